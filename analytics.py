@@ -0,0 +1,278 @@
+"""
+Prediction accuracy analytics, for `manage.py analytics`.
+
+Actual arrivals are inferred from vehicle locations: a vehicle arrives at a
+stop when it first comes within ANALYTICS_ARRIVAL_RADIUS meters of it. Each
+prediction is matched to its vehicle's next arrival at its stop after the
+prediction was made, and its error (actual minus predicted, in seconds;
+positive means late) is counted in a histogram by route, stop and lead time
+(how long before the predicted time the prediction was made).
+
+Both tables are streamed through server-side cursors, ANALYTICS_CHUNK_SIZE
+rows at a time, and the distance tests and matching work on whole arrays.
+Runs are incremental: each one counts the arrivals since the watermark left
+by the last run, re-reading only ANALYTICS_MAX_LEAD of older history for the
+arrivals and predictions that those depend on. History is processed in
+windows of at most ANALYTICS_WINDOW, each committed with its watermark, so
+an interrupted run resumes where it stopped.
+
+Live ingest only needs a few minutes of history, but with ANALYTICS_ENABLED
+the stale-row cleanup keeps everything that the next run still needs (see
+retain_since), for at most ANALYTICS_MAX_RETENTION. Celery beat runs the
+analysis nightly, so that is about a day plus ANALYTICS_MAX_LEAD.
+"""
+import numpy as np
+from collections import Counter
+from datetime import datetime
+from lock import Lock
+from app import app, db
+
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LON = 111320
+WATERMARK = 'prediction_accuracy'
+
+def _seconds(times):
+    """
+    Datetimes as an array of integer seconds since the epoch.
+    """
+    return np.array(times, dtype='datetime64[s]').astype(np.int64)
+
+def detect_arrivals(times, lat, lon, stop_lat, stop_lon, radius, max_gap, chunk=None):
+    """
+    Find one vehicle's arrivals at stops.
+    times (seconds), lat, lon = the vehicle's locations, oldest first
+    stop_lat, stop_lon = the stops to test
+    chunk = test this many locations at a time (default ANALYTICS_CHUNK_SIZE),
+            to bound the size of the locations x stops distance matrix
+    Returns arrays of (location index, stop index): where the vehicle came
+    within radius meters of a stop, having been further away, or not reported
+    for over max_gap seconds, at its previous location.
+    """
+    chunk = chunk or app.config['ANALYTICS_CHUNK_SIZE']
+    found_i, found_j = [], []
+    for start in range(0, len(times), chunk):
+        # Include the location before the chunk, to compare its first one with.
+        lo = max(start - 1, 0)
+        s = slice(lo, start + chunk)
+        dy = (lat[s, None] - stop_lat[None, :]) * METERS_PER_DEGREE_LAT
+        dx = (lon[s, None] - stop_lon[None, :]) * METERS_PER_DEGREE_LON \
+             * np.cos(np.radians(lat[s]))[:, None]
+        near = dx * dx + dy * dy <= radius * radius
+        before = np.zeros_like(near)
+        before[1:] = near[:-1] & (np.diff(times[s]) <= max_gap)[:, None]
+        i, j = np.nonzero(near & ~before)
+        keep = i + lo >= start
+        found_i.append(i[keep] + lo)
+        found_j.append(j[keep])
+    if not found_i:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(found_i), np.concatenate(found_j)
+
+def route_stops():
+    """
+    Get each route's stops, as route id -> (stop ids, lats, lons) arrays.
+    """
+    from models import RouteStop, Stop
+    stops = {}
+    for route_id, stop_id, lat, lon in db.session.query(
+                RouteStop.route_id, Stop.id, Stop.lat, Stop.lon)\
+            .join(Stop, Stop.id == RouteStop.stop_id)\
+            .filter(Stop.lat != None, Stop.lon != None):
+        stops.setdefault(route_id, []).append((stop_id, lat, lon))
+    return {route_id: tuple(np.array(c) for c in zip(*s)) for route_id, s in stops.items()}
+
+def _vehicle_arrivals(rows, stops):
+    """
+    Detect arrivals in one vehicle's location rows of (route id, time, lat,
+    lon), testing the stops of every route it served in them.
+    Returns (stop ids, times) arrays.
+    """
+    route_ids, times, lat, lon = zip(*rows)
+    served = [stops[r] for r in set(route_ids) if r in stops]
+    if not served:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    stop_ids, first = np.unique(np.concatenate([s[0] for s in served]), return_index=True)
+    stop_lat = np.concatenate([s[1] for s in served])[first]
+    stop_lon = np.concatenate([s[2] for s in served])[first]
+    times = _seconds(times)
+    i, j = detect_arrivals(times, np.array(lat, dtype=float), np.array(lon, dtype=float),
+                           stop_lat, stop_lon, app.config['ANALYTICS_ARRIVAL_RADIUS'],
+                           app.config['ANALYTICS_ARRIVAL_GAP'])
+    return stop_ids[j], times[i]
+
+def arrivals(start, end, stops):
+    """
+    Detect all arrivals from the vehicle locations recorded in [start, end).
+    Returns a dict of (vehicle, stop id) -> key, and arrays of keys and
+    arrival times (seconds), sorted by key and then time.
+    """
+    from models import VehicleLocation
+    query = db.session.query(VehicleLocation.vehicle, VehicleLocation.route_id,
+                             VehicleLocation.time, VehicleLocation.lat, VehicleLocation.lon)\
+                .filter(VehicleLocation.time >= start, VehicleLocation.time < end,
+                        VehicleLocation.vehicle != None, VehicleLocation.lat != None,
+                        VehicleLocation.lon != None)\
+                .order_by(VehicleLocation.vehicle, VehicleLocation.time)\
+                .yield_per(app.config['ANALYTICS_CHUNK_SIZE'])
+    pairs = {}
+    keys, times = [], []
+    def add(vehicle, rows):
+        stop_ids, arrived = _vehicle_arrivals(rows, stops)
+        keys.extend(pairs.setdefault((vehicle, s), len(pairs)) for s in stop_ids.tolist())
+        times.append(arrived)
+    vehicle, rows = None, []
+    for v, route_id, time, lat, lon in query:
+        if v != vehicle:
+            if rows:
+                add(vehicle, rows)
+            vehicle, rows = v, []
+        rows.append((route_id, time, lat, lon))
+    if rows:
+        add(vehicle, rows)
+    keys = np.array(keys, dtype=np.int64)
+    times = np.concatenate(times) if times else np.array([], dtype=np.int64)
+    order = np.lexsort((times, keys))
+    return pairs, keys[order], times[order]
+
+def histogram(route_ids, stop_ids, lead, error):
+    """
+    Count predictions by (route id, stop id, lead bucket, error bin).
+    lead and error are in seconds. Returns a Counter keyed by tuples where
+    the lead bucket is its lower bound in minutes (see ANALYTICS_LEAD_BUCKETS)
+    and the error bin is its lower bound in seconds.
+    """
+    edges = np.array(app.config['ANALYTICS_LEAD_BUCKETS']) * 60
+    bucket = np.array(app.config['ANALYTICS_LEAD_BUCKETS'])[
+                 np.searchsorted(edges, lead, side='right') - 1]
+    size = app.config['ANALYTICS_ERROR_BIN']
+    cols = np.vstack([route_ids, stop_ids, bucket, np.floor_divide(error, size) * size])
+    if not cols.shape[1]:
+        return Counter()
+    cols = cols[:, np.lexsort(cols[::-1])]
+    starts = np.flatnonzero(np.concatenate(([True], np.any(cols[:, 1:] != cols[:, :-1], axis=0))))
+    counts = np.diff(np.append(starts, cols.shape[1]))
+    return Counter({tuple(cols[:, s].tolist()): int(n) for s, n in zip(starts, counts)})
+
+def match(start, end, pairs, keys, times):
+    """
+    Match the predictions made in [start - ANALYTICS_MAX_LEAD, end) against
+    arrivals (from arrivals()), and count the errors of the ones whose
+    arrival was in [start, end). Returns (histogram Counter, matched count).
+    """
+    from models import Prediction
+    max_lead = app.config['ANALYTICS_MAX_LEAD'].total_seconds()
+    max_error = app.config['ANALYTICS_MAX_ERROR']
+    if not len(keys):
+        return Counter(), 0
+    base = int(_seconds([start - app.config['ANALYTICS_MAX_LEAD']])[0])
+    lo, hi = _seconds([start, end])
+    # Arrivals as one sorted array of key * 2^32 + time, for searchsorted.
+    combined = keys * 2**32 + (times - base)
+    query = db.session.query(Prediction.vehicle, Prediction.stop_id, Prediction.route_id,
+                             Prediction.created, Prediction.prediction)\
+                .filter(Prediction.created >= start - app.config['ANALYTICS_MAX_LEAD'],
+                        Prediction.created < end, Prediction.prediction != None,
+                        Prediction.vehicle != None, Prediction.stop_id != None)\
+                .yield_per(app.config['ANALYTICS_CHUNK_SIZE'])
+    counts, matched = Counter(), 0
+    chunk = []
+    def flush(chunk):
+        vehicles, stop_ids, route_ids, created, predicted = zip(*chunk)
+        pair_keys = np.array([pairs.get(p, -1) for p in zip(vehicles, stop_ids)],
+                             dtype=np.int64)
+        created, predicted = _seconds(created), _seconds(predicted)
+        # The first arrival of the same vehicle at the same stop after the
+        # prediction was made.
+        i = np.searchsorted(combined, pair_keys * 2**32 + (created - base))
+        found = (pair_keys >= 0) & (i < len(keys))
+        i = np.where(found, i, 0)
+        found &= keys[i] == pair_keys
+        arrived = times[i]
+        lead, error = predicted - created, arrived - predicted
+        # A match far off the prediction was probably another trip.
+        ok = found & (arrived >= lo) & (arrived < hi) & (arrived - created <= max_lead)\
+             & (lead >= 0) & (np.abs(error) <= max_error)
+        counts.update(histogram(np.array(route_ids)[ok], np.array(stop_ids)[ok],
+                                lead[ok], error[ok]))
+        return int(ok.sum())
+    for row in query:
+        chunk.append(row)
+        if len(chunk) == app.config['ANALYTICS_CHUNK_SIZE']:
+            matched += flush(chunk)
+            chunk = []
+    if chunk:
+        matched += flush(chunk)
+    return counts, matched
+
+def save(counts):
+    """
+    Add histogram counts to the stored PredictionError rows.
+    """
+    from models import PredictionError
+    if not counts:
+        return
+    table = PredictionError.__table__
+    columns = (table.c.route_id, table.c.stop_id, table.c.lead, table.c.error)
+    route_ids = {k[0] for k in counts}
+    existing = {tuple(r[:4]): r[4] for r in db.session.query(
+                    PredictionError.route_id, PredictionError.stop_id,
+                    PredictionError.lead, PredictionError.error, PredictionError.count)\
+                .filter(PredictionError.route_id.in_(route_ids))}
+    names = ('route_id', 'stop_id', 'lead', 'error')
+    updates = [dict(zip(('r', 's', 'l', 'e'), k), new_count=existing[k] + n)
+               for k, n in counts.items() if k in existing]
+    inserts = [dict(zip(names, k), count=n) for k, n in counts.items() if k not in existing]
+    if updates:
+        db.session.execute(table.update()\
+            .where(db.and_(*[c == db.bindparam(b) for c, b in zip(columns, 'rsle')]))\
+            .values(count=db.bindparam('new_count')), updates)
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+def retain_since():
+    """
+    The oldest history which the next run needs, or None if it needs all of
+    it (there is no watermark yet).
+    """
+    from models import Watermark
+    watermark = db.session.query(Watermark.time).filter(Watermark.name == WATERMARK).scalar()
+    return watermark - app.config['ANALYTICS_MAX_LEAD'] if watermark else None
+
+def run(rebuild=False, now=None):
+    """
+    Process the history since the watermark. rebuild = start over.
+    Yields (start, end, arrivals, matched predictions) per window.
+    Only one run at a time: raises LockException if another is in progress.
+    """
+    with Lock("analytics", expires=60 * 60, timeout=0):
+        yield from _run(rebuild, now)
+
+def _run(rebuild, now):
+    from models import PredictionError, VehicleLocation, Watermark
+    now = now or datetime.now()
+    if rebuild:
+        db.session.begin()
+        db.session.query(PredictionError).delete()
+        db.session.query(Watermark).filter(Watermark.name == WATERMARK).delete()
+        db.session.commit()
+    stops = route_stops()
+    watermark = db.session.query(Watermark.time).filter(Watermark.name == WATERMARK).scalar()
+    if watermark is None:
+        watermark = db.session.query(db.func.min(VehicleLocation.time)).scalar()
+        if watermark is None:
+            return
+    while watermark < now:
+        end = min(watermark + app.config['ANALYTICS_WINDOW'], now)
+        db.session.begin()
+        try:
+            pairs, keys, times = arrivals(watermark - app.config['ANALYTICS_MAX_LEAD'],
+                                          end, stops)
+            counts, matched = match(watermark, end, pairs, keys, times)
+            save(counts)
+            db.session.merge(Watermark(name=WATERMARK, time=end))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+        yield watermark, end, int((times >= _seconds([watermark])[0]).sum()), matched
+        watermark = end
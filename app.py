@@ -1,9 +1,12 @@
+import math
 import os
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, abort, jsonify, render_template, request
 from flask.ext.bower import Bower
 from sqlalchemy.orm import joinedload
 from models import db
-from datetime import datetime
+import metrics
+from querybudget import QueryBudget
+from datetime import datetime, timedelta
 
 app = Flask(__name__, instance_relative_config=True)
 
@@ -17,23 +20,33 @@ app.config.from_pyfile('config.py', silent=True)
 # Database init
 db.init_app(app)
 
+metrics.configure(app.config['METRICS_ENABLED'], app.config['METRICS_FLUSH_INTERVAL'])
+
 Bower(app)
+QueryBudget(app)
 
 # Flask Web Routes
+def get_agency(agency_tag):
+    """
+    Get an agency from the preloaded catalog, or else the database.
+    """
+    import webcatalog
+    from models import Agency
+    catalog = webcatalog.get()
+    if catalog and agency_tag in catalog.agencies:
+        return catalog.agencies[agency_tag]
+    return db.session.query(Agency).filter(Agency.tag==agency_tag).one()
+
 @app.route('/')
 def map():
-    from models import Agency
     # TODO: serve different agency depending on cookie (or special domain)
-    agency_tag = app.config['AGENCIES'][0]
-    agency = db.session.query(Agency).filter(Agency.tag==agency_tag).one()
+    agency = get_agency(app.config['AGENCIES'][0])
     return render_template('map.html', agency=agency, config=app.config)
 
 @app.route('/embed')
 def map_embed():
-    from models import Agency
     # TODO: serve different agency depending on cookie (or special domain)
-    agency_tag = app.config['AGENCIES'][0]
-    agency = db.session.query(Agency).filter(Agency.tag==agency_tag).one()
+    agency = get_agency(app.config['AGENCIES'][0])
     return render_template('map.html', agency=agency, config=app.config, embed=True)
 
 @app.route('/ajax')
@@ -43,42 +56,46 @@ def ajax():
     dataset = request.args.get('dataset')
     agency = request.args.get('agency')
     def routes():
-        from models import Agency, Route, RouteStop, Stop
-        routes = db.session.query(Route).join(Agency)\
-            .filter(Agency.tag==agency).all()
-        stops = db.session.query(Stop).options(joinedload(Stop.routes))\
-            .filter(Stop.routes.any(Route.id.in_([r.id for r in routes]))).all()
-        return {
-            "routes": {r.tag: r.serialize() for r in routes},
-            "stops": {s.id: s.serialize() for s in stops}
-        }
+        import webcatalog
+        catalog = webcatalog.get()
+        if catalog and agency in catalog.routes_json:
+            return Response(catalog.routes_json[agency], mimetype='application/json')
+        return jsonify(webcatalog.routes_document(agency))
 
     def vehicles():
         from models import Agency, Route, VehicleLocation, Prediction
         # TODO: Somehow bundle these queries into the object model definitions? So messy :(
-        # 1. Select the latest vehicle locations for each vehicle. (The DB may have old ones too).
+        # 1. Select the latest vehicle locations for each vehicle. (The DB may have old ones too,
+        # kept for analytics).
+        now = datetime.now()
         v_inner = db.session.query(VehicleLocation.vehicle,
                                 db.func.max(VehicleLocation.time).label("time"))\
+                            .filter(VehicleLocation.time >= now -
+                                    timedelta(seconds=app.config['LOCATIONS_MAX_AGE']))\
                             .group_by(VehicleLocation.vehicle).subquery()
-        vehicle_locations = db.session.query(VehicleLocation).join(v_inner, db.and_(
+        vehicle_locations = db.session.query(VehicleLocation)\
+            .options(joinedload(VehicleLocation.route), joinedload(VehicleLocation.direction))\
+            .join(v_inner, db.and_(
                 v_inner.c.vehicle == VehicleLocation.vehicle,
                 v_inner.c.time == VehicleLocation.time
             )).filter(Agency.tag==agency).all()
         # 2. Select the predictions for each vehicle:stop pair which came from the most recent
         # API call for that vehicle:stop pair. Old predictions may be stored but we don't want them.
-        now = datetime.now()
         p_inner = db.session.query(Prediction.vehicle, Prediction.stop_id,
                                    db.func.max(Prediction.api_call_id).label("api_call_id"))\
+                            .filter(Prediction.created >= now -
+                                    timedelta(seconds=app.config['PREDICTIONS_MAX_AGE']))\
                             .group_by(Prediction.vehicle, Prediction.stop_id)\
                             .subquery()
-        predictions = db.session.query(Prediction).join(p_inner, db.and_(
+        predictions = db.session.query(Prediction)\
+            .options(joinedload(Prediction.route), joinedload(Prediction.direction))\
+            .join(p_inner, db.and_(
                 p_inner.c.api_call_id == Prediction.api_call_id,
                 p_inner.c.vehicle == Prediction.vehicle,
                 p_inner.c.stop_id == Prediction.stop_id
             )).filter(
                 Agency.tag==agency,
                 Prediction.prediction >= now)\
-            .group_by(Prediction.id, Prediction.vehicle, Prediction.stop_id)\
             .all()
 
         z = {
@@ -87,12 +104,133 @@ def ajax():
         }
         return z
 
+    def positions():
+        import deadreckoning
+        now = datetime.now()
+        return {
+            "time": now,
+            "locations": deadreckoning.positions(agency, now),
+        }
+
+    def headways():
+        import headways
+        return {
+            "time": datetime.now(),
+            "headways": headways.load(agency),
+        }
+
     if dataset == "routes":
-        r = jsonify(routes())
+        r = routes()
     elif dataset == "vehicles":
         r = jsonify(vehicles())
+    elif dataset == "positions":
+        r = jsonify(positions())
+    elif dataset == "headways":
+        r = jsonify(headways())
     return r
 
+@app.route('/vehicles/<vehicle>/track')
+def vehicle_track(vehicle):
+    """
+    A vehicle's recent path as an encoded polyline, simplified for the map's
+    zoom level, with seconds between points. ?minutes=&zoom=
+    """
+    import tracks
+    try:
+        minutes = min(float(request.args.get('minutes', 10)),
+                      app.config['LOCATIONS_MAX_AGE'] / 60)
+        zoom = min(max(int(request.args.get('zoom', 15)), 0), 20)
+    except ValueError:
+        abort(400)
+    t = tracks.track(vehicle, minutes, zoom)
+    if t is None:
+        abort(404)
+    return jsonify(t)
+
+@app.route('/stops/nearby', methods=['GET', 'POST'])
+def stops_nearby():
+    """
+    The k nearest stops within radius meters of a point, with their routes.
+    GET: ?lat=&lon=&k=&radius=&agency=
+    POST (batch): {"points": [[lat, lon], ...], "k":, "radius":, "agency":}
+    """
+    import stopindex
+    if request.method == 'POST':
+        args = request.get_json(force=True, silent=True)
+        if not isinstance(args, dict):
+            abort(400)
+    else:
+        args = request.args
+    try:
+        k = max(1, min(int(args.get('k', 10)), 100))
+        radius = min(float(args.get('radius', 500)), 5000)
+        if request.method == 'POST':
+            points = [(float(lat), float(lon)) for lat, lon in args['points']][:1000]
+        else:
+            points = [(float(args['lat']), float(args['lon']))]
+        if not all(math.isfinite(v) for v in [radius] + [v for p in points for v in p]):
+            raise ValueError("lat, lon and radius must be finite")
+    except (KeyError, TypeError, ValueError, OverflowError):
+        abort(400)
+    index = stopindex.index()
+    results = [{
+        'stops': [{
+            'id': stop['id'],
+            'title': stop['title'],
+            'lat': stop['lat'],
+            'lon': stop['lon'],
+            'routes': stop['routes'],
+            'distance': round(distance, 1),
+        } for distance, stop in index.nearest(lat, lon, k, radius, args.get('agency'))]
+    } for lat, lon in points]
+    if request.method == 'POST':
+        return jsonify(results=results)
+    return jsonify(results[0])
+
+@app.route('/stops/<int:stop_id>/predictions')
+def stop_predictions(stop_id):
+    """ Upcoming arrivals at one stop, by route and direction. """
+    import stopcache
+    doc = stopcache.get(stop_id)
+    if doc is None:
+        doc = stopcache.load(stop_id)
+        if doc is None:
+            abort(404)
+    response = Response(doc, mimetype='application/json')
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['STOP_PREDICTIONS_MAX_AGE']
+    return response
+
+@app.route('/paths/<agency>/<int:z>/<int:x>/<int:y>.json')
+def path_tile(agency, z, x, y):
+    """ An agency's route paths within one map tile, simplified for its zoom. """
+    import paths
+    if not (0 <= z <= 22 and 0 <= x < 2**z and 0 <= y < 2**z):
+        abort(404)
+    response = Response(paths.tile(agency, z, x, y), mimetype='application/json')
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['PATH_TILE_MAX_AGE']
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled():
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+if app.config['PRELOAD_CATALOG']:
+    # Load the web catalog before a pre-forking server forks its workers.
+    import webcatalog
+    try:
+        with app.app_context():
+            try:
+                webcatalog.preload()
+            finally:
+                # Don't let forked workers inherit (and share) the pooled connection.
+                db.engine.dispose()
+    except Exception as e:
+        print("Could not preload the catalog; serving it from the database: {0!r}".format(e))
+
 if __name__ == '__main__':
     # Run Flask
     app.run(host='0.0.0.0')
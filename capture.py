@@ -0,0 +1,149 @@
+"""
+Record/replay of raw Nextbus traffic.
+
+With CAPTURE_DIR set, every Nextbus response is appended to an archive in
+that directory: each process writes a `<pid>-<start>.data` file of gzipped
+response bodies and a `<pid>-<start>.index` file with one JSON line per
+response (params, status, timing, and where its body is in the data file).
+
+An archive can be replayed through the same parsing and DB code as live
+ingest, either at the speed it was recorded or as fast as possible.
+"""
+import gzip
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from itertools import groupby
+from requests.structures import CaseInsensitiveDict
+
+class Recorder():
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, "{0}-{1}".format(os.getpid(), int(time.time())))
+        self.data = open(name + ".data", "ab")
+        self.index = open(name + ".index", "a")
+        self.lock = threading.Lock()
+
+    def record(self, batch, params, tag_name, response, sent):
+        """
+        Append one response to the archive.
+        batch = identifies the requests which were sent together
+        sent = when the request was sent (epoch seconds)
+        """
+        body = gzip.compress(response.content) if response is not None else b""
+        entry = {
+            'batch': batch,
+            'sent': sent,
+            'elapsed': response.elapsed.total_seconds() if response is not None else None,
+            'params': params,
+            'tag': tag_name,
+            'status': response.status_code if response is not None else None,
+            'headers': dict(response.headers) if response is not None else {},
+        }
+        with self.lock:
+            entry['offset'] = self.data.tell()
+            entry['length'] = len(body)
+            self.data.write(body)
+            self.data.flush()
+            self.index.write(json.dumps(entry) + "\n")
+            self.index.flush()
+
+
+class ReplayedResponse():
+    """
+    Enough of a requests.Response for Nextbus.parse_responses().
+    """
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    def __bool__(self):
+        return self.status_code < 400
+
+
+class Archive():
+    def __init__(self, directory):
+        """
+        Open all the captures in a directory.
+        """
+        self.directory = directory
+        self.entries = []
+        for f in sorted(os.listdir(directory)):
+            if f.endswith(".index"):
+                name = os.path.join(directory, f[:-len(".index")])
+                with open(name + ".index") as index:
+                    for line in index:
+                        entry = json.loads(line)
+                        entry['file'] = name + ".data"
+                        self.entries.append(entry)
+        self.entries.sort(key=lambda e: e['sent'])
+
+    def batches(self):
+        """
+        Iterate over (sent time, [entries]) for each batch of requests,
+        in the order they were sent.
+        """
+        by_batch = OrderedDict()
+        for entry in self.entries:
+            by_batch.setdefault((entry['file'], entry['batch']), []).append(entry)
+        for entries in by_batch.values():
+            yield entries[0]['sent'], entries
+
+    def response(self, entry):
+        """
+        Load an entry's response (or None, for a connection error).
+        """
+        if entry['status'] is None:
+            return None
+        with open(entry['file'], "rb") as data:
+            data.seek(entry['offset'])
+            content = gzip.decompress(data.read(entry['length']))
+        return ReplayedResponse(entry['status'], entry['headers'], content)
+
+
+def replay(archive, speed=1.0, commands=('predictionsForMultiStops', 'vehicleLocations')):
+    """
+    Feed an archive's predictions and vehicle locations through parsing and
+    into the database. speed = 1 replays in real time, 2 twice as fast,
+    0 as fast as possible. Returns the number of rows written per command.
+    """
+    from app import db
+    from models import Prediction, VehicleLocation
+    from nextbus import Nextbus
+    hooks = {
+        'predictionsForMultiStops': (Nextbus.prediction_routes, Nextbus.prediction_rows,
+                                     Prediction, Nextbus.publish_predictions),
+        'vehicleLocations': (Nextbus.vehicle_routes, Nextbus.vehicle_rows,
+                             VehicleLocation, None),
+    }
+    written = {c: 0 for c in commands}
+    first = None
+    for sent, entries in archive.batches():
+        entries = [e for e in entries if e['params'].get('command') in commands]
+        if not entries:
+            continue
+        if first is None:
+            first, start = sent, time.time()
+        if speed:
+            time.sleep(max((sent - first) / speed - (time.time() - start), 0))
+        fetched = [(e['params'], e['tag'], archive.response(e)) for e in entries]
+        key = lambda f: f[0]['command']
+        for command, group in groupby(sorted(fetched, key=key), key=key):
+            load_routes, build_rows, model, publish = hooks[command]
+            group = list(group)
+            agency_tags = list({params['a'] for params, tag, response in group})
+            db.session.begin()
+            # Tagged as replayed, so they don't count against the live quota.
+            responses = Nextbus.parse_responses(group, source='Replay')
+            routes = load_routes(agency_tags)
+            rows = build_rows(routes, responses)
+            fetched = Nextbus.fetched_stops(routes, responses) if publish else None
+            db.session.commit()
+            Nextbus.insert_rows(model, rows)
+            if publish:
+                publish(routes, rows, fetched)
+            written[command] += len(rows)
+    return written
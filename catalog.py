@@ -0,0 +1,86 @@
+"""
+In-memory catalog of routes, stops and directions, for ingest.
+
+Ingest only needs ids: which route a routeTag is, which stop a stopTag is on
+that route, which direction a dirTag is. Rather than load Route objects (with
+all their stops and directions) on every cycle, each process keeps dict
+indexes of those ids, and reloads an agency's only when its version stamp in
+Redis changes. Route imports bump the stamp (see Catalog.bump), so a cycle
+costs one Redis round trip instead of a catalog query.
+"""
+import threading
+from lock import connection
+from models import Agency, Direction, Route, RouteStop
+from app import db
+
+class CatalogRoute():
+    """
+    The ids ingest needs for one route.
+    stops = stop tag -> stop id
+    directions = direction tag -> direction id
+    """
+    __slots__ = ('id', 'tag', 'agency_tag', 'stops', 'directions')
+
+    def __init__(self, id, tag, agency_tag):
+        self.id = id
+        self.tag = tag
+        self.agency_tag = agency_tag
+        self.stops = {}
+        self.directions = {}
+
+class Catalog():
+    # Hash of agency tag -> version. The '*' field is bumped when all
+    # agencies change at once (e.g. the agency list is re-imported).
+    version_key = "bm-catalog-version"
+
+    def __init__(self):
+        self.r = connection()
+        self.agencies = {}  # agency tag -> (version, {route tag: CatalogRoute})
+        self.lock = threading.Lock()
+
+    @classmethod
+    def bump(cls, agency_tag=None):
+        """
+        Mark an agency's routes (or all agencies', with no tag) as changed.
+        Call this after the change is committed.
+        """
+        connection().hincrby(cls.version_key, agency_tag or '*', 1)
+
+    def routes(self, agency_tags):
+        """
+        Get the routes of some agencies, as a dict of
+        (agency tag, route tag) -> CatalogRoute.
+        """
+        agency_tags = list(agency_tags)
+        if not agency_tags:
+            return {}
+        versions = self.r.hmget(self.version_key, ['*'] + agency_tags)
+        versions = {a: (versions[0], v) for a, v in zip(agency_tags, versions[1:])}
+        with self.lock:
+            stale = [a for a in agency_tags
+                     if a not in self.agencies or self.agencies[a][0] != versions[a]]
+            if stale:
+                self._load(stale, versions)
+            return {(a, r_tag): route for a in agency_tags
+                    for r_tag, route in self.agencies[a][1].items()}
+
+    def _load(self, agency_tags, versions):
+        loaded = {a: {} for a in agency_tags}
+        by_id = {}
+        for route_id, route_tag, agency_tag in db.session.query(
+                    Route.id, Route.tag, Agency.tag).join(Agency)\
+                .filter(Agency.tag.in_(agency_tags)):
+            route = CatalogRoute(route_id, route_tag, agency_tag)
+            loaded[agency_tag][route_tag] = route
+            by_id[route_id] = route
+        if by_id:
+            for route_id, tag, direction_id in db.session.query(
+                        Direction.route_id, Direction.tag, Direction.id)\
+                    .filter(Direction.route_id.in_(list(by_id))):
+                by_id[route_id].directions[tag] = direction_id
+            for route_id, stop_tag, stop_id in db.session.query(
+                        RouteStop.route_id, RouteStop.stop_tag, RouteStop.stop_id)\
+                    .filter(RouteStop.route_id.in_(list(by_id))):
+                by_id[route_id].stops[stop_tag] = stop_id
+        for agency_tag in agency_tags:
+            self.agencies[agency_tag] = (versions[agency_tag], loaded[agency_tag])
@@ -1,10 +1,16 @@
+from celery.signals import celeryd_after_setup, task_postrun, task_prerun, worker_shutdown
 from celery.utils.log import get_task_logger
 from flask.ext.celery import Celery
 from datetime import datetime, timedelta
 import time
 from app import app, db
+from lock import SingleFlight
+import metrics
+import os
+import profiler
 from models import Agency, Prediction
 from nextbus import Nextbus
+from shards import Cycle, ShardRing
 
 """
 Celery is a task queue for background task processing. We're using it
@@ -29,6 +35,98 @@ celery.Task = ContextTask
 
 logger = get_task_logger(__name__)
 
+# Ingest queues, for spreading per-agency work over several workers.
+# Start workers with e.g. `celery -A celerytasks.celery worker -Q ingest-0,celery`.
+ingest_queues = ["ingest-{0}".format(i) for i in range(app.config['INGEST_QUEUE_COUNT'])]
+shard_ring = ShardRing(ingest_queues)
+
+@celeryd_after_setup.connect
+def register_ingest_queues(sender, instance, **kwargs):
+    """ Announce this worker's ingest queues, so shards get assigned to them. """
+    instance.busmap_queues = list(instance.app.amqp.queues.consume_from)
+    shard_ring.register(instance.busmap_queues)
+
+@celeryd_after_setup.connect
+def serve_metrics(sender, instance, **kwargs):
+    """ Serve ingest metrics in Prometheus text format, if METRICS_PORT is set. """
+    if not (metrics.enabled() and app.config['METRICS_PORT']):
+        return
+    try:
+        metrics.serve(app.config['METRICS_PORT'])
+    except OSError as e:
+        # e.g. another worker on this host already serves them.
+        logger.warning("Not serving metrics on port {0}: {1}".format(app.config['METRICS_PORT'], e))
+
+@worker_shutdown.connect
+def unregister_ingest_queues(sender, **kwargs):
+    """ Withdraw this worker's ingest queues, so their shards move elsewhere. """
+    shard_ring.unregister(getattr(sender, 'busmap_queues', []))
+
+def profile_directory():
+    return app.config['PROFILER_DIR'] or os.path.join(app.instance_path, 'profiles')
+
+@task_prerun.connect
+def profile_task(sender=None, task=None, **kwargs):
+    """ Sample this task's stacks, if the profiler is on. """
+    if app.config['PROFILER_RATE']:
+        profiler.profiler(app.config['PROFILER_RATE'], profile_directory(),
+                          app.config['PROFILER_WRITE_INTERVAL']).task_started(task.name)
+
+@task_postrun.connect
+def unprofile_task(sender=None, task=None, **kwargs):
+    if app.config['PROFILER_RATE']:
+        profiler.profiler(app.config['PROFILER_RATE'], profile_directory(),
+                          app.config['PROFILER_WRITE_INTERVAL']).task_finished()
+
+def dispatch(task, dataset, agencies, **kwargs):
+    """
+    Fan a task out into one shard per agency. Each shard is queued on the
+    ingest queue which the shard ring assigns to it (or the default queue,
+    if no ingest workers are running). Returns the Cycle tracking them.
+    """
+    cycle = Cycle.start(dataset, agencies)
+    for agency_tag in agencies:
+        queue = shard_ring.assign("{0}:{1}".format(dataset, agency_tag),
+                                  default=app.config['CELERY_DEFAULT_QUEUE'])
+        kw = dict(kwargs, cycle=cycle.id)
+        task.apply_async(([agency_tag],), kw, queue=queue)
+    return cycle
+
+def finish_shard(dataset, cycle_id, rows, skipped, failed=False):
+    """
+    Report a finished (or failed) shard to its cycle, and the cycle once all
+    shards are done.
+    """
+    if cycle_id is None:
+        return
+    summary = Cycle(dataset, cycle_id).finish(rows, skipped, failed)
+    if summary:
+        print("{0} cycle {1}: {2} shards ({3} skipped, {4} failed), {5} rows in {6:0.2f} sec."\
+              .format(dataset, summary['cycle'], summary['shards'], summary['skipped'],
+                      summary['failed'], summary['rows'], summary['elapsed']))
+
+def single_flight(task, dataset, agency_tag, fn, followup=False):
+    """
+    Run fn() for one agency's dataset, unless a run is already in progress.
+    Overlapping ticks are merged into one follow-up run of `task`, which
+    starts SINGLE_FLIGHT_GAP seconds after the current run finishes.
+    """
+    entry = next((e for e in app.config['CELERYBEAT_SCHEDULE'].values()
+                  if e['task'] == task.name), None)
+    if entry is None:
+        raise RuntimeError("{0} has no CELERYBEAT_SCHEDULE entry; single-flight tasks "
+                           "must be scheduled.".format(task.name))
+    interval = entry['schedule'].total_seconds()
+    flight = SingleFlight("{0}:{1}".format(dataset, agency_tag),
+                          interval=interval,
+                          gap=app.config['SINGLE_FLIGHT_GAP'][dataset])
+    def schedule(countdown):
+        queue = shard_ring.assign("{0}:{1}".format(dataset, agency_tag),
+                                  default=app.config['CELERY_DEFAULT_QUEUE'])
+        task.apply_async(([agency_tag],), {'followup': True},
+                         countdown=countdown, queue=queue)
+    return flight.run(fn, schedule, followup)
+
 # Task definitions:
 @celery.task()
 def update_agencies():
@@ -38,44 +136,90 @@ def update_agencies():
     Nextbus.get_agencies(truncate=True)
 
 @celery.task()
-def update_routes(agencies=None):
+def update_routes(agencies=None, cycle=None):
     """
     Refresh our list of Routes, Stops, and Directions from Nextbus
     """
-    if not agencies:
-        agencies = app.config['AGENCIES']
+    if not agencies or len(agencies) > 1:
+        # Route locks are per-agency, so refresh each agency in its own task.
+        # This lets separate workers import them in parallel.
+        dispatch(update_routes, 'routes', agencies or app.config['AGENCIES'])
+        return
     route_count = 0
-    for agency_tag in agencies:
-        route_count += len(Nextbus.get_routes(agency_tag, truncate=True))
+    failed = True
+    try:
+        for agency_tag in agencies:
+            route_count += len(Nextbus.get_routes(agency_tag, truncate=False))
+        failed = False
+    finally:
+        finish_shard('routes', cycle, route_count, False, failed)
     print("update_routes: Got {0} routes for {1} agencies"\
           .format(route_count, len(agencies)))
 
 @celery.task()
-def update_predictions(agencies=None):
+def update_predictions(agencies=None, followup=False, cycle=None):
     """
     Get the latest vehicle arrival predictions from Nextbus
     """
-    start = time.time()
-    if not agencies:
-        agencies = app.config['AGENCIES']
-    prediction_count = len(Nextbus.get_predictions(agencies, truncate=False))
-    elapsed = time.time() - start
-    print("Got {0} predictions for {1} agencies in {2:0.2f} sec."\
-          .format(prediction_count, len(agencies), elapsed))
+    if not agencies or len(agencies) > 1:
+        # Each agency is a shard, with its own single-flight task.
+        dispatch(update_predictions, 'predictions', agencies or app.config['AGENCIES'])
+        return
+    def run():
+        start = time.time()
+        prediction_count = len(Nextbus.get_predictions(agencies, truncate=False))
+        elapsed = time.time() - start
+        print("Got {0} predictions for {1} agencies in {2:0.2f} sec."\
+              .format(prediction_count, len(agencies), elapsed))
+        return prediction_count
+    count, failed = None, True
+    try:
+        count = single_flight(update_predictions, 'predictions', agencies[0], run, followup)
+        failed = False
+    finally:
+        finish_shard('predictions', cycle, count or 0, count is None and not failed, failed)
 
 @celery.task()
-def update_vehicle_locations(agencies=None):
+def update_vehicle_locations(agencies=None, followup=False, cycle=None):
     """
     Get the latest vehicle locations (coords/speed/heading) from NextBus
     """
-    start = time.time()
-    if not agencies:
-        agencies = app.config['AGENCIES']
-    vl_count = len(Nextbus.get_vehicle_locations(agencies, truncate=False))
-    elapsed = time.time() - start
-    print("Got {0} vehicle locations for {1} agencies in {2:0.2f} seconds."\
-          .format(vl_count, len(agencies), elapsed))
+    if not agencies or len(agencies) > 1:
+        # Each agency is a shard, with its own single-flight task.
+        dispatch(update_vehicle_locations, 'vehicle_locations', agencies or app.config['AGENCIES'])
+        return
+    def run():
+        start = time.time()
+        vl_count = len(Nextbus.get_vehicle_locations(agencies, truncate=False))
+        elapsed = time.time() - start
+        print("Got {0} vehicle locations for {1} agencies in {2:0.2f} seconds."\
+              .format(vl_count, len(agencies), elapsed))
+        return vl_count
+    count, failed = None, True
+    try:
+        count = single_flight(update_vehicle_locations, 'vehicle_locations', agencies[0],
+                              run, followup)
+        failed = False
+    finally:
+        finish_shard('vehicle_locations', cycle, count or 0, count is None and not failed,
+                     failed)
+
 
+@celery.task()
+def update_analytics():
+    """
+    Add the history since the last run to the prediction accuracy analytics.
+    """
+    import analytics
+    from lock import LockException
+    if not app.config['ANALYTICS_ENABLED']:
+        return
+    try:
+        matched = sum(w[3] for w in analytics.run())
+    except LockException:
+        print("update_analytics: another run is in progress.")
+        return
+    print("update_analytics: matched {0} predictions.".format(matched))
 
 @celery.task()
 def delete_stale_predictions():
@@ -4,6 +4,10 @@ class Config(object):
     CELERY_BROKER_URL = 'redis://'
     CELERY_RESULT_BACKEND = 'redis://'
     CELERY_ACCEPT_CONTENT = ['pickle']
+    CELERY_DEFAULT_QUEUE = 'celery'
+    # Number of ingest queues (ingest-0 ... ingest-N) which per-agency work is
+    # sharded over. Each worker consumes one or more of them.
+    INGEST_QUEUE_COUNT = 4
     CELERYBEAT_SCHEDULE = {
         'update-agencies-every-week': {
             'task': 'celerytasks.update_agencies',
@@ -29,12 +33,122 @@ class Config(object):
             'task': 'celerytasks.delete_stale_vehicle_locations',
             'schedule': timedelta(minutes=5),
         },
+        'update-analytics-every-24h': {
+            'task': 'celerytasks.update_analytics',
+            'schedule': timedelta(hours=24),
+        },
+    }
+    # Single-flight ingest: min. seconds between the end of one run and the start
+    # of the next, per agency. Ticks that arrive sooner are merged or skipped.
+    SINGLE_FLIGHT_GAP = {
+        'predictions': 3,
+        'vehicle_locations': 1,
     }
+    # Max. seconds a Nextbus request may wait for API quota before it is
+    # deferred to the next cycle (see quota.py).
+    QUOTA_MAX_DEFER = {
+        'vehicleLocations': 2,
+        'predictionsForMultiStops': 5,
+        'routeConfig': 60,
+        'routeList': 60,
+        'agencyList': 60,
+    }
+    # Fraction of the quota window which a command may always use, whatever
+    # higher-priority commands spend (see quota.py).
+    QUOTA_MIN_SHARE = {
+        'routeConfig': 0.1,
+        'routeList': 0.1,
+        'agencyList': 0.1,
+    }
+    # Caps for each predictionsForMultiStops request: estimated response size,
+    # and URL length (some proxies and servers reject very long query strings).
+    PREDICTIONS_BATCH_MAX_BYTES = 128 * 1024
+    PREDICTIONS_BATCH_MAX_URL_LENGTH = 4000
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     PREDICTIONS_MAX_AGE = 5 * 60;
+    # /stops/<id>/predictions: how long ingest's per-stop documents live in
+    # Redis, and how long clients may cache a response (seconds).
+    STOP_PREDICTIONS_CACHE_TTL = 30
+    STOP_PREDICTIONS_MAX_AGE = 5
+    # Load the configured agencies and their routes and stops into memory when
+    # the app is imported (see webcatalog.py), to serve pages and routes
+    # without catalog queries. Best with a pre-forking server.
+    PRELOAD_CATALOG = False
+    # /ajax?dataset=positions moves each vehicle along its heading at its speed
+    # since its last report, but for at most this many seconds.
+    EXTRAPOLATE_MAX_SECONDS = 30
+    # /vehicles/<id>/track leaves out points within this many pixels (at the
+    # requested zoom) of the simplified line.
+    TRACK_TOLERANCE_PIXELS = 1
+    # Prediction accuracy analytics (see analytics.py), run nightly. While
+    # enabled, stale predictions and vehicle locations are kept until the
+    # analysis has used them, but for no longer than MAX_RETENTION.
+    ANALYTICS_ENABLED = False
+    ANALYTICS_MAX_RETENTION = timedelta(days=2)
+    # A vehicle has arrived at a stop when it comes
+    # within ARRIVAL_RADIUS meters of it, after being further away or not
+    # reporting for ARRIVAL_GAP seconds. Predictions made more than MAX_LEAD
+    # before their arrival, or off by more than MAX_ERROR seconds, are taken
+    # to be for another trip. Errors are counted in ERROR_BIN-second bins by
+    # lead time bucket (lower bounds, in minutes).
+    ANALYTICS_ARRIVAL_RADIUS = 30
+    ANALYTICS_ARRIVAL_GAP = 10 * 60
+    ANALYTICS_MAX_LEAD = timedelta(hours=1)
+    ANALYTICS_MAX_ERROR = 15 * 60
+    ANALYTICS_ERROR_BIN = 30
+    ANALYTICS_LEAD_BUCKETS = [0, 1, 3, 5, 10, 15, 20, 30, 45]
+    ANALYTICS_CHUNK_SIZE = 10000
+    ANALYTICS_WINDOW = timedelta(days=1)
+    # A vehicle is bunched when its headway is under BUNCHING_SECONDS, or
+    # under BUNCHING_RATIO times the median for its route and direction.
+    HEADWAY_BUNCHING_SECONDS = 2 * 60
+    HEADWAY_BUNCHING_RATIO = 0.25
+    # Stored headways are rewritten when one moves by more than this many
+    # seconds (or a leader or bunching changes), and not served once they
+    # haven't been refreshed by a predictions cycle for MAX_AGE seconds.
+    HEADWAY_CHANGE_SECONDS = 30
+    HEADWAY_MAX_AGE = 60
+    # Route paths are stored simplified for each zoom level in this range
+    # (leaving out points within TOLERANCE_PIXELS of the line), and served as
+    # tiles, cached in Redis and by clients for these many seconds.
+    PATH_MIN_ZOOM = 10
+    PATH_MAX_ZOOM = 18
+    PATH_TOLERANCE_PIXELS = 0.5
+    PATH_TILE_CACHE_TTL = 24 * 60 * 60
+    PATH_TILE_MAX_AGE = 60 * 60
     LOCATIONS_MAX_AGE = 5 * 60;
     AGENCIES = ['rutgers']
 
+    # Nextbus feed URL. Point this at simulator.py for offline/load testing.
+    NEXTBUS_API_URL = 'http://webservices.nextbus.com/service/publicXMLFeed'
+
+    # Set to a directory to record every Nextbus response there (see capture.py).
+    CAPTURE_DIR = None
+
+    # Ingest metrics (see metrics.py). Set METRICS_ENABLED = False to turn
+    # instrumentation off. Each process flushes its metrics to Redis every
+    # METRICS_FLUSH_INTERVAL seconds. Celery workers serve them on METRICS_PORT
+    # (None = don't); the web app serves them at /metrics.
+    METRICS_ENABLED = True
+    METRICS_FLUSH_INTERVAL = 10
+    METRICS_PORT = 9108
+
+    # SQL statement counting per request (see querybudget.py).
+    # SQL_DEBUG_HEADERS returns counts, DB time and likely N+1s as X-SQL-* headers.
+    # SQL_QUERY_BUDGET_ENFORCE fails requests which run more statements than
+    # their endpoint's budget in SQL_QUERY_BUDGETS.
+    SQL_DEBUG_HEADERS = False
+    SQL_QUERY_BUDGET_ENFORCE = False
+    SQL_QUERY_BUDGETS = {}
+    SQL_REPEAT_THRESHOLD = 5
+
+    # Sampling profiler for Celery workers (see profiler.py): samples per
+    # second (0 = off), where to write collapsed stacks (None = instance/profiles),
+    # and how often to write them (seconds).
+    PROFILER_RATE = 10
+    PROFILER_DIR = None
+    PROFILER_WRITE_INTERVAL = 60
+
     # Stops with the same tag within this distance of each other will be averaged to one lat/lon point.
     # 0.001 = 110 Meters (football field)
     SAME_STOP_LAT = 0.005
@@ -55,6 +169,27 @@ class ProdConfig(Config):
 
 class DevConfig(Config):
     DEBUG = True
+    SQL_DEBUG_HEADERS = True
     SQLALCHEMY_URI = 'postgresql://localhost/pybusmap_dev'
     CELERY_BROKER_URL = 'redis://localhost/1'
     CELERY_RESULT_BACKEND = 'redis://localhost/1'
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_URI = 'postgresql://localhost/pybusmap_test'
+    CELERY_BROKER_URL = 'redis://localhost/2'
+    CELERY_RESULT_BACKEND = 'redis://localhost/2'
+    SQL_DEBUG_HEADERS = True
+    SQL_QUERY_BUDGET_ENFORCE = True
+    SQL_QUERY_BUDGETS = {
+        'ajax:routes': 4,
+        'ajax:vehicles': 2,
+        'ajax:positions': 1,
+        'ajax:headways': 1,
+        'map': 1,
+        'map_embed': 1,
+        'stop_predictions': 2,
+        'stops_nearby': 2,
+        'vehicle_track': 1,
+        'path_tile': 1,
+    }
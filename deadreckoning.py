@@ -0,0 +1,74 @@
+"""
+Dead reckoning: estimate where vehicles are now from their last report.
+
+Each vehicle is moved along its reported heading at its reported speed, for
+as long as it's been since the report, but for no more than
+EXTRAPOLATE_MAX_SECONDS (beyond that, a bus has likely stopped or turned).
+The whole fleet is computed in one vectorized pass.
+"""
+import numpy as np
+from datetime import datetime, timedelta
+from app import app, db
+
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LON = 111320
+
+def extrapolate(lat, lon, heading, speed_kmh, age, max_seconds):
+    """
+    Extrapolate positions. All arguments are equal-length arrays (heading in
+    degrees clockwise from north, NaN if unknown; age in seconds), except
+    max_seconds. Returns (lat, lon, seconds extrapolated).
+    """
+    seconds = np.clip(age, 0, max_seconds)
+    # No heading or no speed: stay put.
+    moving = ~np.isnan(heading) & ~np.isnan(speed_kmh) & (speed_kmh > 0)
+    seconds = np.where(moving, seconds, 0)
+    meters = np.where(moving, speed_kmh, 0) / 3.6 * seconds
+    theta = np.radians(np.where(moving, heading, 0))
+    new_lat = lat + meters * np.cos(theta) / METERS_PER_DEGREE_LAT
+    new_lon = lon + meters * np.sin(theta) / (METERS_PER_DEGREE_LON * np.cos(np.radians(lat)))
+    return new_lat, new_lon, seconds
+
+def positions(agency_tag, now=None):
+    """
+    The extrapolated current position of each of an agency's vehicles,
+    from its latest location report.
+    """
+    from models import Agency, Direction, Route, VehicleLocation
+    now = now or datetime.now()
+    latest = db.session.query(VehicleLocation.vehicle,
+                              db.func.max(VehicleLocation.time).label("time"))\
+                .filter(VehicleLocation.time >= now -
+                        timedelta(seconds=app.config['LOCATIONS_MAX_AGE']))\
+                .group_by(VehicleLocation.vehicle).subquery()
+    rows = db.session.query(VehicleLocation.vehicle, Route.tag, Direction.tag,
+                            VehicleLocation.lat, VehicleLocation.lon,
+                            VehicleLocation.heading, VehicleLocation.speed,
+                            VehicleLocation.time)\
+                .join(latest, db.and_(latest.c.vehicle == VehicleLocation.vehicle,
+                                      latest.c.time == VehicleLocation.time))\
+                .join(Route, Route.id == VehicleLocation.route_id).join(Agency)\
+                .outerjoin(Direction, Direction.id == VehicleLocation.direction_id)\
+                .filter(Agency.tag == agency_tag).all()
+    if not rows:
+        return {}
+    vehicles, route_tags, direction_tags, lat, lon, heading, speed, times = zip(*rows)
+    as_float = lambda values: np.array([np.nan if v is None else v for v in values], dtype=float)
+    age = np.array([(now - t).total_seconds() for t in times])
+    new_lat, new_lon, seconds = extrapolate(as_float(lat), as_float(lon), as_float(heading),
+                                            as_float(speed), age,
+                                            app.config['EXTRAPOLATE_MAX_SECONDS'])
+    return {
+        vehicle: {
+            'vehicle': vehicle,
+            'route': route_tags[i],
+            'direction': direction_tags[i],
+            'lat': round(float(new_lat[i]), 6),
+            'lon': round(float(new_lon[i]), 6),
+            'heading': heading[i],
+            'speed': speed[i],
+            'time': times[i],
+            'age': round(float(age[i]), 1),
+            'extrapolated': round(float(seconds[i]), 1),
+        } for i, vehicle in enumerate(vehicles)
+    }
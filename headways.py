@@ -0,0 +1,177 @@
+"""
+Live headways between consecutive vehicles, and bunching, for
+/ajax?dataset=headways.
+
+After every predictions cycle, each vehicle's next predicted arrival at each
+stop is compared with the vehicle arriving just before it there (its leader).
+A vehicle's headway is the median gap to its leader over the stops which they
+both have predictions for. A vehicle is bunched if that is under
+HEADWAY_BUNCHING_SECONDS, or under HEADWAY_BUNCHING_RATIO times the median
+headway of its route and direction.
+
+Results are kept in the headway table, one row per vehicle. Computing them
+is cheap; writing them is what costs, so a route's rows are only rewritten
+when its headways changed meaningfully since they were stored (a snapshot
+of them is kept in Redis to compare with). When each route was last
+computed is kept in Redis too, so unchanged routes don't touch the table.
+"""
+import json
+from datetime import datetime, timedelta
+from statistics import median
+from lock import connection
+from app import app, db
+import metrics
+
+results_key = "bm-headway-results"
+computed_key = "bm-headway-computed"
+
+def _snapshot(headways):
+    """
+    What a route's stored headways are compared by: (direction id, vehicle)
+    -> (leader, bunched, headway).
+    """
+    return {(h['direction_id'], h['vehicle']): (h['leader'], h['bunched'], h['headway'])
+            for h in headways}
+
+def changed(old, new):
+    """
+    Whether a route's headways changed meaningfully since they were stored:
+    a vehicle's leader or bunching changed, a vehicle came or went, or a
+    headway moved by more than HEADWAY_CHANGE_SECONDS.
+    """
+    if old is None or set(old) != set(new):
+        return True
+    threshold = app.config['HEADWAY_CHANGE_SECONDS']
+    return any(old[k][:2] != new[k][:2] or abs(old[k][2] - new[k][2]) > threshold
+               for k in new)
+
+def compute(rows, now=None):
+    """
+    Compute a route's headways from its prediction rows (dicts). Rows
+    without a direction (Nextbus sent an unknown dirTag) are left out.
+    Returns a list of dicts with direction_id, vehicle, leader, headway
+    (seconds), stops (how many stops it was measured at) and bunched.
+    """
+    now = now or datetime.now()
+    # Each vehicle's next arrival at each stop.
+    first = {}
+    for r in rows:
+        if r['prediction'] < now or not r['vehicle'] or r['direction_id'] is None:
+            continue
+        key = (r['direction_id'], r['stop_id'], r['vehicle'])
+        if key not in first or r['prediction'] < first[key]:
+            first[key] = r['prediction']
+    at_stop = {}
+    for (direction_id, stop_id, vehicle), t in first.items():
+        at_stop.setdefault((direction_id, stop_id), []).append((t, vehicle))
+    gaps = {}
+    for (direction_id, stop_id), arrivals in at_stop.items():
+        arrivals.sort()
+        for (t0, leader), (t1, vehicle) in zip(arrivals, arrivals[1:]):
+            gaps.setdefault((direction_id, vehicle, leader), [])\
+                .append((t1 - t0).total_seconds())
+    # A vehicle's leader is the one arriving just before it at the most stops.
+    best = {}
+    for (direction_id, vehicle, leader), g in sorted(gaps.items()):
+        if len(g) > len(best.get((direction_id, vehicle), (None, []))[1]):
+            best[direction_id, vehicle] = (leader, g)
+    by_direction = {}
+    for (direction_id, vehicle), (leader, g) in best.items():
+        by_direction.setdefault(direction_id, []).append({
+            'direction_id': direction_id,
+            'vehicle': vehicle,
+            'leader': leader,
+            'headway': int(round(median(g))),
+            'stops': len(g),
+        })
+    result = []
+    for items in by_direction.values():
+        typical = median(i['headway'] for i in items)
+        for i in items:
+            i['bunched'] = i['headway'] < app.config['HEADWAY_BUNCHING_SECONDS'] \
+                or i['headway'] < app.config['HEADWAY_BUNCHING_RATIO'] * typical
+        result.extend(items)
+    return result
+
+def update(routes, rows):
+    """
+    Recompute the headways of this cycle's routes, and rewrite the stored
+    ones of the routes where they changed (see changed()).
+    routes = the cycle's routes, as (agency tag, route tag) -> CatalogRoute;
+    rows = the cycle's Prediction rows (dicts).
+    Returns the ids of the routes which were rewritten.
+    """
+    from models import Headway
+    by_route = {route.id: [] for route in routes.values()}
+    for r in rows:
+        if r['route_id'] in by_route:
+            by_route[r['route_id']].append(r)
+    if not by_route:
+        return []
+    with metrics.timer('busmap_headways'):
+        now = datetime.now()
+        route_ids = list(by_route)
+        computed = {route_id: compute(by_route[route_id], now) for route_id in route_ids}
+        stored = connection().hmget(results_key, route_ids)
+        rewrite = []
+        for route_id, old in zip(route_ids, stored):
+            old = {tuple(k): tuple(v) for k, v in json.loads(old.decode())} \
+                if old is not None else None
+            if changed(old, _snapshot(computed[route_id])):
+                rewrite.append(route_id)
+        if rewrite:
+            headways = [dict(h, route_id=route_id, updated=now) for route_id in rewrite
+                        for h in computed[route_id]]
+            db.session.begin()
+            try:
+                db.session.query(Headway).filter(Headway.route_id.in_(rewrite))\
+                    .delete(synchronize_session=False)
+                if headways:
+                    db.session.execute(Headway.__table__.insert(), headways)
+                db.session.commit()
+            except:
+                db.session.rollback()
+                raise
+            connection().hmset(results_key, {
+                route_id: json.dumps([[list(k), list(v)] for k, v in
+                                      _snapshot(computed[route_id]).items()])
+                for route_id in rewrite})
+        connection().hmset(computed_key, {route_id: now.timestamp() for route_id in route_ids})
+    metrics.inc('busmap_headway_routes_updated_total', len(rewrite))
+    return rewrite
+
+def load(agency_tag):
+    """
+    Get an agency's headways, as route tag -> direction tag -> list of
+    vehicles, shortest headway first. Leaves out routes which haven't been
+    computed in a predictions cycle for HEADWAY_MAX_AGE seconds; `updated` is
+    when each route was last computed.
+    """
+    from models import Agency, Direction, Headway, Route
+    rows = db.session.query(Route.id, Route.tag, Direction.tag, Headway.vehicle,
+                            Headway.leader, Headway.headway, Headway.stops, Headway.bunched)\
+                .join(Headway, Headway.route_id == Route.id).join(Agency)\
+                .join(Direction, Direction.id == Headway.direction_id)\
+                .filter(Agency.tag == agency_tag)\
+                .order_by(Headway.headway).all()
+    route_ids = list({row[0] for row in rows})
+    oldest = datetime.now() - timedelta(seconds=app.config['HEADWAY_MAX_AGE'])
+    computed = {}
+    for route_id, t in zip(route_ids, connection().hmget(computed_key, route_ids)
+                           if route_ids else []):
+        if t is not None and datetime.fromtimestamp(float(t)) >= oldest:
+            computed[route_id] = datetime.fromtimestamp(float(t))
+    result = {}
+    for route_id, route_tag, direction_tag, vehicle, leader, headway, stops, bunched in rows:
+        if route_id not in computed:
+            continue
+        updated = computed[route_id]
+        result.setdefault(route_tag, {}).setdefault(direction_tag, []).append({
+            'vehicle': vehicle,
+            'leader': leader,
+            'headway': headway,
+            'stops': stops,
+            'bunched': bunched,
+            'updated': updated,
+        })
+    return result
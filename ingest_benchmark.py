@@ -0,0 +1,127 @@
+"""
+Benchmark for the three ingest entry points: Nextbus.get_routes,
+get_vehicle_locations and get_predictions.
+
+For each size (routes x stops per route x vehicles per route), a simulated
+Nextbus feed (simulator.py) is started in-process, the benchmark database is
+reset, and each entry point is run against it. For every phase the benchmark
+reports wall time, rows written, rows per second, SQL statements and peak
+Python memory, and all results are saved as JSON so runs from different
+commits can be compared.
+
+Needs Redis and a Postgres database which may be wiped, e.g.:
+    python ingest_benchmark.py postgresql://localhost/pybusmap_bench \
+        --sizes 10x10x2,50x25x4,200x30x8 --output bench.json
+"""
+import argparse
+import json
+import subprocess
+import threading
+import time
+import tracemalloc
+from sqlalchemy import event
+from app import app, db
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Counter():
+    """
+    Counts SQL statements executed on an engine.
+    """
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+
+def measure(counter, fn):
+    """
+    Run fn() and return (result, stats).
+    """
+    tracemalloc.start()
+    statements = counter.count
+    start = time.time()
+    result = fn()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rows = len(result)
+    return result, {
+        'seconds': round(elapsed, 4),
+        'rows': rows,
+        'rows_per_second': round(rows / elapsed, 1) if elapsed else None,
+        'sql_statements': counter.count - statements,
+        'peak_memory_bytes': peak,
+    }
+
+
+def run(size, port, counter):
+    """
+    Run every phase for one size. Returns {phase: stats}.
+    """
+    from nextbus import Nextbus
+    from quota import QuotaPlanner
+    from simulator import Simulator, Handler, ThreadingServer
+    routes, stops, vehicles = size
+    simulator = Simulator(agencies=1, routes=routes, stops=stops, vehicles=vehicles,
+                          max_bytes=2**40)
+    Handler.simulator = simulator
+    server = ThreadingServer(('localhost', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Nextbus.api_url = "http://localhost:{0}/service/publicXMLFeed".format(port)
+    # The simulator has no quota worth planning for.
+    Nextbus._quota = QuotaPlanner(2**40, Nextbus.api_limits['max_bytes_timeframe_seconds'])
+    try:
+        db.drop_all()
+        db.create_all()
+        Nextbus.get_agencies(truncate=True)
+        agency = simulator.agencies[0].tag
+        phases = {}
+        for phase, fn in (
+                ('routes', lambda: Nextbus.get_routes(agency, truncate=True)),
+                ('vehicle_locations', lambda: Nextbus.get_vehicle_locations([agency], truncate=False)),
+                ('predictions', lambda: Nextbus.get_predictions([agency], truncate=False))):
+            result, phases[phase] = measure(counter, fn)
+        return phases
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ingest benchmark")
+    parser.add_argument('database', help="Postgres URL. This database will be wiped!")
+    parser.add_argument('--sizes', default="10x10x2,50x25x4,200x30x8",
+        help="comma-separated ROUTESxSTOPSxVEHICLES (stops and vehicles per route)")
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--output', default="ingest_benchmark.json")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['CAPTURE_DIR'] = None
+    sizes = [tuple(int(n) for n in s.split("x")) for s in args.sizes.split(",")]
+    results = []
+    with app.app_context():
+        counter = Counter(db.engine)
+        for size in sizes:
+            phases = run(size, args.port, counter)
+            results.append({'routes': size[0], 'stops_per_route': size[1],
+                            'vehicles_per_route': size[2], 'phases': phases})
+            for phase, stats in phases.items():
+                print("{0:>4} routes x {1:>3} stops x {2:>3} vehicles | {3:<17} {4:8.3f} sec"
+                      " {5:7} rows {6:>10} rows/sec {7:6} SQL {8:8.1f} MB peak".format(
+                      size[0], size[1], size[2], phase, stats['seconds'], stats['rows'],
+                      stats['rows_per_second'], stats['sql_statements'],
+                      stats['peak_memory_bytes'] / 1024**2))
+    with open(args.output, "w") as f:
+        json.dump({'commit': git_commit(), 'time': time.time(), 'results': results},
+                  f, indent=2)
+    print("Results saved to {0}".format(args.output))
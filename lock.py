@@ -1,103 +1,265 @@
 import redis
-import pickle
 import os
-from time import sleep, time
-from random import random
+import metrics
+from time import time
+from uuid import uuid4
+
+# All locks in this process share one connection pool.
+_pool = None
+_scripts = {}
+
+def connection():
+    """
+    Get a Redis client backed by the shared connection pool.
+    """
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool()
+    return redis.StrictRedis(connection_pool=_pool)
+
+# Lua scripts. Each one runs atomically on the Redis server, so checking for
+# a conflicting lock and taking ours can never interleave with another client.
+#
+# KEYS: exclusive key, shared key (zset of token -> expiry), fence counter, channel
+# ARGV: token, now (ms), expires (ms)
+
+# Take an exclusive lock. The first call claims the exclusive key, which stops
+# new shared locks; the lock is held once all existing shared locks are gone.
+# Returns a fencing token when held, 0 while waiting on readers, -1 if busy.
+_ACQUIRE_EXCLUSIVE = """
+local owner = redis.call('get', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return -1
+end
+redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[3])
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[2])
+if redis.call('zcard', KEYS[2]) > 0 then
+    return 0
+end
+return redis.call('incr', KEYS[3])
+"""
+
+# Take a shared lock, unless somebody holds (or is claiming) the exclusive one.
+# Returns a fencing token, or -1 if busy.
+_ACQUIRE_SHARED = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return -1
+end
+redis.call('zadd', KEYS[2], ARGV[2] + ARGV[3], ARGV[1])
+redis.call('pexpire', KEYS[2], ARGV[3])
+return redis.call('incr', KEYS[3])
+"""
+
+# Release an exclusive lock (only if we still own it) and wake up waiters.
+_RELEASE_EXCLUSIVE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    redis.call('publish', KEYS[4], 'x')
+    return 1
+end
+return 0
+"""
+
+# Release a shared lock and wake up waiters.
+_RELEASE_SHARED = """
+local removed = redis.call('zrem', KEYS[2], ARGV[1])
+redis.call('publish', KEYS[4], 's')
+return removed
+"""
 
 class Lock():
-    def __init__(cls, key, shared=False, expires=25, timeout=30, step=0.5):
+    def __init__(self, key, shared=False, expires=25, timeout=30, step=0.5):
         """
-        A lock mechanism, using Redis as a backend.
+        A reader/writer lock mechanism, using Redis as a backend.
 
         key = identifier for this lock
         expires = lock expiration time in seconds (when it is considered stale)
         timeout = max time to wait for a lock to become available
+        step = max time to sleep between attempts if no release is announced
 
         Multiple shared locks can exist simultaneously.
         Only one non-shared (exclusive) lock can exist at a time.
         Shared locks wait for exclusive locks to release.
         If an exclusive lock is set, new shared lock attempts will wait (block).
         Similarly, exclusive locks will wait (block) until all shared locks to clear.
-        """
-
-        cls.r = redis.StrictRedis()
 
-        cls.exclusive_key = "bm-lock-x-{0}".format(key)
-        cls.shared_key = "bm-lock-s-{0}".format(key)
-        cls.shared = shared
-        cls.expires = expires
-        cls.timeout = timeout
-        cls.step = step
-        cls.pid = os.getpid()
+        Acquire and release are atomic Lua scripts. Waiters are woken up through
+        pub/sub as soon as a lock is released, so they don't have to poll.
+        Once acquired, `fence` holds a fencing token which increases with every
+        lock taken on this key.
+        """
+        self.r = connection()
 
+        self.key = key
+        self.exclusive_key = "bm-lock-x-{0}".format(key)
+        self.shared_key = "bm-lock-s-{0}".format(key)
+        self.fence_key = "bm-lock-f-{0}".format(key)
+        self.channel = "bm-lock-c-{0}".format(key)
+        self.shared = shared
+        self.expires = expires
+        self.timeout = timeout
+        self.step = step
+        self.token = "{0}:{1}".format(os.getpid(), uuid4().hex)
+        self.fence = None
 
-    def __enter__(cls):
+    def __enter__(self):
         """
         Attempt to acquire the lock.
-        If the lock is unavailable, retry for `timeout` seconds.
-        If a stale lock is found (older than `expires`), remove it.
+        If the lock is unavailable, wait up to `timeout` seconds for a release.
+        Stale locks (older than `expires`) expire on their own.
         """
-        while cls.timeout >= 0:
-            cls.expires = time() + cls.expires + 1
-            if cls.shared:
-                # Make sure nobody has exclusive, but don't take it.
-                if not cls.r.get(cls.exclusive_key):
-                    # Nobody has exclusive. Get our shared lock
-                    cls._set_shared()
-                    return
-            else:
-                # We're getting an exclusive lock. Set it.
-                if cls._set_exclusive():
-                    # Some shared locks may still exist. Wait for them to release.
-                    cls._wait_for_shared()
-                    return
-            # Lock not aquired! Check for stale exclusive lock
-            oldlock = cls.r.get(cls.exclusive_key)
-            (existing_expires, existing_pid) = pickle.loads(oldlock)
-            if existing_expires and float(existing_expires) < time():
-                # Stale Exc Lock found. Delete it.
-                cls.r.delete(cls.exclusive_key)
-            # Tick and repeat until timeout.
-            if existing_expires:
-                remaining = existing_expires - time()
-            cls.timeout -= cls.step
-            sleep(cls.step)
+        script = _ACQUIRE_SHARED if self.shared else _ACQUIRE_EXCLUSIVE
+        start = time()
+        deadline = start + self.timeout
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        # Subscribe before the first attempt, so a release can't slip by unnoticed.
+        pubsub.subscribe(self.channel)
+        try:
+            while True:
+                fence = self._eval(script)
+                if fence > 0:
+                    self.fence = fence
+                    metrics.observe('busmap_lock_wait', time() - start, lock=self.key)
+                    return self
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                pubsub.get_message(timeout=min(self.step, remaining))
+        finally:
+            pubsub.close()
+        if not self.shared:
+            # Give up our claim on the exclusive lock, so readers may continue.
+            self._eval(_RELEASE_EXCLUSIVE)
         # Timed out
-        raise(LockException("Could not acquire lock: {0}".format(cls.exclusive_key)))
+        metrics.inc('busmap_lock_timeouts_total', lock=self.key)
+        raise(LockException("Could not acquire lock: {0}".format(self.exclusive_key)))
 
-    def __exit__(cls, typ, value, traceback):
+    def __exit__(self, typ, value, traceback):
         """
         Release the lock.
         """
-        if cls.shared:
-            cls.r.lrem(cls.shared_key, 0, pickle.dumps((cls.expires, cls.pid)))
-        else:
-            cls.r.delete(cls.exclusive_key)
+        self._eval(_RELEASE_SHARED if self.shared else _RELEASE_EXCLUSIVE)
+        self.fence = None
+
+    def _eval(self, script):
+        """
+        Run one of the lock scripts against this lock's keys.
+        """
+        keys = [self.exclusive_key, self.shared_key, self.fence_key, self.channel]
+        args = [self.token, int(time() * 1000), int(self.expires * 1000)]
+        if script not in _scripts:
+            _scripts[script] = self.r.register_script(script)
+        return _scripts[script](keys=keys, args=args, client=self.r)
 
-    def _set_shared(cls):
+class LockException(Exception):
+    pass
+
+
+# Start a single-flight run, unless one is in progress or it's too early.
+# KEYS: running, pending, finished, stats
+# ARGV: token, now (ms), expires (ms), gap (ms), is_followup
+# Returns {1, 0} to run; {0, -1} if merged into the run in progress;
+# {0, countdown (ms)} if merged into a follow-up; {0, -2} if skipped.
+_FLIGHT_START = """
+if ARGV[5] == '1' then
+    redis.call('del', KEYS[2])
+end
+if not redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[3]) then
+    if redis.call('set', KEYS[2], 1, 'NX', 'PX', ARGV[3]) then
+        redis.call('hincrby', KEYS[4], 'merged', 1)
+        return {0, -1}
+    end
+    redis.call('hincrby', KEYS[4], 'skipped', 1)
+    return {0, -2}
+end
+local due = tonumber(redis.call('get', KEYS[3]) or 0) + tonumber(ARGV[4])
+if tonumber(ARGV[2]) < due then
+    redis.call('del', KEYS[1])
+    if redis.call('set', KEYS[2], 1, 'NX', 'PX', ARGV[3]) then
+        redis.call('hincrby', KEYS[4], 'merged', 1)
+        return {0, due - tonumber(ARGV[2])}
+    end
+    redis.call('hincrby', KEYS[4], 'skipped', 1)
+    return {0, -2}
+end
+return {1, 0}
+"""
+
+# Finish a single-flight run and record its stats.
+# KEYS: running, pending, finished, stats
+# ARGV: token, now (ms), elapsed (ms), interval (ms)
+# Returns 1 if ticks were merged into this run and a follow-up is owed.
+_FLIGHT_FINISH = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+redis.call('set', KEYS[3], ARGV[2])
+redis.call('hincrby', KEYS[4], 'runs', 1)
+redis.call('hset', KEYS[4], 'last_elapsed_ms', ARGV[3])
+if tonumber(ARGV[3]) > tonumber(ARGV[4]) then
+    redis.call('hincrby', KEYS[4], 'overruns', 1)
+end
+return redis.call('exists', KEYS[2])
+"""
+
+class SingleFlight():
+    def __init__(self, key, interval, gap=0, expires=300):
         """
-        Set a shared lock
+        Run periodic work at most once at a time, using Redis as a backend.
+
+        key = identifier for this job (e.g. dataset and agency)
+        interval = the period it is scheduled at, in seconds
+        gap = minimum time between the end of one run and the start of the next
+        expires = how long a run may take before it's considered dead
+
+        A tick which arrives while a run is in progress (or sooner than `gap`
+        after the last one finished) doesn't queue up behind it. The first such
+        tick is merged into one follow-up run, scheduled `gap` seconds after
+        the current run finishes; any further ticks are skipped.
+        Runs, merged and skipped ticks, and overruns (runs longer than
+        `interval`) are counted in the `bm-flight-stats-<key>` hash.
         """
-        return cls.r.lpush(cls.shared_key, pickle.dumps((cls.expires, cls.pid)))
+        self.r = connection()
+        self.running_key = "bm-flight-r-{0}".format(key)
+        self.pending_key = "bm-flight-p-{0}".format(key)
+        self.finished_key = "bm-flight-f-{0}".format(key)
+        self.stats_key = "bm-flight-stats-{0}".format(key)
+        self.interval = interval
+        self.gap = gap
+        self.expires = expires
 
-    def _set_exclusive(cls):
+    def run(self, fn, schedule, followup=False):
         """
-        Set an exclusive lock
+        Call fn() and return its result, or return None if this tick was merged
+        or skipped. schedule(countdown) must queue a follow-up tick (with
+        followup=True) to run after `countdown` seconds.
         """
-        return cls.r.setnx(cls.exclusive_key, pickle.dumps((cls.expires,cls.pid)))
-
-    def _wait_for_shared(cls):
-        while cls.r.llen(cls.shared_key) > 0 and cls.timeout >= 0:
-            for sk in cls.r.lrange(cls.shared_key, 0, -1):
-                (cls.expires, cls.pid) = pickle.loads(sk)
-                if float(cls.expires) < time():
-                    cls.r.lrem(cls.shared_key, 0, pickle.dumps((cls.expires, cls.pid)))
-                cls.timeout -= cls.step
-                sleep(cls.step)
-        if cls.r.llen(cls.shared_key) == 0:
-            return
-        else:
-            raise(LockException("Shared locks still present: {0}".format(cls.shared_key)))
+        token = "{0}:{1}".format(os.getpid(), uuid4().hex)
+        should_run, countdown = self._eval(_FLIGHT_START, token,
+            int(self.expires * 1000), int(self.gap * 1000), int(bool(followup)))
+        if not should_run:
+            if countdown >= 0:
+                schedule(countdown / 1000)
+            return None
+        start = time()
+        try:
+            return fn()
+        finally:
+            elapsed = time() - start
+            owed = self._eval(_FLIGHT_FINISH, token,
+                int(elapsed * 1000), int(self.interval * 1000))
+            if owed:
+                schedule(self.gap)
 
-class LockException(Exception):
-    pass
+    def stats(self):
+        """
+        Get this job's counters as a dict.
+        """
+        return {k.decode(): int(v) for k, v in self.r.hgetall(self.stats_key).items()}
+
+    def _eval(self, script, token, *args):
+        keys = [self.running_key, self.pending_key, self.finished_key, self.stats_key]
+        args = [token, int(time() * 1000)] + list(args)
+        if script not in _scripts:
+            _scripts[script] = self.r.register_script(script)
+        return _scripts[script](keys=keys, args=args, client=self.r)
@@ -0,0 +1,113 @@
+"""
+Contention benchmark for lock.Lock.
+
+Runs a number of worker processes which repeatedly take a mix of shared and
+exclusive locks on the same key, hold them briefly, and record how long each
+acquisition had to wait. The same workload is run against the current Lock
+and against the old polling implementation (LegacyLock, below).
+
+Usage: python lock_benchmark.py [--workers 8] [--iterations 50]
+                                [--hold 0.01] [--exclusive 0.25]
+"""
+import argparse
+import os
+import pickle
+import random
+import redis
+from multiprocessing import Pool
+from time import sleep, time
+from lock import Lock, LockException
+
+
+class LegacyLock():
+    """
+    The previous lock.Lock: a new connection per lock, polling in `step`
+    increments, and non-atomic check-then-set for shared locks.
+    Kept here only as a baseline for comparison.
+    """
+    def __init__(self, key, shared=False, expires=25, timeout=30, step=0.5):
+        self.r = redis.StrictRedis()
+        self.exclusive_key = "bm-legacylock-x-{0}".format(key)
+        self.shared_key = "bm-legacylock-s-{0}".format(key)
+        self.shared = shared
+        self.expires = expires
+        self.timeout = timeout
+        self.step = step
+        self.pid = os.getpid()
+
+    def __enter__(self):
+        while self.timeout >= 0:
+            self.expires = time() + self.expires + 1
+            value = pickle.dumps((self.expires, self.pid))
+            if self.shared:
+                if not self.r.get(self.exclusive_key):
+                    self.r.lpush(self.shared_key, value)
+                    return self
+            elif self.r.setnx(self.exclusive_key, value):
+                while self.r.llen(self.shared_key) > 0 and self.timeout >= 0:
+                    self.timeout -= self.step
+                    sleep(self.step)
+                return self
+            oldlock = self.r.get(self.exclusive_key)
+            if oldlock:
+                (existing_expires, existing_pid) = pickle.loads(oldlock)
+                if float(existing_expires) < time():
+                    self.r.delete(self.exclusive_key)
+            self.timeout -= self.step
+            sleep(self.step)
+        raise(LockException("Could not acquire lock: {0}".format(self.exclusive_key)))
+
+    def __exit__(self, typ, value, traceback):
+        if self.shared:
+            self.r.lrem(self.shared_key, 0, pickle.dumps((self.expires, self.pid)))
+        else:
+            self.r.delete(self.exclusive_key)
+
+
+def worker(args):
+    """
+    Take `iterations` locks and return the wait time for each one.
+    """
+    lock_class, key, iterations, hold, exclusive = args
+    random.seed(os.getpid())
+    waits = []
+    for i in range(iterations):
+        shared = random.random() >= exclusive
+        start = time()
+        with lock_class(key, shared=shared):
+            waits.append(time() - start)
+            sleep(hold)
+    return waits
+
+
+def run(lock_class, workers, iterations, hold, exclusive):
+    key = "benchmark-{0}".format(os.getpid())
+    start = time()
+    with Pool(workers) as pool:
+        results = pool.map(worker,
+            [(lock_class, key, iterations, hold, exclusive)] * workers)
+    elapsed = time() - start
+    waits = sorted(w for r in results for w in r)
+    return {
+        'elapsed': elapsed,
+        'locks': len(waits),
+        'mean_wait': sum(waits) / len(waits),
+        'p95_wait': waits[int(len(waits) * 0.95)],
+        'max_wait': waits[-1],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Lock contention benchmark")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--hold', type=float, default=0.01,
+        help="seconds to hold each lock")
+    parser.add_argument('--exclusive', type=float, default=0.25,
+        help="fraction of locks which are exclusive")
+    args = parser.parse_args()
+    for name, lock_class in (("legacy", LegacyLock), ("current", Lock)):
+        r = run(lock_class, args.workers, args.iterations, args.hold, args.exclusive)
+        print("{0:>8}: {1} locks in {2:.2f} sec; wait mean {3:.4f} / p95 {4:.4f} / max {5:.4f} sec"\
+              .format(name, r['locks'], r['elapsed'], r['mean_wait'],
+                      r['p95_wait'], r['max_wait']))
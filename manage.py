@@ -1,3 +1,4 @@
+import os
 import time
 import sys
 from flask.ext.script import Manager
@@ -64,6 +65,52 @@ def update_vehicle_locations(loop=False,agencies=None):
     else:
         do_it(agencies)
 
+@manager.option('dataset', choices=('predictions', 'vehicle_locations'))
+@manager.option('-i', '--interval', type=float, default=None,
+                help="Target seconds between cycles (default: the beat schedule's)")
+@manager.option('-q', '--queue-size', dest='queue_size', type=int, default=2,
+                help="Max cycles waiting between pipeline stages")
+@manager.option('-a', '--agencies', default=None)
+@manager.option('-m', '--metrics-port', dest='metrics_port', type=int, default=None,
+                help="Serve metrics in Prometheus text format on this port")
+def ingest_daemon(dataset, interval=None, queue_size=2, agencies=None, metrics_port=None):
+    """
+    Continuously ingest a dataset, with fetch, parse and DB-write running as
+    pipelined stages. Stops gracefully on SIGINT/SIGTERM.
+    """
+    import signal
+    from pipeline import IngestPipeline
+    agencies = agencies.split(",") if agencies else app.config['AGENCIES']
+    if interval is None:
+        interval = next(e['schedule'] for e in app.config['CELERYBEAT_SCHEDULE'].values()
+                        if e['task'] == 'celerytasks.update_{0}'.format(dataset))\
+                   .total_seconds()
+    pipeline = IngestPipeline(dataset, agencies, interval, queue_size)
+    if metrics_port:
+        import metrics
+        metrics.serve(metrics_port)
+    def stop(signum, frame):
+        print("Stopping; finishing cycles in progress...")
+        pipeline.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    pipeline.run()
+
+@manager.option('directory', help="Capture directory (see CAPTURE_DIR)")
+@manager.option('-s', '--speed', type=float, default=1.0,
+                help="1 = real time, 2 = twice as fast, 0 = as fast as possible")
+def replay(directory, speed=1.0):
+    """
+    Replay captured Nextbus predictions and vehicle locations into the database.
+    """
+    from capture import Archive, replay
+    start = time.time()
+    archive = Archive(directory)
+    written = replay(archive, speed)
+    print("Replayed {0} responses in {1:.2f} seconds: {2}".format(
+          len(archive.entries), time.time() - start,
+          ", ".join("{0} {1} rows".format(n, c) for c, n in written.items())))
+
 @manager.command
 def api_quota(tail=False):
     """
@@ -85,5 +132,80 @@ def api_quota(tail=False):
         remaining_mb = Nextbus.remaining_quota() / 1024**2
         print("Nextbus Quota: {0:.3f} MB remaining.".format(remaining_mb))
 
+@manager.command
+def single_flight_stats():
+    """
+    Show run/merged/skipped/overrun counts for the periodic ingest tasks.
+    """
+    from lock import SingleFlight
+    for dataset in app.config['SINGLE_FLIGHT_GAP']:
+        for agency_tag in app.config['AGENCIES']:
+            key = "{0}:{1}".format(dataset, agency_tag)
+            stats = SingleFlight(key, interval=0).stats()
+            print("{0}: {1} runs, {2} merged, {3} skipped, {4} overruns, last run {5} ms"\
+                  .format(key, stats.get('runs', 0), stats.get('merged', 0),
+                          stats.get('skipped', 0), stats.get('overruns', 0),
+                          stats.get('last_elapsed_ms', '-')))
+
+@manager.command
+def ingest_cycles():
+    """
+    Show live ingest queues and the last completed cycle of each dataset.
+    """
+    from celerytasks import shard_ring
+    from shards import Cycle
+    print("Live ingest queues: {0}".format(", ".join(shard_ring.live_queues()) or "none"))
+    for dataset in ('routes', 'predictions', 'vehicle_locations'):
+        last = Cycle.last(dataset)
+        if not last:
+            print("{0}: no completed cycles.".format(dataset))
+            continue
+        print("{0}: cycle {1}, {2} shards ({3} skipped, {4} failed), {5} rows in {6:0.2f} sec, {7:0.0f} sec ago."\
+              .format(dataset, last['cycle'], last['shards'], last['skipped'], last.get('failed', 0),
+                      last['rows'], last['elapsed'], time.time() - last['finished']))
+
+@manager.option('-r', '--rebuild', action='store_true',
+                help="Discard the stored histograms and start over")
+def analytics(rebuild=False):
+    """
+    Match predictions against arrivals inferred from vehicle locations, and
+    add to the prediction error histograms, from where the last run stopped.
+    """
+    import analytics
+    start = time.time()
+    windows = 0
+    for window_start, window_end, arrivals, matched in analytics.run(rebuild):
+        windows += 1
+        print("{0} to {1}: {2} arrivals, {3} predictions matched.".format(
+              window_start, window_end, arrivals, matched))
+    print("Processed {0} windows in {1:.2f} seconds.".format(windows, time.time() - start))
+
+@manager.option('-t', '--task', default=None, help="Only this task, e.g. celerytasks.update_predictions")
+@manager.option('-o', '--output', default=None, help="Write here instead of stdout")
+@manager.option('-a', '--all', dest='include_all', action='store_true',
+                help="Include processes which are no longer running")
+def dump_profile(task=None, output=None, include_all=False):
+    """
+    Collect the Celery workers' sampled stacks in collapsed-stack format,
+    e.g. for `flamegraph.pl profile.folded > profile.svg`.
+    """
+    import profiler
+    from celerytasks import profile_directory
+    directory = profile_directory()
+    profiler.request_dump()
+    # Profilers check for dump requests once per second.
+    time.sleep(2)
+    max_age = None if include_all else 2 * app.config['PROFILER_WRITE_INTERVAL'] + 2
+    counts = profiler.merge(directory, max_age=max_age, task=task) \
+        if os.path.isdir(directory) else {}
+    lines = "".join("{0} {1}\n".format(k, v) for k, v in sorted(counts.items()))
+    if output:
+        with open(output, "w") as f:
+            f.write(lines)
+        print("Wrote {0} samples ({1} stacks) to {2}".format(
+              sum(counts.values()), len(counts), output))
+    else:
+        sys.stdout.write(lines)
+
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,231 @@
+"""
+Ingest metrics: counters, gauges and timers, in Prometheus text format.
+
+Each process adds up its metrics in memory, and a background thread flushes
+them to Redis every few seconds, so an endpoint in any process (the Celery
+worker's, or /metrics in the Flask app) can show the totals of all of them.
+
+Metric names are Prometheus-style; labels are keyword arguments:
+    metrics.inc('busmap_fetch_bytes_total', len(body), agency='rutgers')
+    with metrics.timer('busmap_parse', command='vehicleLocations'):
+        ...
+
+Timers are reported as summaries: <name>_seconds_sum and _seconds_count.
+With instrumentation turned off (see configure()), every call returns
+straight away.
+"""
+import atexit
+import os
+import threading
+from functools import wraps
+from time import sleep, time
+
+counters_key = "bm-metrics-counters"
+gauges_key = "bm-metrics-gauges"
+types_key = "bm-metrics-types"
+
+_enabled = True
+_flush_interval = 10
+_counters = {}
+_gauges = {}
+_types = {}
+_lock = threading.Lock()
+_flusher_pid = None
+
+def configure(enabled=True, flush_interval=10):
+    """
+    Turn instrumentation on or off, and set how often (seconds) to flush.
+    """
+    global _enabled, _flush_interval
+    _enabled = enabled
+    _flush_interval = flush_interval
+
+def enabled():
+    return _enabled
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return "{0}{{{1}}}".format(name, ",".join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    """
+    Add to a counter.
+    """
+    if not _enabled:
+        return
+    _start_flusher()
+    series = _series(name, labels)
+    with _lock:
+        _counters[series] = _counters.get(series, 0) + value
+        _types[name] = 'counter'
+
+def gauge(name, value, **labels):
+    """
+    Set a gauge.
+    """
+    if not _enabled:
+        return
+    _start_flusher()
+    series = _series(name, labels)
+    with _lock:
+        _gauges[series] = value
+        _types[name] = 'gauge'
+
+def observe(name, seconds, **labels):
+    """
+    Record one duration for a timer.
+    """
+    if not _enabled:
+        return
+    _start_flusher()
+    name = name + "_seconds"
+    sum_series = _series(name + "_sum", labels)
+    count_series = _series(name + "_count", labels)
+    with _lock:
+        _counters[sum_series] = _counters.get(sum_series, 0) + seconds
+        _counters[count_series] = _counters.get(count_series, 0) + 1
+        _types[name] = 'summary'
+
+class _Timer():
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        observe(self.name, time() - self.start, **self.labels)
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        pass
+
+_null_timer = _NullTimer()
+
+def timer(name, **labels):
+    """
+    Time a block of code:  with metrics.timer('busmap_insert', table='prediction'):
+    """
+    if not _enabled:
+        return _null_timer
+    return _Timer(name, labels)
+
+def timed(name, **labels):
+    """
+    Decorator version of timer().
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Timer(name, labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _start_flusher():
+    """
+    Start this process's flush thread, if it isn't running yet. Checked by
+    pid, since a forked child (e.g. a Celery pool process) doesn't inherit it.
+    """
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        # Anything recorded before the fork belongs to the parent.
+        _counters.clear()
+        _gauges.clear()
+    def run():
+        while True:
+            sleep(_flush_interval)
+            flush()
+    threading.Thread(target=run, name="metrics-flush", daemon=True).start()
+
+def flush():
+    """
+    Push this process's metrics to Redis.
+    """
+    from lock import connection
+    global _counters, _gauges
+    with _lock:
+        counters, _counters = _counters, {}
+        gauges, _gauges = _gauges, {}
+        types = dict(_types)
+    if not (counters or gauges):
+        return
+    try:
+        pipe = connection().pipeline(transaction=False)
+        for series, value in counters.items():
+            pipe.hincrbyfloat(counters_key, series, value)
+        if gauges:
+            pipe.hmset(gauges_key, gauges)
+        pipe.hmset(types_key, types)
+        pipe.execute()
+    except Exception as e:
+        # Keep what we have, and try again next time.
+        print("Could not flush metrics: {0!r}".format(e))
+        with _lock:
+            for series, value in counters.items():
+                _counters[series] = _counters.get(series, 0) + value
+            for series, value in gauges.items():
+                _gauges.setdefault(series, value)
+
+atexit.register(flush)
+
+def render():
+    """
+    Get all processes' metrics in Prometheus text format.
+    """
+    from lock import connection
+    flush()
+    r = connection()
+    types = {k.decode(): v.decode() for k, v in r.hgetall(types_key).items()}
+    series = {}
+    for key in (counters_key, gauges_key):
+        for k, v in r.hgetall(key).items():
+            k = k.decode()
+            series.setdefault(k.split("{")[0], []).append((k, float(v)))
+    lines = []
+    for name in sorted(types):
+        lines.append("# TYPE {0} {1}".format(name, types[name]))
+        names = [name + "_sum", name + "_count"] if types[name] == 'summary' else [name]
+        for n in names:
+            for k, v in sorted(series.get(n, [])):
+                lines.append("{0} {1}".format(k, repr(v)))
+    return "\n".join(lines) + "\n"
+
+def serve(port, host='0.0.0.0'):
+    """
+    Serve render() over HTTP on a background thread (for the Celery worker).
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+    server = Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,22 @@
+"""Add route fingerprints
+
+Revision ID: 2517d5809a66
+Revises: 40964e5a022
+Create Date: 2026-10-19 10:12:40.118529
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2517d5809a66'
+down_revision = '40964e5a022'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('route', sa.Column('fingerprint', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('route', 'fingerprint')
@@ -0,0 +1,34 @@
+"""Add headways
+
+Revision ID: 3a7e4c9d1f60
+Revises: 8d3f2b6a9e14
+Create Date: 2026-10-19 12:21:53.904417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a7e4c9d1f60'
+down_revision = '8d3f2b6a9e14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('headway',
+    sa.Column('route_id', sa.Integer(), nullable=False),
+    sa.Column('direction_id', sa.Integer(), nullable=False),
+    sa.Column('vehicle', sa.String(), nullable=False),
+    sa.Column('leader', sa.String(), nullable=True),
+    sa.Column('headway', sa.Integer(), nullable=True),
+    sa.Column('stops', sa.Integer(), nullable=True),
+    sa.Column('bunched', sa.Boolean(), nullable=True),
+    sa.Column('updated', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['direction_id'], ['direction.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['route_id'], ['route.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('route_id', 'direction_id', 'vehicle')
+    )
+
+
+def downgrade():
+    op.drop_table('headway')
@@ -0,0 +1,23 @@
+"""Index vehicle locations by vehicle and time
+
+Revision ID: 5c0e8a1f3b27
+Revises: 2517d5809a66
+Create Date: 2026-10-19 11:02:15.540811
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c0e8a1f3b27'
+down_revision = '2517d5809a66'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_vehicle_location_vehicle_time', 'vehicle_location',
+                    ['vehicle', 'time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_vehicle_location_vehicle_time', table_name='vehicle_location')
@@ -0,0 +1,41 @@
+"""Add prediction error histograms and batch job watermarks
+
+Revision ID: 8d3f2b6a9e14
+Revises: 5c0e8a1f3b27
+Create Date: 2026-10-19 11:40:07.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d3f2b6a9e14'
+down_revision = '5c0e8a1f3b27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('prediction_error',
+    sa.Column('route_id', sa.Integer(), nullable=False),
+    sa.Column('stop_id', sa.Integer(), nullable=False),
+    sa.Column('lead', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('error', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['route_id'], ['route.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['stop_id'], ['stop.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('route_id', 'stop_id', 'lead', 'error')
+    )
+    op.create_table('watermark',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('time', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_index('ix_prediction_created', 'prediction', ['created'], unique=False)
+    op.create_index('ix_vehicle_location_time', 'vehicle_location', ['time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_vehicle_location_time', table_name='vehicle_location')
+    op.drop_index('ix_prediction_created', table_name='prediction')
+    op.drop_table('watermark')
+    op.drop_table('prediction_error')
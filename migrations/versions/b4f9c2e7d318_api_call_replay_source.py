@@ -0,0 +1,25 @@
+"""Allow replayed API calls
+
+Revision ID: b4f9c2e7d318
+Revises: e6b1d07c4a52
+Create Date: 2026-10-19 15:12:44.203817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b4f9c2e7d318'
+down_revision = 'e6b1d07c4a52'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.drop_constraint('source', 'api_call', type_='check')
+    op.create_check_constraint('source', 'api_call', "source IN ('Nextbus', 'Replay')")
+
+
+def downgrade():
+    op.execute("DELETE FROM api_call WHERE source = 'Replay'")
+    op.drop_constraint('source', 'api_call', type_='check')
+    op.create_check_constraint('source', 'api_call', "source IN ('Nextbus')")
@@ -0,0 +1,29 @@
+"""Add route paths
+
+Revision ID: e6b1d07c4a52
+Revises: 3a7e4c9d1f60
+Create Date: 2026-10-19 13:05:12.662930
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e6b1d07c4a52'
+down_revision = '3a7e4c9d1f60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('route_path',
+    sa.Column('route_id', sa.Integer(), nullable=False),
+    sa.Column('zoom', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('points', sa.LargeBinary(), nullable=True),
+    sa.Column('offsets', sa.LargeBinary(), nullable=True),
+    sa.ForeignKeyConstraint(['route_id'], ['route.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('route_id', 'zoom')
+    )
+
+
+def downgrade():
+    op.drop_table('route_path')
@@ -91,8 +91,8 @@ class ApiCall(Model):
     # Any error text returned by the API
     error = db.Column(db.String)
 
-    # Where the data came from
-    source = db.Column(db.Enum('Nextbus', name="source", native_enum=False), default='Nextbus')
+    # Where the data came from ('Replay': a capture archive, see capture.py)
+    source = db.Column(db.Enum('Nextbus', 'Replay', name="source", native_enum=False), default='Nextbus')
 
     # When this data was fetched
     time = db.Column(db.DateTime, default=datetime.now)
@@ -132,6 +132,31 @@ class Direction(Model):
         }
 
 
+class Headway(Model):
+    """ A vehicle's current headway behind the vehicle ahead of it (see headways.py). """
+    __tablename__ = "headway"
+    route_id = db.Column(db.Integer, db.ForeignKey('route.id', ondelete="cascade"), primary_key=True)
+    direction_id = db.Column(db.Integer, db.ForeignKey('direction.id', ondelete="cascade"), primary_key=True)
+
+    # vehicle - Bus ID (not always numeric)
+    vehicle = db.Column(db.String, primary_key=True)
+
+    # leader - The vehicle ahead
+    leader = db.Column(db.String)
+
+    # headway - Seconds behind the leader (median over the stops measured)
+    headway = db.Column(db.Integer)
+
+    # stops - Number of stops the headway was measured at
+    stops = db.Column(db.Integer)
+
+    # bunched - Whether the vehicle is too close behind its leader
+    bunched = db.Column(db.Boolean)
+
+    # updated - When this was computed
+    updated = db.Column(db.DateTime)
+
+
 class Prediction(Model):
     """ A vehicle arrival prediction """
     __tablename__ = "prediction"
@@ -145,7 +170,7 @@ class Prediction(Model):
     prediction = db.Column(db.DateTime)
 
     # created - when the prediction was made
-    created = db.Column(db.DateTime, default=datetime.now)
+    created = db.Column(db.DateTime, default=datetime.now, index=True)
 
     # is_departure - whether this is the time when the vehicle will depart
     is_departure = db.Column(db.Boolean)
@@ -184,6 +209,22 @@ class Prediction(Model):
         }
 
 
+class PredictionError(Model):
+    """ A histogram bin of prediction errors, from `manage.py analytics`. """
+    __tablename__ = "prediction_error"
+    route_id = db.Column(db.Integer, db.ForeignKey('route.id', ondelete="cascade"), primary_key=True)
+    stop_id = db.Column(db.Integer, db.ForeignKey('stop.id', ondelete="cascade"), primary_key=True)
+
+    # lead - How far ahead the predictions were made (bucket lower bound, minutes)
+    lead = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # error - Actual minus predicted arrival (bin lower bound, seconds)
+    error = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # count - Number of predictions in this bin
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Region(Model):
     """ A geographic region """
     __tablename__ = "region"
@@ -236,6 +277,9 @@ class Route(Model):
     # lon_max - route extent east
     lon_max = db.Column(db.Float)
 
+    # fingerprint - Hash of the routeConfig this route was saved from
+    fingerprint = db.Column(db.String)
+
     # directions - "Eastbound" / "Westbound", "Inbound" / "Outbound".
     directions = db.relationship("Direction", backref="route", lazy="joined")
 
@@ -245,10 +289,11 @@ class Route(Model):
     # vehicleLocations - Locations of vehicles on this route.
     vehicle_locations = db.relationship("VehicleLocation", backref=backref("route"))
 
-    # paths - Path segments which this route consists of
-    # TODO: implement paths
+    # paths - Path segments which this route consists of, per zoom level.
     # Nextbus's paths are illustrative only and are said to be unreliable for
-    #  .. chaining into a full route path. Leaving this out for now.
+    #  .. chaining into a full route path, so they are kept as separate lines.
+    paths = db.relationship("RoutePath", backref="route", cascade="all, delete-orphan",
+                            passive_deletes=True)
 
     # API Request which was used to retrieve this data
     api_call_id = db.Column(db.Integer, db.ForeignKey('api_call.id', ondelete="set null"))
@@ -272,6 +317,18 @@ class Route(Model):
             'stops': list(self.stops.keys()),
         }
 
+class RoutePath(Model):
+    """ A route's paths, simplified for one zoom level (see paths.py). """
+    __tablename__ = "route_path"
+    route_id = db.Column(db.Integer, db.ForeignKey('route.id', ondelete="cascade"), primary_key=True)
+    zoom = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # points - int32 lat, lon pairs in 1e-5 degrees, all paths one after another
+    points = db.Column(db.LargeBinary)
+
+    # offsets - int32 index of each path's first point
+    offsets = db.Column(db.LargeBinary)
+
 class RouteStop(Model):
     """ Association Object for Stop.routes / Route.stops. A simple many-to-many association
         table would not suffice, because we also need to track which Stop Tag is used by this
@@ -394,6 +451,9 @@ class Stop(Model):
 class VehicleLocation(Model):
     """ A vehicle geolocation for a specific time. """
     __tablename__ = "vehicle_location"
+    __table_args__ = (
+        db.Index('ix_vehicle_location_vehicle_time', 'vehicle', 'time'),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     # vehicle - Bus ID (not always numeric)
@@ -413,7 +473,7 @@ class VehicleLocation(Model):
     lon = db.Column(db.Float)
 
     # When this location was recorded
-    time = db.Column(db.DateTime, default=datetime.now)
+    time = db.Column(db.DateTime, default=datetime.now, index=True)
 
     # Whether this vehicle is currently "predictable"
     predictable = db.Column(db.Boolean)
@@ -441,6 +501,13 @@ class VehicleLocation(Model):
         }
 
 
+class Watermark(Model):
+    """ How far a batch job has processed the history. """
+    __tablename__ = "watermark"
+    name = db.Column(db.String, primary_key=True)
+    time = db.Column(db.DateTime)
+
+
 # Hybrid properties (can't be defined until relevant classes are defined)
 # Agency boundaries (derived from Route boundaries)
 Agency.lat_min = column_property(db.select([db.func.min(Route.lat_min)])\
@@ -1,14 +1,23 @@
 from requests import get, ConnectionError
 from lxml import etree
+import hashlib
 import json
+import math
 import time
+import metrics
 from datetime import datetime, timedelta
-from models import Agency, ApiCall, Direction, Prediction, Region, Route, RouteStop, Stop, VehicleLocation
+from models import Agency, ApiCall, Direction, Prediction, Region, Route, RoutePath, RouteStop, Stop, VehicleLocation
 from app import app, db
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.orm import joinedload
 from lock import Lock
+from quota import QuotaPlanner
+from capture import Recorder
+from catalog import Catalog
+import stopcache
+import headways
+import paths
+from contextlib import contextmanager, ExitStack
 from concurrent.futures import ThreadPoolExecutor
 from requests_futures.sessions import FuturesSession
 from urllib.parse import urlencode
@@ -21,7 +30,7 @@ class Nextbus():
     API Doc: https://www.nextbus.com/xmlFeedDocs/NextBusXMLFeed.pdf
     """
 
-    api_url = "http://webservices.nextbus.com/service/publicXMLFeed"
+    api_url = app.config['NEXTBUS_API_URL']
 
     api_limits = {                          # As per Nextbus API doc Rev. 1.22, April 4 2013.
         'max_bytes': 2 * 1024**2,           # 2MB
@@ -33,6 +42,16 @@ class Nextbus():
         'max_concurrent_requests': 50,
     }
 
+    # Per-agency datasets, in the order their locks must be acquired.
+    lock_order = ['routes', 'vehicle_locations', 'predictions']
+
+    _quota = None
+    _recorder = None
+    _catalog = None
+    # agency tag -> (time loaded, _predictions_per_stop() result)
+    _stop_history = {}
+    stop_history_refresh_seconds = 5 * 60
+
     def _xml_to_tree(xml_string):
         """
         Convert an XML string to a navigable tree.
@@ -43,32 +62,105 @@ class Nextbus():
             raise(NextbusException("Unparseable XML received.\n{0}".format(xml_string)))
         return etree.ElementTree(xmlroot)
 
+    @classmethod
+    @contextmanager
+    def locks(cls, agency_tags, shared=(), exclusive=()):
+        """
+        Lock datasets (see lock_order) for some agencies, plus a shared lock on
+        the agency list. Each agency's datasets are locked separately, so work
+        on one agency never waits for another. Locks are always taken in the
+        same order (by dataset, then by agency tag) so callers can't deadlock.
+        """
+        wanted = [(dataset, True) for dataset in shared] + \
+                 [(dataset, False) for dataset in exclusive]
+        locks = sorted((cls.lock_order.index(dataset), agency_tag, is_shared)
+                       for dataset, is_shared in wanted
+                       for agency_tag in set(agency_tags))
+        with ExitStack() as stack:
+            stack.enter_context(Lock("agencies", shared=True))
+            for rank, agency_tag, is_shared in locks:
+                key = "{0}:{1}".format(cls.lock_order[rank], agency_tag)
+                stack.enter_context(Lock(key, shared=is_shared))
+            yield
+
+    @staticmethod
+    def _count_response(params, response, elapsed):
+        """
+        Record metrics for one response (None for a connection error).
+        """
+        if not metrics.enabled():
+            return
+        labels = {'agency': params.get('a', ''), 'command': params.get('command')}
+        metrics.inc('busmap_requests_total', **labels)
+        metrics.observe('busmap_fetch', elapsed, **labels)
+        if response is None:
+            metrics.inc('busmap_errors_total', kind='connection', **labels)
+            return
+        metrics.inc('busmap_fetch_bytes_total', QuotaPlanner.response_size(response), **labels)
+        if response.status_code != 200:
+            metrics.inc('busmap_errors_total', kind='http', **labels)
+
+    @classmethod
+    def quota(cls):
+        """
+        Get the QuotaPlanner which budgets our requests.
+        """
+        if cls._quota is None:
+            cls._quota = QuotaPlanner(cls.api_limits['max_bytes'],
+                                      cls.api_limits['max_bytes_timeframe_seconds'])
+        return cls._quota
+
+    @classmethod
+    def catalog(cls):
+        """
+        Get this process's Catalog of route, stop and direction ids.
+        """
+        if cls._catalog is None:
+            cls._catalog = Catalog()
+        return cls._catalog
+
+    @classmethod
+    def recorder(cls):
+        """
+        Get the Recorder which captures responses, if CAPTURE_DIR is set.
+        """
+        if cls._recorder is None and app.config.get('CAPTURE_DIR'):
+            cls._recorder = Recorder(app.config['CAPTURE_DIR'])
+        return cls._recorder
+
     @classmethod
     def request(cls, params, tagName):
         """
         Perform an API request specified by params
         and return all elements called tagName (or None, for a failed request)
         """
-        if cls.remaining_quota() <= 0:
+        reservation = cls.quota().reserve(params)
+        if reservation is None:
             raise(NextbusQuotaException(
                 "Over Quota ({0}MB per {1} seconds). Try again later."\
                 .format(cls.api_limits['max_bytes']/1024**2,
                     cls.api_limits['max_bytes_timeframe_seconds'])))
         error = None
         response = None
+        sent = time.time()
         try:
             response = get(cls.api_url, params)
         except ConnectionError:
             pass
+        if cls.recorder():
+            cls.recorder().record(sent, params, tagName, response, sent)
+        cls.quota().settle(reservation, QuotaPlanner.response_size(response))
+        cls._count_response(params, response, time.time() - sent)
         if response and response.status_code == 200:
-            tree = cls._xml_to_tree(response.content)
+            with metrics.timer('busmap_parse', agency=params.get('a', ''),
+                               command=params.get('command')):
+                tree = cls._xml_to_tree(response.content)
             error = tree.find('Error')
         # Log the request
         api_call = ApiCall(
             url = cls.api_url if response else None,
             params = params,
-            size = response.headers['content-length']
-                if (response and 'content-length' in response.headers) else 0,
+            size = QuotaPlanner.response_size(response),
             status = response.status_code if response else 0,
             error = error.text if error else None if response else "Connection Error",
             source = 'Nextbus'
@@ -91,37 +183,92 @@ class Nextbus():
         """
         Perform API requests asynchrously.
         requests is a list of (params, tagName) tuples.
+        Requests are sent in priority order, each once the quota planner
+        has budget for it. All of a command's requests share one deadline
+        (its QUOTA_MAX_DEFER from the start of the batch), and once one of a
+        priority's requests misses it, the rest of that priority aren't
+        tried. Those requests are deferred to a later cycle, and left out of
+        the results.
+        """
+        return cls.parse_responses(cls.fetch(requests))
+
+    @classmethod
+    def fetch(cls, requests):
+        """
+        The network half of async_request: send requests in parallel and wait
+        for the responses. Returns a list of (params, tagName, response)
+        tuples; response is None for connection errors.
         """
         fs = FuturesSession(max_workers=cls.api_limits['max_concurrent_requests'])
+        planner = cls.quota()
+        recorder = cls.recorder()
+        batch = time.time()
         futures = []
+        missed = set()
         # Start parallel requests
-        for (params, tagName) in requests:
+        for (params, tagName) in sorted(requests, key=lambda r: planner.priority(r[0])):
+            priority = planner.priority(params)
+            reservation = None
+            if priority not in missed:
+                deadline = batch + planner.max_defer(params)
+                reservation = planner.reserve(params, max(deadline - time.time(), 0))
+            if reservation is None:
+                missed.add(priority)
+                metrics.inc('busmap_requests_deferred_total', agency=params.get('a', ''),
+                            command=params.get('command'))
+                continue
             url = "{0}?{1}".format(cls.api_url,
                                   urlencode(params, doseq=True))
-            futures.append((fs.get(url), params))
-        # Handle results as they are available
+            futures.append((fs.get(url), params, tagName, reservation, time.time()))
+        fetched = []
+        for (f, params, tagName, reservation, sent) in futures:
+            # These are blocking, so will stop if one isnt available yet. Poop.
+            try:
+                response = f.result()
+            except ConnectionError:
+                response = None
+            planner.settle(reservation, QuotaPlanner.response_size(response))
+            cls._count_response(params, response, response.elapsed.total_seconds()
+                                if response is not None else time.time() - sent)
+            if recorder:
+                recorder.record(batch, params, tagName, response, sent)
+            fetched.append((params, tagName, response))
+        if metrics.enabled():
+            metrics.gauge('busmap_quota_remaining_bytes', planner.remaining())
+        return fetched
+
+    @classmethod
+    def parse_responses(cls, fetched, source='Nextbus'):
+        """
+        The parsing half of async_request: parse responses from fetch() and
+        log them as ApiCalls. Returns a list of (elements, api_call) tuples,
+        where elements is None for a failed request.
+        source = the ApiCalls' source; 'Replay' for captured responses, which
+                 don't count against the quota.
+        """
         results = []
         db.session.begin(nested=True)
-        for (f, params) in futures:
-            # These are blocking, so will stop if one isnt available yet. Poop.
+        for (params, tagName, response) in fetched:
             error = None
-            response = f.result()
             if response and response.status_code == 200:
-                tree = cls._xml_to_tree(response.content)
+                with metrics.timer('busmap_parse', agency=params.get('a', ''),
+                                   command=params.get('command')):
+                    tree = cls._xml_to_tree(response.content)
                 error = tree.find('Error')
             # Log the request
             api_call = ApiCall(
                 url = cls.api_url,
                 params = params,
-                size = response.headers['content-length']
-                    if (response and 'content-length' in response.headers) else None,
+                size = QuotaPlanner.response_size(response),
                 status = response.status_code if response else None,
                 error = error.text if error is not None else None if response else "Connection Error",
-                source = 'Nextbus'
+                source = source
             )
             db.session.add(api_call)
             # Handle API error
             if error is not None:
+                metrics.inc('busmap_errors_total', kind='api', agency=params.get('a', ''),
+                            command=params.get('command'))
                 should_retry = error.get('shouldRetry')
                 if should_retry == False:
                     # This is a permanent error, so we are probably doing something wrong.
@@ -146,7 +293,7 @@ class Nextbus():
                         db.func.coalesce(
                             db.func.sum(ApiCall.size),
                             0)
-                    ).filter(ApiCall.time >= time_begin).one()[0]
+                    ).filter(ApiCall.time >= time_begin, ApiCall.source == 'Nextbus').one()[0]
         # Return zero if we've gone over-quota (negative quota makes no sense)
         return max(bytes_allowed - bytes_used, 0)
 
@@ -177,6 +324,9 @@ class Nextbus():
                     api_call = api_call)
                 agencies.append(a)
             db.session.commit()
+            if truncate:
+                # Deleting agencies deleted their routes too.
+                Catalog.bump()
             return agencies
 
     @classmethod
@@ -187,112 +337,206 @@ class Nextbus():
         routeConfig is needed to get full details about a route,
         but can only show 100 routes at a time. So, use routeList
         to get a list, then batch the first 100 and piecemeal the rest.
+
+        The import runs in two phases, so live ingest isn't held up by it:
+        1. Fetch and validate every routeConfig, without any dataset locks.
+        2. Lock the agency's datasets and apply the changes in one short
+           transaction (see apply_routes). Until it commits, readers and
+           ingest keep using the routes as they were.
+        Stops are shared between agencies (see Stop.get_or_create), so the
+        transaction also holds a global "stops" lock: imports of different
+        agencies may run at once, but their stop upserts must not interleave.
+        It is always taken last, after the agency's locks.
         """
-        with Lock("agencies", shared=True), Lock("routes"), Lock("vehicle_locations"), Lock("predictions"):
-            def save_route(route_xml, api_call):
-                def save_directions(route_xml, route_obj, api_call):
-                    directions = route_xml.findall('direction')
-                    for direction in directions:
-                        d =  Direction.get_or_create(db.session,
-                            tag = direction.get('tag'),
-                            title = direction.get('title'),
-                            name = direction.get('name'),
-                            route_id = route_obj.id,
-                            api_call_id = api_call.id)
-                def save_stops(route_xml, route_obj, api_call):
-                    stops = route_xml.findall('stop')
-                    for stop in stops:
-                        s =  Stop.get_or_create(db.session,
-                            title = stop.get('title'),
-                            lat = float(stop.get('lat')),
-                            lon = float(stop.get('lon')),
-                            stop_id = stop.get('stopId'),
-                            api_call_id = api_call.id)
-                        db.session.flush()
-                        rs = RouteStop.get_or_create(db.session,
-                            route_id = route_obj.id,
-                            stop_id = s.id,
-                            stop_tag = stop.get('tag'))
-                r = Route.get_or_create(db.session,
-                    tag = route_xml.get('tag'),
-                    title = route_xml.get('title'),
-                    color = route_xml.get('color'),
-                    opposite_color = route_xml.get('oppositeColor'),
-                    lat_min = float(route_xml.get('latMin')),
-                    lat_max = float(route_xml.get('latMax')),
-                    lon_min = float(route_xml.get('lonMin')),
-                    lon_max = float(route_xml.get('lonMax')),
-                    agency_id = agency.id,
-                    api_call = api_call)
-                db.session.flush()
-                save_directions(route_xml, r, api_call)
-                save_stops(route_xml, r, api_call)
-                db.session.flush()
-                return r
+        with Lock("route_import:{0}".format(agency_tag), expires=10*60, timeout=10*60):
+            fetched = cls.fetch_routes(agency_tag)
+            if fetched is None:
+                return []
+            listed, configs = fetched
+            with cls.locks([agency_tag],
+                    exclusive=('routes', 'vehicle_locations', 'predictions')):
+                with Lock("stops", expires=10*60, timeout=10*60):
+                    return cls.apply_routes(agency_tag, listed, configs, truncate)
 
-            # Get list of routes
-            request_params = {
-                'command': 'routeList',
-                'a': agency_tag
-            }
-            routelist_xml, routelist_api_call = cls.request(request_params, 'route')
+    @classmethod
+    def fetch_routes(cls, agency_tag):
+        """
+        Fetch an agency's route list and the routeConfig of every route on it.
+        Returns (listed route tags, {route tag: (route element, api call)})
+        or None if the route list couldn't be fetched. Routes whose
+        routeConfig failed or is invalid are left out of the dict.
+        """
+        request_params = {
+            'command': 'routeList',
+            'a': agency_tag
+        }
+        routelist_xml, routelist_api_call = cls.request(request_params, 'route')
+        if not routelist_xml:
+            return None
+        listed = set(route.get('tag') for route in routelist_xml)
+        configs = {}
 
-            if not routelist_xml:
-                return []
+        # Batch-import as many as Nextbus allows (100)
+        request_params = {
+            'command': 'routeConfig',
+            'a': agency_tag,
+        }
+        rc_xml, rc_api_call = cls.request(request_params, 'route')
+        for route in rc_xml or []:
+            configs[route.get('tag')] = (route, rc_api_call)
 
-            db.session.begin()
-            ### TODO: This transaction stays open too long! Can we shortedn it?
-            agency = db.session.query(Agency).filter_by(tag=agency_tag).one()
-            if truncate:
-                db.session.query(Route).filter_by(agency_id=agency.id).delete()
+        # Do the rest one-by-one
+        requests = []
+        for route_tag in listed:
+            if route_tag not in configs:
+                request_params = {
+                    'command': 'routeConfig',
+                    'a': agency_tag,
+                    'route': route_tag
+                }
+                requests.append((request_params, 'route'))
+        db.session.begin()
+        responses = cls.async_request(requests)
+        db.session.commit()
+        for rc_xml, rc_api_call in responses:
+            if rc_xml:
+                configs[rc_xml[0].get('tag')] = (rc_xml[0], rc_api_call)
+        return listed, {tag: c for tag, c in configs.items()
+                        if tag in listed and cls._valid_route(c[0])}
 
-            # Batch-import as many as Nextbus allows (100)
-            request_params = {
-                'command': 'routeConfig',
-                'a': agency.tag,
-            }
-            rc_xml, rc_api_call = cls.request(request_params, 'route')
-
-            routes = []
-            for route in rc_xml:
-                r = save_route(route, rc_api_call)
-                routes.append(r)
-
-            # Do the rest one-by-one
-            requests = []
-            for route in routelist_xml:
-                route_tag = route.get('tag')
-                if route_tag not in [r.tag for r in routes]:
-                    request_params = {
-                        'command': 'routeConfig',
-                        'a': agency.tag,
-                        'route': route_tag
-                    }
-                    requests.append((request_params, 'route'))
-            responses = cls.async_request(requests)
-            for rc_xml, rc_api_call in responses:
-                r = save_route(rc_xml[0], rc_api_call)
-                routes.append(r)
-            db.session.commit()
-            return routes
+    @staticmethod
+    def _valid_route(route_xml):
+        """
+        Check that a routeConfig element has everything we save.
+        """
+        try:
+            for attr in ('latMin', 'latMax', 'lonMin', 'lonMax'):
+                float(route_xml.get(attr))
+            stops = route_xml.findall('stop')
+            for stop in stops:
+                float(stop.get('lat'))
+                float(stop.get('lon'))
+                if not stop.get('tag'):
+                    return False
+        except (TypeError, ValueError):
+            return False
+        return bool(stops) and all(d.get('tag') for d in route_xml.findall('direction'))
+
+    @classmethod
+    def apply_routes(cls, agency_tag, listed, configs, truncate=False):
+        """
+        Bring an agency's stored routes in line with fetch_routes() results,
+        in one transaction.
+        Each route's routeConfig is fingerprinted, and only new and changed
+        routes are saved; unchanged ones (and their predictions and vehicle
+        locations) are left alone, apart from getting their paths if they
+        have none. Routes no longer in routeList are deleted.
+        truncate = delete and re-import all of the agency's routes anyway.
+        """
+        def save_route(route_xml, api_call):
+            def save_directions(route_xml, route_obj, api_call):
+                directions = route_xml.findall('direction')
+                for direction in directions:
+                    d =  Direction.get_or_create(db.session,
+                        tag = direction.get('tag'),
+                        title = direction.get('title'),
+                        name = direction.get('name'),
+                        route_id = route_obj.id,
+                        api_call_id = api_call.id)
+            def save_stops(route_xml, route_obj, api_call):
+                stops = route_xml.findall('stop')
+                for stop in stops:
+                    s =  Stop.get_or_create(db.session,
+                        title = stop.get('title'),
+                        lat = float(stop.get('lat')),
+                        lon = float(stop.get('lon')),
+                        stop_id = stop.get('stopId'),
+                        api_call_id = api_call.id)
+                    db.session.flush()
+                    rs = RouteStop.get_or_create(db.session,
+                        route_id = route_obj.id,
+                        stop_id = s.id,
+                        stop_tag = stop.get('tag'))
+            r = Route.get_or_create(db.session,
+                fingerprint = cls._route_fingerprint(route_xml),
+                tag = route_xml.get('tag'),
+                title = route_xml.get('title'),
+                color = route_xml.get('color'),
+                opposite_color = route_xml.get('oppositeColor'),
+                lat_min = float(route_xml.get('latMin')),
+                lat_max = float(route_xml.get('latMax')),
+                lon_min = float(route_xml.get('lonMin')),
+                lon_max = float(route_xml.get('lonMax')),
+                agency_id = agency.id,
+                api_call = api_call)
+            db.session.flush()
+            save_directions(route_xml, r, api_call)
+            save_stops(route_xml, r, api_call)
+            save_paths(route_xml, r)
+            db.session.flush()
+            return r
+
+        def save_paths(route_xml, route_obj):
+            db.session.execute(RoutePath.__table__.insert(),
+                               paths.rows(route_obj.id, route_xml))
+
+        db.session.begin()
+        agency = db.session.query(Agency).filter_by(tag=agency_tag).one()
+        if truncate:
+            db.session.query(Route).filter_by(agency_id=agency.id).delete()
+        stored = {r.tag: r for r in db.session.query(Route).filter_by(agency_id=agency.id)}
+        with_paths = {route_id for (route_id,) in db.session.query(RoutePath.route_id)\
+                          .filter(RoutePath.route_id.in_([r.id for r in stored.values()]))\
+                          .distinct()} if stored else set()
+        routes = {}
+        changed = []
+        for tag, (route_xml, api_call) in configs.items():
+            old = stored.get(tag)
+            if old is not None:
+                if old.fingerprint == cls._route_fingerprint(route_xml):
+                    routes[tag] = old
+                    if old.id not in with_paths:
+                        # Saved before paths were stored.
+                        save_paths(route_xml, old)
+                        changed.append(tag)
+                    continue
+                # A changed route is deleted (with its history) and saved anew.
+                db.session.query(Route).filter_by(id=old.id)\
+                    .delete(synchronize_session=False)
+                db.session.expunge(old)
+            routes[tag] = save_route(route_xml, api_call)
+            changed.append(tag)
+
+        # Delete routes which Nextbus no longer lists. (Routes whose
+        # routeConfig failed this time are kept as they are.)
+        removed = [r.id for tag, r in stored.items() if tag not in listed]
+        if removed:
+            db.session.query(Route).filter(Route.id.in_(removed))\
+                .delete(synchronize_session=False)
+        db.session.commit()
+        if truncate or changed or removed:
+            Catalog.bump(agency_tag)
+        return list(routes.values())
+
+    @staticmethod
+    def _route_fingerprint(route_xml):
+        """
+        Hash of a route's routeConfig element, to tell whether it changed.
+        """
+        return hashlib.sha1(etree.tostring(route_xml, method='c14n')).hexdigest()
 
     @classmethod
     def get_predictions(cls, agency_tags, truncate=True):
         """
         Get vehicle arrival predictions
-        request parameter 'stops' is actually a list of "route|stop" pairs
         """
         if not agency_tags:
             return []
-        with Lock("agencies", shared=True), Lock("routes", shared=True), Lock("predictions"):
+        with cls.locks(agency_tags, shared=('routes',), exclusive=('predictions',)):
             db.session.begin()
-            routes = db.session.query(Route).join(Agency)\
-                .options(joinedload(Route.stops),
-                    joinedload(Route.directions))\
-                .filter(Agency.tag.in_(agency_tags)).all()
+            routes = cls.prediction_routes(agency_tags)
             if not routes:
                 return []
-            routes = {(r.agency.tag, r.tag): r for r in routes}
             if truncate:
                 db.session.query(Prediction)\
                     .filter(
@@ -301,69 +545,208 @@ class Nextbus():
                         ))\
                     .delete(synchronize_session=False)
                 db.session.expire_all()
-            all_stops = {}
-            for (a_tag, r_tag) in routes:
-                route = routes[(a_tag, r_tag)]
-                for s in route.stops:
-                    if a_tag not in all_stops:
-                        all_stops[a_tag] = []
-                    all_stops[a_tag].append("{0}|{1}".format(route.tag, route.stops[s].stop_tag))
-            requests = []
-            predictions = []
-            # Break this up by agency, since agency tag is a request param.
-            for agency_tag in all_stops:
-                # Further break the request into batches to comply with API limits
-                stops_per_request = cls.api_limits['predictions_max_stops']
-                batches = [all_stops[agency_tag][x:x+stops_per_request]
-                    for x in range(0, len(all_stops[agency_tag]), stops_per_request)]
-                for stops in batches:
-                    request_params = {
-                        'command': 'predictionsForMultiStops',
-                        'a': agency_tag,
-                        'stops': stops
-                    }
-                    requests.append((request_params, 'predictions'))
+            requests = cls.prediction_requests(routes)
             responses = cls.async_request(requests)
-            for prediction_sets, api_call in responses:
-                if not prediction_sets:
-                    continue
-                agency_tag = api_call.params['a']
-                for prediction_set in prediction_sets:
-                    route_tag = prediction_set.get('routeTag')
-                    route = routes[(agency_tag, route_tag)]
-                    if not route:
-                        # Sometimes this happens. Skip this one, to avoid an exception.
-                        continue
-                    stop_tag = prediction_set.get('stopTag')
-                    try:
-                        stop = route.stops[stop_tag].stop
-                    except KeyError:
-                        raise(NextbusException("Non-existent stop '{0}' for agency '{1}' route '{2}'"\
-                            .format(stop_tag, route.agency.tag, route.tag)))
-                    for direction in prediction_set.findall('direction'):
-                        xml_predictions = direction.findall('prediction')
-                        for prediction in xml_predictions:
-                            # Try to identify the Direction. Use "None" if Nextbus gave an invalid one (happens)
-                            direction = next((d for d in route.directions if d.tag == prediction.get('dirTag')), None)
-                            # Nextbus gives epoch with msecs; divide by 1k and convert
-                            predicted_seconds = int(prediction.get('epochTime'))/1000
-                            predicted_time = datetime.fromtimestamp(predicted_seconds)
-                            # create the prediction
-                            p_params = {'route_id': route.id,
-                                'stop_id': stop.id,
-                                'prediction': predicted_time,
-                                'is_departure': prediction.get('isDeparture'),
-                                'has_layover': prediction.get('affectedByLayover'),
-                                'direction_id': direction.id if direction else None,
-                                'vehicle': prediction.get('vehicle'),
-                                'block': prediction.get('block'),
-                                'api_call_id': api_call.id}
-                            predictions.append(p_params)
+            predictions = cls.prediction_rows(routes, responses)
+            fetched = cls.fetched_stops(routes, responses)
             db.session.commit()
+            cls.insert_rows(Prediction, predictions)
+            cls.publish_predictions(routes, predictions, fetched)
+            return predictions
+
+    @classmethod
+    def prediction_routes(cls, agency_tags):
+        """
+        Get the routes which we get predictions for, as a dict of
+        (agency tag, route tag) -> CatalogRoute.
+        """
+        return cls.catalog().routes(agency_tags)
+
+    @classmethod
+    def prediction_requests(cls, routes):
+        """
+        Build the predictionsForMultiStops requests for some routes.
+        request parameter 'stops' is actually a list of "route|stop" pairs
+        """
+        # Collect unique "route|stop" pairs per agency, with the stop's
+        # (route id, stop id) so we can look up its history.
+        all_stops = {}
+        for (a_tag, r_tag) in routes:
+            route = routes[(a_tag, r_tag)]
+            for stop_tag, stop_id in route.stops.items():
+                pair = "{0}|{1}".format(route.tag, stop_tag)
+                all_stops.setdefault(a_tag, {})[pair] = (route.id, stop_id)
+        requests = []
+        # Break this up by agency, since agency tag is a request param.
+        for agency_tag in all_stops:
+            # Further break the request into batches to comply with API limits
+            for stops in cls._pack_stops(agency_tag, all_stops[agency_tag]):
+                request_params = {
+                    'command': 'predictionsForMultiStops',
+                    'a': agency_tag,
+                    'stops': stops
+                }
+                requests.append((request_params, 'predictions'))
+        return requests
+
+    @classmethod
+    @metrics.timed('busmap_build_rows', command='predictionsForMultiStops')
+    def prediction_rows(cls, routes, responses):
+        """
+        Turn predictionsForMultiStops responses into Prediction rows (dicts).
+        """
+        predictions = []
+        for prediction_sets, api_call in responses:
+            if not prediction_sets:
+                continue
+            agency_tag = api_call.params['a']
+            count = len(predictions)
+            for prediction_set in prediction_sets:
+                route_tag = prediction_set.get('routeTag')
+                route = routes.get((agency_tag, route_tag))
+                if not route:
+                    # Sometimes this happens. Skip this one, to avoid an exception.
+                    continue
+                stop_tag = prediction_set.get('stopTag')
+                try:
+                    stop_id = route.stops[stop_tag]
+                except KeyError:
+                    raise(NextbusException("Non-existent stop '{0}' for agency '{1}' route '{2}'"\
+                        .format(stop_tag, agency_tag, route.tag)))
+                for direction in prediction_set.findall('direction'):
+                    xml_predictions = direction.findall('prediction')
+                    for prediction in xml_predictions:
+                        # Try to identify the Direction. Use "None" if Nextbus gave an invalid one (happens)
+                        direction_id = route.directions.get(prediction.get('dirTag'))
+                        # Nextbus gives epoch with msecs; divide by 1k and convert
+                        predicted_seconds = int(prediction.get('epochTime'))/1000
+                        predicted_time = datetime.fromtimestamp(predicted_seconds)
+                        # create the prediction
+                        p_params = {'route_id': route.id,
+                            'stop_id': stop_id,
+                            'prediction': predicted_time,
+                            'is_departure': prediction.get('isDeparture'),
+                            'has_layover': prediction.get('affectedByLayover'),
+                            'direction_id': direction_id,
+                            'vehicle': prediction.get('vehicle'),
+                            'block': prediction.get('block'),
+                            'api_call_id': api_call.id}
+                        predictions.append(p_params)
+            metrics.inc('busmap_rows_total', len(predictions) - count, agency=agency_tag,
+                        command='predictionsForMultiStops')
+        return predictions
+
+    @classmethod
+    def fetched_stops(cls, routes, responses):
+        """
+        Ids of the stops in predictionsForMultiStops requests which got a
+        response (with or without predictions).
+        """
+        fetched = set()
+        for prediction_sets, api_call in responses:
+            if prediction_sets is None:
+                continue
+            agency_tag = api_call.params['a']
+            for pair in api_call.params['stops']:
+                route_tag, stop_tag = pair.split("|", 1)
+                route = routes.get((agency_tag, route_tag))
+                if route and stop_tag in route.stops:
+                    fetched.add(route.stops[stop_tag])
+        return fetched
+
+    @classmethod
+    def insert_rows(cls, model, rows):
+        """
+        Bulk-insert rows (dicts) into a model's table.
+        """
+        if not rows:
+            return
+        with metrics.timer('busmap_insert', table=model.__tablename__):
             db.session.begin()
-            db.engine.execute(Prediction.__table__.insert(), predictions)
+            db.engine.execute(model.__table__.insert(), rows)
             db.session.commit()
-            return predictions
+        metrics.inc('busmap_rows_written_total', len(rows), table=model.__tablename__)
+
+    @classmethod
+    def publish_predictions(cls, routes, rows, fetched):
+        """
+        Update what's derived from a cycle's Prediction rows (once they are
+        stored): the per-stop cache and the headways.
+        fetched = ids of the stops which got a response (see fetched_stops()).
+        """
+        stopcache.publish(routes, rows, fetched)
+        headways.update(routes, rows)
+
+    @classmethod
+    def _predictions_per_stop(cls, agency_tag, route_ids):
+        """
+        Average number of predictions per response, for each (route id, stop id)
+        of an agency's routes, over its recent predictions (PREDICTIONS_MAX_AGE).
+        Cached for stop_history_refresh_seconds.
+        """
+        cached = cls._stop_history.get(agency_tag)
+        if cached and time.time() - cached[0] < cls.stop_history_refresh_seconds:
+            return cached[1]
+        since = datetime.now() - timedelta(seconds=app.config['PREDICTIONS_MAX_AGE'])
+        rows = db.session.query(Prediction.route_id, Prediction.stop_id,
+                    db.func.count(Prediction.id),
+                    db.func.count(db.distinct(Prediction.api_call_id)))\
+                .filter(Prediction.route_id.in_(route_ids), Prediction.created >= since)\
+                .group_by(Prediction.route_id, Prediction.stop_id).all() if route_ids else []
+        history = {(route_id, stop_id): count / max(calls, 1)
+                   for route_id, stop_id, count, calls in rows}
+        cls._stop_history[agency_tag] = (time.time(), history)
+        return history
+
+    @classmethod
+    def _pack_stops(cls, agency_tag, stops):
+        """
+        Split an agency's stops into predictionsForMultiStops batches.
+        stops is a dict of "route|stop" pair -> (route id, stop id).
+
+        Each stop's response size is estimated from how many predictions it
+        usually gets, calibrated against the quota planner's bytes-per-stop.
+        Stops are then spread over as few batches as the stop count, URL
+        length and byte size caps allow, biggest first, each going to the
+        lightest batch. This keeps batches about equally heavy, so the
+        parallel requests finish at about the same time.
+        """
+        max_stops = cls.api_limits['predictions_max_stops']
+        max_bytes = app.config['PREDICTIONS_BATCH_MAX_BYTES']
+        # The URL also has the API base, command and agency (see fetch()).
+        prefix = "{0}?{1}".format(cls.api_url, urlencode(
+            {'command': 'predictionsForMultiStops', 'a': agency_tag}))
+        max_url = max(app.config['PREDICTIONS_BATCH_MAX_URL_LENGTH'] - len(prefix), 1)
+        # Estimate bytes per stop: a fixed cost per <predictions> element,
+        # plus a cost per prediction which matches the planner's average.
+        history = cls._predictions_per_stop(agency_tag,
+                                            sorted({ids[0] for ids in stops.values()}))
+        mean_count = sum(history.values()) / len(history) if history else 0
+        per_stop = cls.quota().estimate({'command': 'predictionsForMultiStops',
+                                         'a': agency_tag, 'stops': [None]})
+        base = min(per_stop, 300)
+        per_prediction = (per_stop - base) / mean_count if mean_count else 0
+        weights = {pair: base + per_prediction * history.get(ids, mean_count)
+                   for pair, ids in stops.items()}
+        url_lengths = {pair: len(urlencode({'stops': pair})) + 1 for pair in stops}
+        # At least this many batches are needed to satisfy every cap.
+        count = max(math.ceil(len(stops) / max_stops),
+                    math.ceil(sum(weights.values()) / max_bytes),
+                    math.ceil(sum(url_lengths.values()) / max_url), 1)
+        batches = [[[], 0, 0] for i in range(count)] # [pairs, bytes, url length]
+        for pair in sorted(stops, key=lambda p: weights[p], reverse=True):
+            # A stop heavier than the byte cap on its own gets a batch to itself.
+            fits = [b for b in batches
+                    if len(b[0]) < max_stops and b[2] + url_lengths[pair] <= max_url
+                    and (not b[0] or b[1] + weights[pair] <= max_bytes)]
+            if not fits:
+                fits = [[[], 0, 0]]
+                batches.append(fits[0])
+            batch = min(fits, key=lambda b: b[1])
+            batch[0].append(pair)
+            batch[1] += weights[pair]
+            batch[2] += url_lengths[pair]
+        return [b[0] for b in batches if b[0]]
 
     @classmethod
     def get_vehicle_locations(cls, agency_tags, truncate=True):
@@ -372,73 +755,145 @@ class Nextbus():
         """
         if not agency_tags:
             return []
-        with Lock("agencies", shared=True), Lock("routes", shared=True), Lock("vehicle_locations"):
+        with cls.locks(agency_tags, shared=('routes',), exclusive=('vehicle_locations',)):
             db.session.begin()
-            routes = db.session.query(Route).join(Agency)\
-                .options(joinedload('directions'))\
-                .filter(Agency.tag.in_(agency_tags)).all()
+            routes = cls.vehicle_routes(agency_tags)
             if not routes:
                 return []
-            most_recent = db.session.query(VehicleLocation.route_id,
-                            db.func.max(ApiCall.time))\
-                    .join(ApiCall)\
-                    .filter(
-                        VehicleLocation.route_id.in_([r.id for r in routes]))\
-                    .group_by(VehicleLocation.route_id).all()
-            last_time = {}
-            for route_id, mr_time in most_recent:
-                last_time[route_id] = mr_time
-            requests = []
-            for route in routes:
-                t = last_time[route.id].timestamp() if route.id in last_time else 0
-                request_params = {
-                    'command': 'vehicleLocations',
-                    'a': route.agency.tag,
-                    'r': route.tag,
-                    't': int(t)
-                }
-                requests.append((request_params, 'vehicle'))
+            requests = cls.vehicle_requests(routes)
             responses = cls.async_request(requests)
-            vehicle_locations = []
-            for (vehicles, api_call) in responses:
-                if not vehicles:
-                    continue
-                for vehicle in vehicles:
-                    r_tag = api_call.params['r']
-                    a_tag = api_call.params['a']
-                    route = next((r for r in routes if r.tag == r_tag and r.agency.tag == a_tag), None)
-                    direction = next((d for d in route.directions if d.tag == vehicle.get('dirTag')), None)
-                    # Convert age in seconds to a DateTime
-                    age = timedelta(seconds=int(vehicle.get('secsSinceReport')))
-                    time = datetime.now() - age
-                    # Convert negative heading to None, as per API docs
-                    heading = int(vehicle.get('heading'))
-                    if heading < 0:
-                        heading = None
-                    # Save it all
-                    vl = {'vehicle': vehicle.get('id'),
-                        'route_id': route.id if route else None,
-                        'direction_id': direction.id if direction else None,
-                        'lat': vehicle.get('lat'),
-                        'lon': vehicle.get('lon'),
-                        'time': time,
-                        'predictable': vehicle.get('predictable'),
-                        'heading': heading,
-                        'speed': float(vehicle.get('speedKmHr')),
-                        'api_call_id': api_call.id}
-                    vehicle_locations.append(vl)
-            db.session.commit()
-            db.session.begin()
-            db.engine.execute(VehicleLocation.__table__.insert(), vehicle_locations)
+            vehicle_locations = cls.vehicle_rows(routes, responses)
             db.session.commit()
+            cls.insert_rows(VehicleLocation, vehicle_locations)
             return vehicle_locations
 
+    @classmethod
+    def vehicle_routes(cls, agency_tags):
+        """
+        Get the routes which we get vehicle locations for, as a dict of
+        (agency tag, route tag) -> CatalogRoute.
+        """
+        return cls.catalog().routes(agency_tags)
+
+    @classmethod
+    def vehicle_requests(cls, routes, last_times=None):
+        """
+        Build the vehicleLocations requests for some routes, asking only for
+        what changed since each route's last update (within LOCATIONS_MAX_AGE;
+        older history may be kept for analytics, but isn't needed here).
+        last_times = (agency tag, route tag) -> lastTime of the route's previous
+                     response, where the caller knows it (see
+                     vehicle_last_times()); used instead of the database.
+        """
+        last_times = last_times or {}
+        unknown = [r.id for key, r in routes.items() if key not in last_times]
+        since = datetime.now() - timedelta(seconds=app.config['LOCATIONS_MAX_AGE'])
+        most_recent = db.session.query(VehicleLocation.route_id,
+                        db.func.max(ApiCall.time))\
+                .join(ApiCall)\
+                .filter(
+                    VehicleLocation.route_id.in_(unknown),
+                    VehicleLocation.time >= since,
+                    ApiCall.source == 'Nextbus')\
+                .group_by(VehicleLocation.route_id).all() if unknown else []
+        last_time = {}
+        for route_id, mr_time in most_recent:
+            last_time[route_id] = mr_time
+        requests = []
+        for key, route in routes.items():
+            if key in last_times:
+                t = last_times[key]
+            else:
+                t = last_time[route.id].timestamp() if route.id in last_time else 0
+            request_params = {
+                'command': 'vehicleLocations',
+                'a': route.agency_tag,
+                'r': route.tag,
+                't': int(t)
+            }
+            requests.append((request_params, 'vehicle'))
+        return requests
+
+    @classmethod
+    def vehicle_last_times(cls, fetched):
+        """
+        The lastTime of each vehicleLocations response from fetch(), as
+        (agency tag, route tag) -> lastTime, to ask for only newer reports
+        next time.
+        """
+        last_times = {}
+        for params, tagName, response in fetched:
+            if not response or response.status_code != 200:
+                continue
+            try:
+                last_time = cls._xml_to_tree(response.content).find('lastTime')
+            except NextbusException:
+                # parse_responses() reports it.
+                continue
+            if last_time is not None and last_time.get('time'):
+                last_times[params['a'], params['r']] = int(last_time.get('time'))
+        return last_times
+
+    @classmethod
+    @metrics.timed('busmap_build_rows', command='vehicleLocations')
+    def vehicle_rows(cls, routes, responses):
+        """
+        Turn vehicleLocations responses into VehicleLocation rows (dicts).
+        """
+        vehicle_locations = []
+        for (vehicles, api_call) in responses:
+            if not vehicles:
+                continue
+            route = routes.get((api_call.params['a'], api_call.params['r']))
+            if not route:
+                continue
+            metrics.inc('busmap_rows_total', len(vehicles), agency=api_call.params['a'],
+                        command='vehicleLocations')
+            for vehicle in vehicles:
+                direction_id = route.directions.get(vehicle.get('dirTag'))
+                # Convert age in seconds to a DateTime
+                age = timedelta(seconds=int(vehicle.get('secsSinceReport')))
+                time = datetime.now() - age
+                # Convert negative heading to None, as per API docs
+                heading = int(vehicle.get('heading'))
+                if heading < 0:
+                    heading = None
+                # Save it all
+                vl = {'vehicle': vehicle.get('id'),
+                    'route_id': route.id,
+                    'direction_id': direction_id,
+                    'lat': vehicle.get('lat'),
+                    'lon': vehicle.get('lon'),
+                    'time': time,
+                    'predictable': vehicle.get('predictable'),
+                    'heading': heading,
+                    'speed': float(vehicle.get('speedKmHr')),
+                    'api_call_id': api_call.id}
+                vehicle_locations.append(vl)
+        return vehicle_locations
+
+    @staticmethod
+    def _stale_before(max_age):
+        """
+        Cutoff for deleting stale rows: max_age seconds ago, but with
+        ANALYTICS_ENABLED, not before the analysis is done with them (for at
+        most ANALYTICS_MAX_RETENTION).
+        """
+        now = datetime.now()
+        expire = now - timedelta(seconds=max_age)
+        if app.config['ANALYTICS_ENABLED']:
+            import analytics
+            keep = analytics.retain_since()
+            expire = min(expire, keep) if keep else now - app.config['ANALYTICS_MAX_RETENTION']
+            expire = max(expire, now - app.config['ANALYTICS_MAX_RETENTION'])
+        return expire
+
     @classmethod
     def delete_stale_predictions(cls):
         """
-        Delete predictions older than PREDICTIONS_MAX_AGE.
+        Delete predictions older than PREDICTIONS_MAX_AGE (see _stale_before).
         """
-        expire = datetime.now() - timedelta(seconds=app.config['PREDICTIONS_MAX_AGE'])
+        expire = cls._stale_before(app.config['PREDICTIONS_MAX_AGE'])
         delete = db.session.query(Prediction)\
                     .filter(Prediction.created < expire)\
                     .delete(synchronize_session=False)
@@ -447,9 +902,9 @@ class Nextbus():
     @classmethod
     def delete_stale_vehicle_locations(cls):
         """
-        Delete vehicle locations older than LOCATIONS_MAX_AGE.
+        Delete vehicle locations older than LOCATIONS_MAX_AGE (see _stale_before).
         """
-        expire = datetime.now() - timedelta(seconds=app.config['LOCATIONS_MAX_AGE'])
+        expire = cls._stale_before(app.config['LOCATIONS_MAX_AGE'])
         delete = db.session.query(VehicleLocation)\
                     .filter(VehicleLocation.time < expire)\
                     .delete(synchronize_session=False)
@@ -0,0 +1,144 @@
+"""
+Route path geometry, served as tiles at /paths/<agency>/<z>/<x>/<y>.json.
+
+Each route's routeConfig <path> elements are stored as fixed-point integer
+arrays (1e-5 degrees, interleaved lat, lon), simplified ahead of time for
+each zoom level from PATH_MIN_ZOOM to PATH_MAX_ZOOM (see tracks.simplify).
+A tile request picks the routes whose bounds overlap the tile, takes their
+geometry at the tile's zoom level, keeps the runs of segments which overlap
+the tile, and sends those as encoded polylines. Tiles are cached in Redis
+under the agency's route catalog version, so they are rebuilt after a route
+import, and are cacheable by browsers for PATH_TILE_MAX_AGE seconds.
+
+Tile format:
+    {"routes": {route tag: {"color": "ff0000", "paths": [polyline, ...]}}}
+"""
+import json
+import math
+import numpy as np
+from lock import connection
+from catalog import Catalog
+from app import app, db
+import tracks
+
+SCALE = 1e5
+tile_key_format = "bm-path-tile-{0}-{1}-{2}-{3}-{4}-{5}"
+
+def parse(route_xml):
+    """
+    Get a routeConfig element's paths, as a list of (n, 2) lat, lon arrays.
+    Points which don't parse are left out.
+    """
+    paths = []
+    for path in route_xml.findall('path'):
+        points = []
+        for point in path.findall('point'):
+            try:
+                points.append((float(point.get('lat')), float(point.get('lon'))))
+            except (TypeError, ValueError):
+                continue
+        if len(points) >= 2:
+            paths.append(np.array(points))
+    return paths
+
+def pack(paths):
+    """
+    Pack paths into (points, offsets) bytes: int32 fixed-point lat, lon
+    pairs, and the index of each path's first point.
+    """
+    if not paths:
+        return b'', b''
+    points = np.round(np.concatenate(paths) * SCALE).astype('<i4')
+    offsets = np.cumsum([0] + [len(p) for p in paths[:-1]]).astype('<i4')
+    return points.tobytes(), offsets.tobytes()
+
+def unpack(points, offsets):
+    """
+    Unpack pack()ed bytes into an (n, 2) array of degrees and an array of
+    path offsets.
+    """
+    return (np.frombuffer(points, dtype='<i4').reshape(-1, 2) / SCALE,
+            np.frombuffer(offsets, dtype='<i4'))
+
+def rows(route_id, route_xml):
+    """
+    Build a route's RoutePath rows (dicts), one per zoom level.
+    """
+    paths = parse(route_xml)
+    projected = []
+    for p in paths:
+        lat = p[:, 0].mean()
+        projected.append((p[:, 1] * tracks.METERS_PER_DEGREE_LON * math.cos(math.radians(lat)),
+                          p[:, 0] * tracks.METERS_PER_DEGREE_LAT, lat))
+    result = []
+    for zoom in range(app.config['PATH_MIN_ZOOM'], app.config['PATH_MAX_ZOOM'] + 1):
+        simplified = [p[tracks.simplify(x, y, tracks.tolerance(
+                          zoom, lat, app.config['PATH_TOLERANCE_PIXELS']))]
+                      for p, (x, y, lat) in zip(paths, projected)]
+        points, offsets = pack(simplified)
+        result.append({'route_id': route_id, 'zoom': zoom,
+                       'points': points, 'offsets': offsets})
+    return result
+
+def tile_bounds(z, x, y):
+    """
+    A Web Mercator tile's (lat_min, lat_max, lon_min, lon_max).
+    """
+    n = 2 ** z
+    lat = lambda y: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat(y + 1), lat(y), x / n * 360 - 180, (x + 1) / n * 360 - 180
+
+def clip(points, offsets, bounds):
+    """
+    Get the parts of a route's paths which overlap bounds, as a list of
+    (n, 2) arrays: runs of consecutive segments whose bounding boxes overlap
+    it, so that lines crossing the tile edge are drawn up to the next point.
+    """
+    lat_min, lat_max, lon_min, lon_max = bounds
+    a, b = points[:-1], points[1:]
+    keep = (np.minimum(a[:, 0], b[:, 0]) <= lat_max) & (np.maximum(a[:, 0], b[:, 0]) >= lat_min)\
+         & (np.minimum(a[:, 1], b[:, 1]) <= lon_max) & (np.maximum(a[:, 1], b[:, 1]) >= lon_min)
+    # No segments from one path's last point to the next one's first.
+    keep[offsets[1:] - 1] = False
+    edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return [points[s:e + 1] for s, e in zip(starts, ends)]
+
+def build_tile(agency_tag, z, x, y):
+    """
+    Build a tile's JSON document.
+    """
+    from models import Agency, Route, RoutePath
+    bounds = tile_bounds(z, x, y)
+    lat_min, lat_max, lon_min, lon_max = bounds
+    zoom = min(max(z, app.config['PATH_MIN_ZOOM']), app.config['PATH_MAX_ZOOM'])
+    result = {}
+    for tag, color, points, offsets in db.session.query(
+                Route.tag, Route.color, RoutePath.points, RoutePath.offsets)\
+            .join(RoutePath, RoutePath.route_id == Route.id).join(Agency)\
+            .filter(Agency.tag == agency_tag, RoutePath.zoom == zoom,
+                    Route.lat_min <= lat_max, Route.lat_max >= lat_min,
+                    Route.lon_min <= lon_max, Route.lon_max >= lon_min):
+        if not points:
+            continue
+        parts = clip(*unpack(points, offsets), bounds=bounds)
+        if parts:
+            result[tag] = {
+                'color': color,
+                'paths': [tracks.encode_polyline(p[:, 0], p[:, 1]) for p in parts],
+            }
+    return json.dumps({'routes': result})
+
+def tile(agency_tag, z, x, y):
+    """
+    Get a tile's JSON document, from the cache if it's there.
+    """
+    r = connection()
+    versions = [v.decode() if v else 0 for v in r.hmget(Catalog.version_key, ['*', agency_tag])]
+    key = tile_key_format.format(agency_tag, versions[0], versions[1], z, x, y)
+    doc = r.get(key)
+    if doc is not None:
+        return doc.decode()
+    doc = build_tile(agency_tag, z, x, y)
+    r.setex(key, app.config['PATH_TILE_CACHE_TTL'], doc)
+    return doc
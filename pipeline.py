@@ -0,0 +1,147 @@
+"""
+Long-running, pipelined ingest.
+
+Each cycle goes through three stages, each on its own thread:
+fetch (HTTP requests to Nextbus), parse (XML to rows) and write (DB insert).
+The stages are connected by bounded queues, so the fetch for one cycle can
+run while the previous cycle is being parsed or written. Throughput is then
+limited by the slowest stage, not by the sum of all stages.
+"""
+import queue
+import threading
+import time
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import Prediction, VehicleLocation
+from nextbus import Nextbus
+
+# Per-dataset hooks into Nextbus:
+# (load routes, build requests, build rows, model, publish rows or None,
+#  get last times from responses or None)
+datasets = {
+    'predictions': (Nextbus.prediction_routes, Nextbus.prediction_requests,
+                    Nextbus.prediction_rows, Prediction, Nextbus.publish_predictions, None),
+    'vehicle_locations': (Nextbus.vehicle_routes, Nextbus.vehicle_requests,
+                          Nextbus.vehicle_rows, VehicleLocation, None,
+                          Nextbus.vehicle_last_times),
+}
+
+class IngestPipeline():
+    def __init__(self, dataset, agency_tags, interval, queue_size=2):
+        """
+        dataset = 'predictions' or 'vehicle_locations'
+        agency_tags = agencies to ingest
+        interval = target seconds between the starts of two cycles
+        queue_size = max cycles waiting between two stages. When a later
+            stage falls behind, the queue fills up and the earlier stage
+            blocks (backpressure), instead of piling up stale data.
+        """
+        self.dataset = dataset
+        self.agency_tags = agency_tags
+        self.interval = interval
+        self.load_routes, self.build_requests, self.build_rows, self.model, self.publish, \
+            self.get_last_times = datasets[dataset]
+        # What the previous response for each route was current as of. The
+        # previous cycle may not be written yet when the next one is fetched,
+        # so this is kept here rather than read back from the database.
+        self.last_times = {}
+        self.parse_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def run(self):
+        """
+        Run until stop() is called (e.g. from a signal handler), then finish
+        the cycles already in flight and return.
+        """
+        for stage, inbox, outbox in ((self._fetch, None, self.parse_queue),
+                                     (self._parse, self.parse_queue, self.write_queue),
+                                     (self._write, self.write_queue, None)):
+            t = threading.Thread(target=self._stage, args=(stage, inbox, outbox),
+                                 name="{0}-{1}".format(self.dataset, stage.__name__))
+            t.start()
+            self.threads.append(t)
+        for t in self.threads:
+            # join() with a timeout, so the main thread still receives signals.
+            while t.is_alive():
+                t.join(0.5)
+
+    def stop(self):
+        """
+        Ask the pipeline to stop. No new cycles are fetched.
+        """
+        self.stopping.set()
+
+    def _stage(self, stage, inbox, outbox):
+        """
+        Run one stage in an app context (so it gets its own DB session).
+        Takes work from `inbox` (or paces itself, if it's the first stage)
+        and puts results into `outbox`. A None work item means shut down;
+        it's passed along so the later stages drain and exit too.
+        """
+        with app.app_context():
+            next_start = time.time()
+            while True:
+                if inbox is None:
+                    # First stage: pace cycles to the target interval.
+                    self.stopping.wait(max(next_start - time.time(), 0))
+                    if self.stopping.is_set():
+                        work = None
+                    else:
+                        next_start = max(next_start + self.interval, time.time())
+                        work = (time.time(),)
+                else:
+                    work = inbox.get()
+                if work is None:
+                    if outbox is not None:
+                        outbox.put(None)
+                    return
+                try:
+                    result = stage(*work)
+                except Exception as e:
+                    print("{0}: {1} stage failed: {2!r}".format(self.dataset, stage.__name__, e))
+                    db.session.rollback()
+                    continue
+                if outbox is not None and result is not None:
+                    outbox.put(result)
+
+    def _fetch(self, started):
+        with Nextbus.locks(self.agency_tags, shared=('routes',)):
+            routes = self.load_routes(self.agency_tags)
+            if not routes:
+                return None
+            if self.get_last_times:
+                requests = self.build_requests(routes, self.last_times)
+            else:
+                requests = self.build_requests(routes)
+        fetched = Nextbus.fetch(requests)
+        if self.get_last_times:
+            self.last_times.update(self.get_last_times(fetched))
+        return (started, fetched)
+
+    def _parse(self, started, fetched):
+        db.session.begin()
+        responses = Nextbus.parse_responses(fetched)
+        routes = self.load_routes(self.agency_tags)
+        rows = self.build_rows(routes, responses)
+        fetched = Nextbus.fetched_stops(routes, responses) if self.publish else None
+        db.session.commit()
+        return (started, rows, fetched)
+
+    def _write(self, started, rows, fetched):
+        try:
+            with Nextbus.locks(self.agency_tags, shared=('routes',),
+                                exclusive=(self.dataset,)):
+                Nextbus.insert_rows(self.model, rows)
+        except IntegrityError:
+            # Routes were refreshed while this cycle was in flight.
+            db.session.rollback()
+            print("{0}: dropped {1} rows for routes which no longer exist."\
+                  .format(self.dataset, len(rows)))
+            return
+        if self.publish:
+            self.publish(self.load_routes(self.agency_tags), rows, fetched)
+        print("Got {0} {1} for {2} agencies in {3:0.2f} seconds."\
+              .format(len(rows), self.dataset.replace("_", " "),
+                      len(self.agency_tags), time.time() - started))
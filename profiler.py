@@ -0,0 +1,134 @@
+"""
+Always-on sampling profiler for Celery worker processes.
+
+A background thread looks at the stacks of the threads which are running a
+task, `rate` times per second, and counts each stack under the task's name.
+Every `write_interval` seconds (or when `manage.py dump_profile` asks for it)
+the counts are written to `<directory>/<pid>.folded` in collapsed-stack
+format: one "task;frame;frame;... count" line per distinct stack, which
+flamegraph.pl and speedscope read directly.
+
+Sampling costs one walk over the task threads' stacks per sample, so at the
+default 10 samples per second the overhead is negligible.
+"""
+import os
+import sys
+import threading
+from time import sleep, time
+from lock import connection
+
+# Set to the time of the latest on-demand dump request.
+dump_key = "bm-profiler-dump"
+
+_profiler = None
+
+class SamplingProfiler():
+    def __init__(self, rate, directory, write_interval=60):
+        """
+        rate = samples per second
+        directory = where to write collapsed-stack files
+        write_interval = seconds between writes
+        """
+        self.interval = 1.0 / rate
+        self.directory = directory
+        self.write_interval = write_interval
+        self.path = os.path.join(directory, "{0}.folded".format(os.getpid()))
+        self.tasks = {}   # thread id -> name of the task it is running
+        self.counts = {}  # collapsed stack -> samples
+        self.lock = threading.Lock()
+        self.last_write = time()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+
+    def task_started(self, name):
+        self.tasks[threading.get_ident()] = name
+
+    def task_finished(self):
+        self.tasks.pop(threading.get_ident(), None)
+
+    def _run(self):
+        next_check = time() + 1
+        while True:
+            sleep(self.interval)
+            self.sample()
+            if time() >= next_check:
+                next_check = time() + 1
+                if time() - self.last_write >= self.write_interval or self._dump_requested():
+                    self.write()
+
+    def sample(self):
+        """
+        Count the current stack of every thread which is running a task.
+        """
+        frames = sys._current_frames()
+        for thread_id, task in list(self.tasks.items()):
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{0}:{1}".format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(task)
+            key = ";".join(reversed(stack))
+            with self.lock:
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _dump_requested(self):
+        try:
+            requested = connection().get(dump_key)
+        except Exception:
+            return False
+        return requested is not None and float(requested) > self.last_write
+
+    def write(self):
+        """
+        Write all samples since this process started, replacing the last write.
+        """
+        with self.lock:
+            lines = ["{0} {1}\n".format(k, v) for k, v in sorted(self.counts.items())]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.writelines(lines)
+        os.replace(tmp, self.path)
+        self.last_write = time()
+
+def profiler(rate, directory, write_interval):
+    """
+    Get this process's profiler, starting it on first use (or after a fork).
+    """
+    global _profiler
+    if _profiler is None or _profiler.path != os.path.join(
+            directory, "{0}.folded".format(os.getpid())):
+        _profiler = SamplingProfiler(rate, directory, write_interval)
+        _profiler.start()
+    return _profiler
+
+def request_dump():
+    """
+    Ask every running profiler to write its samples now.
+    """
+    connection().set(dump_key, time())
+
+def merge(directory, max_age=None, task=None):
+    """
+    Add up the collapsed stacks of all processes' files.
+    max_age = only files written within this many seconds (i.e. live processes)
+    task = only this task's stacks
+    Returns {collapsed stack: samples}.
+    """
+    counts = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.endswith(".folded"):
+            continue
+        if max_age is not None and time() - os.path.getmtime(path) > max_age:
+            continue
+        with open(path) as f:
+            for line in f:
+                stack, n = line.rsplit(" ", 1)
+                if task and stack.split(";", 1)[0] != task:
+                    continue
+                counts[stack] = counts.get(stack, 0) + int(n)
+    return counts
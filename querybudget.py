@@ -0,0 +1,133 @@
+"""
+SQL statement counting and N+1 detection for Flask requests.
+
+Counts the SQL statements and DB time of each request, and groups the
+statements by shape (the SQL with its parameters blanked out). A shape which
+runs SQL_REPEAT_THRESHOLD times or more in one request is most likely a lazy
+relationship being loaded row by row (an N+1), so it's reported along with
+the line of our code which triggered it.
+
+With SQL_DEBUG_HEADERS on (DevConfig), the findings are returned as
+X-SQL-* response headers. With SQL_QUERY_BUDGET_ENFORCE on (TestConfig), a
+request which runs more statements than its endpoint's SQL_QUERY_BUDGETS
+entry raises QueryBudgetExceeded. Endpoints which serve several datasets
+(/ajax) are budgeted per dataset, as "<endpoint>:<dataset>".
+(tests/test_query_budgets.py requests each budgeted endpoint.)
+"""
+import os
+import re
+import sys
+from time import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_params = re.compile(r"%\(\w+\)s|\?|\$\d+")
+_lists = re.compile(r"\?(?:\s*,\s*\?)+")
+_space = re.compile(r"\s+")
+
+def shape(statement):
+    """
+    Reduce a statement to its shape: parameters and IN lists become "?".
+    """
+    statement = _params.sub("?", statement)
+    statement = _lists.sub("?", statement)
+    return _space.sub(" ", statement).strip()
+
+class QueryBudget():
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('SQL_DEBUG_HEADERS', False)
+        app.config.setdefault('SQL_QUERY_BUDGET_ENFORCE', False)
+        app.config.setdefault('SQL_QUERY_BUDGETS', {})
+        app.config.setdefault('SQL_REPEAT_THRESHOLD', 5)
+        if not (app.config['SQL_DEBUG_HEADERS'] or app.config['SQL_QUERY_BUDGET_ENFORCE']):
+            # Off: no listeners, so no overhead.
+            return
+        self.root = os.path.abspath(app.root_path)
+        event.listen(Engine, 'before_cursor_execute', self._before)
+        event.listen(Engine, 'after_cursor_execute', self._after)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def _start(self):
+        g.sql_statements = []
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql_statements' in g:
+            g.sql_started = time()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql_statements' in g:
+            g.sql_statements.append((shape(statement), time() - g.sql_started,
+                                     self._call_site()))
+
+    def _call_site(self):
+        """
+        The innermost frame of our own code (not a library's, nor this module's).
+        """
+        here = os.path.abspath(__file__)
+        frame = sys._getframe(1)
+        while frame is not None:
+            filename = os.path.abspath(frame.f_code.co_filename)
+            if filename.startswith(self.root) and filename != here \
+                    and "site-packages" not in filename:
+                return "{0}:{1}".format(os.path.relpath(filename, self.root), frame.f_lineno)
+            frame = frame.f_back
+        return None
+
+    def report(self):
+        """
+        Summarize the current request's statements:
+        (count, seconds, [(repeats, call sites, shape)] for likely N+1s).
+        """
+        statements = g.get('sql_statements', [])
+        shapes = {}
+        for statement, seconds, site in statements:
+            s = shapes.setdefault(statement, [0, set()])
+            s[0] += 1
+            s[1].add(site)
+        threshold = self.app.config['SQL_REPEAT_THRESHOLD']
+        repeated = sorted(((n, sorted(s for s in sites if s), statement)
+                           for statement, (n, sites) in shapes.items() if n >= threshold),
+                          reverse=True)
+        return len(statements), sum(s[1] for s in statements), repeated
+
+    def budget(self):
+        """
+        The current request's budget name and statement budget (or None):
+        "<endpoint>:<dataset>" if there is one for its ?dataset=, else the
+        endpoint's.
+        """
+        budgets = self.app.config['SQL_QUERY_BUDGETS']
+        dataset = request.args.get('dataset')
+        if dataset:
+            name = "{0}:{1}".format(request.endpoint, dataset)
+            if name in budgets:
+                return name, budgets[name]
+        return request.endpoint, budgets.get(request.endpoint)
+
+    def _finish(self, response):
+        count, seconds, repeated = self.report()
+        if self.app.config['SQL_DEBUG_HEADERS']:
+            response.headers['X-SQL-Queries'] = str(count)
+            response.headers['X-SQL-Time-Ms'] = "{0:.1f}".format(seconds * 1000)
+            for n, sites, statement in repeated:
+                response.headers.add('X-SQL-Repeated', "{0}x at {1}: {2}".format(
+                    n, ", ".join(sites) or "?", statement[:200]))
+        name, budget = self.budget()
+        if self.app.config['SQL_QUERY_BUDGET_ENFORCE'] and budget is not None and count > budget:
+            raise(QueryBudgetExceeded(
+                "{0} ran {1} SQL statements; its budget is {2}.{3}".format(
+                    name, count, budget, "".join(
+                        "\n  {0}x at {1}: {2}".format(n, ", ".join(sites) or "?", statement)
+                        for n, sites, statement in repeated))))
+        return response
+
+class QueryBudgetExceeded(Exception):
+    """ A request ran more SQL statements than its endpoint's budget. """
+    pass
@@ -0,0 +1,234 @@
+"""
+Budgeting of Nextbus requests against the API's byte quota, shared by all
+workers through a ledger in Redis. See QuotaPlanner.
+"""
+from time import sleep, time
+from datetime import datetime, timedelta
+from uuid import uuid4
+from lock import connection
+from models import ApiCall
+from app import app, db
+
+# Reserve bytes against the shared ledger, if they fit under the limit.
+# KEYS: ledger (zset of "id:bytes" -> expiry in ms)
+# ARGV: now (ms), expires (ms), id, bytes, limit
+# Returns 1 if reserved, 0 if there is not enough budget.
+_RESERVE = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+local used = 0
+for _, member in ipairs(redis.call('zrange', KEYS[1], 0, -1)) do
+    used = used + tonumber(string.match(member, ':(%d+)$'))
+end
+if used + tonumber(ARGV[4]) > tonumber(ARGV[5]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[3] .. ':' .. ARGV[4])
+redis.call('pexpireat', KEYS[1], ARGV[2])
+return 1
+"""
+
+class QuotaPlanner():
+    """
+    Plans Nextbus requests against the API's byte quota.
+
+    Every request reserves its estimated response size in a ledger shared by
+    all workers (in Redis) before it is sent, and settles the reservation with
+    the actual size once the response arrives. Entries expire from the ledger
+    after the quota window, just as the bytes age out of Nextbus's own count.
+
+    Commands have priorities: vehicle locations before predictions before
+    routes. A lower-priority request may not eat into the bytes which the
+    higher-priority commands have been spending per window (per ApiCall
+    history), so live data keeps flowing when the budget is tight. Commands
+    with a QUOTA_MIN_SHARE may always fill the window up to that fraction of
+    it, and higher priorities leave it free for them, so route imports can't
+    be starved. A request which doesn't fit is deferred until budget frees
+    up, for at most QUOTA_MAX_DEFER seconds.
+
+    Sizes are counted as response_size() measures them, both in the ledger
+    and in ApiCall.size (which the estimates are learned from).
+    """
+
+    ledger_key = "bm-quota-ledger"
+
+    # Lower number = higher priority.
+    priorities = {
+        'vehicleLocations': 0,
+        'predictionsForMultiStops': 1,
+        'routeConfig': 2,
+        'routeList': 2,
+        'agencyList': 2,
+    }
+
+    # Estimated response bytes when there is no history yet.
+    # predictionsForMultiStops is estimated per stop.
+    default_estimates = {
+        'vehicleLocations': 8 * 1024,
+        'predictionsForMultiStops': 1024,
+        'routeConfig': 64 * 1024,
+        'routeList': 4 * 1024,
+        'agencyList': 16 * 1024,
+    }
+
+    # How much ApiCall history to learn from, and how often to re-learn it.
+    history_seconds = 10 * 60
+    history_refresh_seconds = 60
+
+    _history = None
+    _history_time = 0
+
+    @staticmethod
+    def response_size(response):
+        """
+        Bytes a response counts for: its Content-Length (what was sent over
+        the wire), or the length of its body if it has none.
+        0 for a connection error (None).
+        """
+        if response is None:
+            return 0
+        try:
+            return int(response.headers['content-length'])
+        except (KeyError, ValueError):
+            return len(response.content)
+
+    def __init__(self, max_bytes, window_seconds):
+        self.max_bytes = max_bytes
+        self.window_seconds = window_seconds
+        self.r = connection()
+        self._reserve = self.r.register_script(_RESERVE)
+
+    @staticmethod
+    def units(params):
+        """
+        How many units of work a request asks for (stops, for predictions).
+        """
+        if params.get('command') == 'predictionsForMultiStops':
+            return max(len(params.get('stops', [])), 1)
+        return 1
+
+    def priority(self, params):
+        """
+        Priority of a request (lower number = higher priority).
+        """
+        return self.priorities.get(params.get('command'), max(self.priorities.values()))
+
+    def history(self):
+        """
+        Learn from recent ApiCalls:
+        - bytes per unit, per (command, agency) and per command
+        - bytes spent per quota window, per priority
+        Cached for history_refresh_seconds.
+        """
+        cls = type(self)
+        if cls._history and time() - cls._history_time < cls.history_refresh_seconds:
+            return cls._history
+        since = datetime.now() - timedelta(seconds=cls.history_seconds)
+        calls = db.session.query(ApiCall.params, ApiCall.size)\
+                    .filter(ApiCall.time >= since, ApiCall.size > 0,
+                            ApiCall.source == 'Nextbus').all()
+        totals = {}
+        spent = {}
+        for params, size in calls:
+            command = params.get('command')
+            for key in ((command, params.get('a')), (command, None)):
+                t = totals.setdefault(key, [0, 0])
+                t[0] += size
+                t[1] += cls.units(params)
+            priority = self.priority(params)
+            spent[priority] = spent.get(priority, 0) + size
+        windows = cls.history_seconds / self.window_seconds
+        cls._history = {
+            'per_unit': {k: b / u for k, (b, u) in totals.items()},
+            'per_window': {p: b / windows for p, b in spent.items()},
+        }
+        cls._history_time = time()
+        return cls._history
+
+    def estimate(self, params):
+        """
+        Estimate the response size of a request, in bytes.
+        """
+        command = params.get('command')
+        per_unit = self.history()['per_unit']
+        bytes_per_unit = per_unit.get((command, params.get('a')),
+                         per_unit.get((command, None),
+                         self.default_estimates.get(command, 0)))
+        return int(bytes_per_unit * self.units(params))
+
+    def min_shares(self):
+        """
+        Guaranteed fraction of the window per priority (see QUOTA_MIN_SHARE).
+        """
+        shares = {}
+        for command, share in app.config['QUOTA_MIN_SHARE'].items():
+            priority = self.priority({'command': command})
+            shares[priority] = max(shares.get(priority, 0), share)
+        return shares
+
+    def limit(self, params):
+        """
+        Bytes which a request of this priority may fill the window up to.
+        Leaves room for what higher-priority commands usually spend, and for
+        the guaranteed shares of lower-priority ones, but is never less than
+        this priority's own guaranteed share.
+        """
+        priority = self.priority(params)
+        per_window = self.history()['per_window']
+        shares = self.min_shares()
+        headroom = sum(b for p, b in per_window.items() if p < priority)
+        reserved = sum(s for p, s in shares.items() if p > priority) * self.max_bytes
+        return max(self.max_bytes - headroom - reserved,
+                   shares.get(priority, 0) * self.max_bytes, 0)
+
+    def max_defer(self, params):
+        """
+        How long a request may wait for budget (QUOTA_MAX_DEFER).
+        """
+        return app.config['QUOTA_MAX_DEFER'].get(params.get('command'), 0)
+
+    def reserve(self, params, max_defer=None):
+        """
+        Reserve budget for a request. Wait up to max_defer seconds for
+        budget to free up. Returns a reservation, or None if there's no room.
+        """
+        if max_defer is None:
+            max_defer = self.max_defer(params)
+        size = self.estimate(params)
+        limit = self.limit(params)
+        deadline = time() + max_defer
+        while True:
+            reservation = (uuid4().hex, size, time())
+            if self._add(reservation, limit):
+                return reservation
+            if time() >= deadline:
+                return None
+            sleep(min(0.25, max(deadline - time(), 0)))
+
+    def settle(self, reservation, size):
+        """
+        Replace a reservation's estimate with the actual response size.
+        """
+        if reservation is None:
+            return
+        rid, estimate, reserved_time = reservation
+        expires = int((reserved_time + self.window_seconds) * 1000)
+        pipe = self.r.pipeline()
+        pipe.zrem(self.ledger_key, "{0}:{1}".format(rid, estimate))
+        pipe.zadd(self.ledger_key, expires, "{0}:{1}".format(rid, int(size or 0)))
+        pipe.execute()
+
+    def remaining(self):
+        """
+        Bytes left in the current window, per the ledger.
+        """
+        now = int(time() * 1000)
+        used = sum(int(m.rsplit(b":", 1)[1])
+                   for m in self.r.zrangebyscore(self.ledger_key, now, '+inf'))
+        return max(self.max_bytes - used, 0)
+
+    def _add(self, reservation, limit):
+        rid, size, reserved_time = reservation
+        now = int(time() * 1000)
+        expires = int((reserved_time + self.window_seconds) * 1000)
+        return self._reserve(keys=[self.ledger_key],
+                             args=[now, expires, rid, size, limit])
@@ -0,0 +1,145 @@
+"""
+Sharding of ingest work across Celery worker queues.
+
+Each piece of work (a dataset for one agency) is a shard. Shards are assigned
+to worker queues by consistent hashing, so when a worker joins or leaves,
+only the shards of that worker's queue move. Workers announce which ingest
+queues they consume with a heartbeat; queues without a live worker are left
+out of the ring.
+"""
+import json
+import threading
+from bisect import bisect
+from hashlib import md5
+from time import sleep, time
+from lock import connection
+
+class ShardRing():
+    """
+    A consistent hash ring of the worker queues which are currently alive.
+    """
+
+    members_key = "bm-shard-queues"
+
+    # Points per queue on the ring. More points = more even distribution.
+    replicas = 64
+
+    # Seconds between heartbeats, and until a silent queue is considered dead.
+    heartbeat = 3
+    expires = 10
+
+    def __init__(self, queues):
+        """
+        queues = every ingest queue name which may be used
+        """
+        self.queues = queues
+        self.r = connection()
+
+    @staticmethod
+    def _hash(value):
+        return int(md5(value.encode()).hexdigest()[:8], 16)
+
+    def live_queues(self):
+        """
+        Get the ingest queues which a worker has announced recently.
+        """
+        alive = self.r.zrangebyscore(self.members_key, time() - self.expires, '+inf')
+        alive = {q.decode() for q in alive}
+        return [q for q in self.queues if q in alive]
+
+    def assign(self, shard, default=None):
+        """
+        Get the queue for a shard, or `default` if no ingest queue is alive.
+        """
+        queues = self.live_queues()
+        if not queues:
+            return default
+        ring = sorted((self._hash("{0}#{1}".format(q, i)), q)
+                      for q in queues for i in range(self.replicas))
+        point = bisect(ring, (self._hash(shard),))
+        return ring[point % len(ring)][1]
+
+    def register(self, queues):
+        """
+        Announce that this worker consumes `queues`, until it exits.
+        Starts a daemon thread that keeps the announcement fresh.
+        """
+        queues = [q for q in queues if q in self.queues]
+        if not queues:
+            return
+        def beat():
+            while True:
+                now = time()
+                self.r.zadd(self.members_key, *[x for q in queues for x in (now, q)])
+                sleep(self.heartbeat)
+        threading.Thread(target=beat, daemon=True).start()
+
+    def unregister(self, queues):
+        """
+        Withdraw this worker's queues (on shutdown), so their shards move now
+        instead of after `expires` seconds.
+        """
+        queues = [q for q in queues if q in self.queues]
+        if queues:
+            self.r.zrem(self.members_key, *queues)
+
+
+class Cycle():
+    """
+    Tracks one fan-out of a dataset's shards, and reports when all of them
+    have finished.
+    """
+
+    def __init__(self, dataset, cycle_id):
+        self.dataset = dataset
+        self.id = cycle_id
+        self.key = "bm-cycle-{0}:{1}".format(dataset, cycle_id)
+        self.r = connection()
+
+    @classmethod
+    def start(cls, dataset, shards):
+        """
+        Start a new cycle for `shards` (a list of shard names).
+        """
+        r = connection()
+        cycle = cls(dataset, r.incr("bm-cycle-id-{0}".format(dataset)))
+        pipe = r.pipeline()
+        pipe.hmset(cycle.key, {'shards': len(shards), 'remaining': len(shards),
+                               'rows': 0, 'skipped': 0, 'started': time()})
+        pipe.expire(cycle.key, 60 * 60)
+        pipe.execute()
+        return cycle
+
+    def finish(self, rows=0, skipped=False, failed=False):
+        """
+        Mark one shard as done (failed = it raised). Returns the cycle's
+        summary if this was the last shard, otherwise None.
+        """
+        pipe = self.r.pipeline()
+        pipe.hincrby(self.key, 'rows', rows)
+        pipe.hincrby(self.key, 'skipped', int(skipped))
+        pipe.hincrby(self.key, 'failed', int(failed))
+        pipe.hincrby(self.key, 'remaining', -1)
+        remaining = pipe.execute()[-1]
+        if remaining != 0:
+            return None
+        cycle = {k.decode(): float(v) for k, v in self.r.hgetall(self.key).items()}
+        summary = {
+            'cycle': self.id,
+            'shards': int(cycle['shards']),
+            'skipped': int(cycle['skipped']),
+            'failed': int(cycle.get('failed', 0)),
+            'rows': int(cycle['rows']),
+            'elapsed': time() - cycle['started'],
+            'finished': time(),
+        }
+        self.r.set("bm-cycle-last-{0}".format(self.dataset), json.dumps(summary))
+        return summary
+
+    @classmethod
+    def last(cls, dataset):
+        """
+        Get the summary of the last completed cycle for a dataset, or None.
+        """
+        summary = connection().get("bm-cycle-last-{0}".format(dataset))
+        return json.loads(summary.decode()) if summary else None
@@ -0,0 +1,366 @@
+"""
+A local stand-in for the Nextbus XML feed, for load and scale testing.
+
+Serves agencyList, routeList, routeConfig, predictionsForMultiStops and
+vehicleLocations in Nextbus's schema, for a synthetic set of agencies,
+routes, stops and vehicles. Vehicles drive back and forth along their
+routes, so locations and predictions change over time like the real thing.
+Latency, errors and size limits can be injected.
+
+Usage: python simulator.py [--agencies 1] [--routes 20] [--stops 25]
+                           [--vehicles 4] [--port 8765] ...
+Then point the app at it, e.g. in instance/config.py:
+    NEXTBUS_API_URL = 'http://localhost:8765/service/publicXMLFeed'
+    AGENCIES = ['sim0']
+"""
+import argparse
+import bisect
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import quoteattr
+
+# Meters per degree of latitude (longitude is scaled by cos(lat)).
+METERS_PER_DEGREE = 111320
+
+
+class Route():
+    """
+    A synthetic route: a random walk of stops, driven "out" from the first
+    stop to the last, then back "in".
+    """
+    def __init__(self, rng, index, center, stops, vehicles, speed):
+        self.tag = "r{0}".format(index)
+        self.title = "Route {0}".format(index)
+        self.color = "{0:06x}".format(rng.randrange(0x1000000))
+        self.opposite_color = "ffffff"
+        lat, lon = center
+        lat += rng.uniform(-0.05, 0.05)
+        lon += rng.uniform(-0.05, 0.05)
+        heading = rng.uniform(0, 2 * math.pi)
+        self.stops = []
+        for i in range(stops):
+            self.stops.append({
+                'tag': "{0}_{1}".format(self.tag, i),
+                'title': "{0} Stop {1}".format(self.title, i),
+                'lat': lat,
+                'lon': lon,
+                'stopId': index * 1000 + i,
+            })
+            heading += rng.uniform(-0.5, 0.5)
+            step = rng.uniform(200, 600)
+            lat += step * math.cos(heading) / METERS_PER_DEGREE
+            lon += step * math.sin(heading) / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        # Distance along the route (meters) of each stop
+        self.offsets = [0]
+        for a, b in zip(self.stops, self.stops[1:]):
+            self.offsets.append(self.offsets[-1] + self._distance(a, b))
+        self.length = self.offsets[-1] or 1
+        # Vehicles: (id, starting point along the out-and-back cycle,
+        # speed in m/s, offset of its GPS report schedule in seconds)
+        self.vehicles = [("{0}-{1}".format(index, v),
+                          rng.uniform(0, 2 * self.length),
+                          speed * rng.uniform(0.7, 1.3),
+                          rng.uniform(0, 10))
+                         for v in range(vehicles)]
+
+    @staticmethod
+    def _distance(a, b):
+        dlat = (b['lat'] - a['lat']) * METERS_PER_DEGREE
+        dlon = (b['lon'] - a['lon']) * METERS_PER_DEGREE * math.cos(math.radians(a['lat']))
+        return math.hypot(dlat, dlon)
+
+    def position(self, cycle_offset):
+        """
+        Get (lat, lon, heading, direction tag) at a point along the
+        out-and-back cycle.
+        """
+        u = cycle_offset % (2 * self.length)
+        outbound = u < self.length
+        d = u if outbound else 2 * self.length - u
+        i = min(max(bisect.bisect_right(self.offsets, d) - 1, 0), len(self.stops) - 2)
+        a, b = self.stops[i], self.stops[i + 1]
+        seg = (self.offsets[i + 1] - self.offsets[i]) or 1
+        f = (d - self.offsets[i]) / seg
+        lat = a['lat'] + (b['lat'] - a['lat']) * f
+        lon = a['lon'] + (b['lon'] - a['lon']) * f
+        if not outbound:
+            a, b = b, a
+        heading = math.degrees(math.atan2(
+            (b['lon'] - a['lon']) * math.cos(math.radians(a['lat'])),
+            b['lat'] - a['lat'])) % 360
+        return lat, lon, int(heading), "out" if outbound else "in"
+
+    def vehicle_reports(self, now, report_interval):
+        """
+        Get each vehicle's last report as (id, time, lat, lon, heading, dir, speed).
+        Vehicles report every `report_interval` seconds, staggered.
+        """
+        reports = []
+        for vid, start, speed, phase in self.vehicles:
+            reported = math.floor((now - phase) / report_interval) * report_interval + phase
+            lat, lon, heading, dir_tag = self.position(start + speed * reported)
+            reports.append((vid, reported, lat, lon, heading, dir_tag, speed))
+        return reports
+
+    def arrivals(self, stop_index, now, max_predictions):
+        """
+        Predict arrivals at a stop: a list of (seconds, vehicle id, dir tag).
+        """
+        cycle = 2 * self.length
+        points = [("out", self.offsets[stop_index]),
+                  ("in", cycle - self.offsets[stop_index])]
+        arrivals = []
+        for vid, start, speed, phase in self.vehicles:
+            u = (start + speed * now) % cycle
+            for dir_tag, point in points:
+                distance = (point - u) % cycle
+                arrivals.append((distance / speed, vid, dir_tag))
+        return sorted(arrivals)[:max_predictions]
+
+
+class Agency():
+    def __init__(self, rng, index, routes, stops, vehicles, speed):
+        self.tag = "sim{0}".format(index)
+        self.title = "Simulated Transit {0}".format(index)
+        self.short_title = "Sim {0}".format(index)
+        self.region = "Simulation"
+        center = (40.5 + index * 0.5, -74.4)
+        self.routes = [Route(rng, r, center, stops, vehicles, speed)
+                       for r in range(routes)]
+        self.routes_by_tag = {r.tag: r for r in self.routes}
+
+
+class Simulator():
+    def __init__(self, agencies=1, routes=20, stops=25, vehicles=4, speed=8,
+                 latency=0, error_rate=0, fatal_error_rate=0,
+                 max_bytes=2 * 1024**2, max_bytes_seconds=20, report_interval=10,
+                 seed=0):
+        """
+        agencies, routes, stops, vehicles = size of the world (routes per
+            agency, stops and vehicles per route)
+        speed = average vehicle speed in m/s
+        latency = mean added response delay in seconds (exponentially distributed)
+        error_rate = share of requests answered with <Error shouldRetry="true">
+        fatal_error_rate = share answered with <Error shouldRetry="false">
+        max_bytes, max_bytes_seconds = byte quota, as enforced by Nextbus
+        report_interval = seconds between a vehicle's GPS reports
+        """
+        rng = random.Random(seed)
+        self.agencies = [Agency(rng, a, routes, stops, vehicles, speed)
+                         for a in range(agencies)]
+        self.agencies_by_tag = {a.tag: a for a in self.agencies}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fatal_error_rate = fatal_error_rate
+        self.max_bytes = max_bytes
+        self.max_bytes_seconds = max_bytes_seconds
+        self.report_interval = report_interval
+        self.rng = random.Random(seed)
+        self.served = deque()  # (time, bytes) of recent responses
+        self.served_lock = threading.Lock()
+
+    def handle(self, params):
+        """
+        Answer a request (a dict of param -> list of values) with XML bytes.
+        """
+        if self.latency:
+            time.sleep(self.rng.expovariate(1 / self.latency))
+        roll = self.rng.random()
+        if roll < self.fatal_error_rate:
+            return self._error("Simulated fatal error.", False)
+        if roll < self.fatal_error_rate + self.error_rate:
+            return self._error("Simulated temporary error.", True)
+        command = params.get('command', [None])[0]
+        handler = getattr(self, "cmd_{0}".format(command), None)
+        if not handler:
+            return self._error("Command \"{0}\" is not valid.".format(command), False)
+        try:
+            body = handler(params)
+        except KeyError as e:
+            return self._error("Invalid parameter: {0}".format(e), False)
+        xml = self._body(body)
+        if not self._within_quota(len(xml)):
+            return self._error("Exceeded the maximum of {0} bytes per {1} seconds."\
+                               .format(self.max_bytes, self.max_bytes_seconds), True)
+        return xml
+
+    def _within_quota(self, size):
+        now = time.time()
+        with self.served_lock:
+            while self.served and self.served[0][0] < now - self.max_bytes_seconds:
+                self.served.popleft()
+            if sum(s for t, s in self.served) + size > self.max_bytes:
+                return False
+            self.served.append((now, size))
+            return True
+
+    @staticmethod
+    def _body(elements):
+        return ('<?xml version="1.0" encoding="utf-8" ?>\n'
+                '<body copyright="Simulated data.">\n{0}\n</body>\n'
+                .format("\n".join(elements))).encode()
+
+    def _error(self, text, should_retry):
+        return self._body(['<Error shouldRetry="{0}">{1}</Error>'\
+                           .format("true" if should_retry else "false", text)])
+
+    @staticmethod
+    def _tag(name, attrs, children=None):
+        a = " ".join("{0}={1}".format(k, quoteattr(str(v))) for k, v in attrs)
+        if children is None:
+            return "<{0} {1}/>".format(name, a)
+        return "<{0} {1}>{2}</{0}>".format(name, a, "".join(children))
+
+    def cmd_agencyList(self, params):
+        return [self._tag('agency', [('tag', a.tag), ('title', a.title),
+                    ('shortTitle', a.short_title), ('regionTitle', a.region)])
+                for a in self.agencies]
+
+    def cmd_routeList(self, params):
+        agency = self.agencies_by_tag[params['a'][0]]
+        return [self._tag('route', [('tag', r.tag), ('title', r.title)])
+                for r in agency.routes]
+
+    def cmd_routeConfig(self, params):
+        agency = self.agencies_by_tag[params['a'][0]]
+        if 'r' in params or 'route' in params:
+            routes = [agency.routes_by_tag[params.get('r', params.get('route'))[0]]]
+        else:
+            routes = agency.routes[:100]
+        return [self._route_config(r) for r in routes]
+
+    def _route_config(self, route):
+        lats = [s['lat'] for s in route.stops]
+        lons = [s['lon'] for s in route.stops]
+        children = [self._tag('stop', [('tag', s['tag']), ('title', s['title']),
+                        ('lat', round(s['lat'], 7)), ('lon', round(s['lon'], 7)),
+                        ('stopId', s['stopId'])])
+                    for s in route.stops]
+        for dir_tag, title, stops in (("out", "Outbound", route.stops),
+                                      ("in", "Inbound", route.stops[::-1])):
+            children.append(self._tag('direction',
+                [('tag', dir_tag), ('title', title), ('name', title), ('useForUI', 'true')],
+                [self._tag('stop', [('tag', s['tag'])]) for s in stops]))
+        children.append(self._tag('path', [], [
+            self._tag('point', [('lat', round(s['lat'], 7)), ('lon', round(s['lon'], 7))])
+            for s in route.stops]))
+        return self._tag('route', [('tag', route.tag), ('title', route.title),
+            ('color', route.color), ('oppositeColor', route.opposite_color),
+            ('latMin', min(lats)), ('latMax', max(lats)),
+            ('lonMin', min(lons)), ('lonMax', max(lons))], children)
+
+    def cmd_predictionsForMultiStops(self, params):
+        agency = self.agencies_by_tag[params['a'][0]]
+        now = time.time()
+        elements = []
+        for pair in params['stops']:
+            route_tag, stop_tag = pair.split("|", 1)
+            route = agency.routes_by_tag[route_tag]
+            index = next(i for i, s in enumerate(route.stops) if s['tag'] == stop_tag)
+            stop = route.stops[index]
+            by_direction = {}
+            for seconds, vid, dir_tag in route.arrivals(index, now, 5):
+                by_direction.setdefault(dir_tag, []).append(self._tag('prediction', [
+                    ('epochTime', int((now + seconds) * 1000)),
+                    ('seconds', int(seconds)), ('minutes', int(seconds / 60)),
+                    ('isDeparture', 'false'), ('affectedByLayover', 'false'),
+                    ('dirTag', dir_tag), ('vehicle', vid), ('block', vid),
+                    ('tripTag', "{0}-{1}".format(vid, int(now // 3600)))]))
+            directions = [self._tag('direction',
+                              [('title', "Outbound" if d == "out" else "Inbound")], p)
+                          for d, p in by_direction.items()]
+            elements.append(self._tag('predictions', [('agencyTitle', agency.title),
+                ('routeTitle', route.title), ('routeTag', route.tag),
+                ('stopTitle', stop['title']), ('stopTag', stop['tag'])], directions))
+        return elements
+
+    def cmd_vehicleLocations(self, params):
+        agency = self.agencies_by_tag[params['a'][0]]
+        since = int(params.get('t', [0])[0]) / 1000
+        routes = agency.routes
+        if 'r' in params:
+            routes = [agency.routes_by_tag[params['r'][0]]]
+        now = time.time()
+        elements = []
+        for route in routes:
+            for vid, reported, lat, lon, heading, dir_tag, speed in \
+                    route.vehicle_reports(now, self.report_interval):
+                if reported <= since:
+                    continue
+                elements.append(self._tag('vehicle', [('id', vid),
+                    ('routeTag', route.tag), ('dirTag', dir_tag),
+                    ('lat', round(lat, 6)), ('lon', round(lon, 6)),
+                    ('secsSinceReport', int(now - reported)), ('predictable', 'true'),
+                    ('heading', heading), ('speedKmHr', round(speed * 3.6, 1))]))
+        elements.append(self._tag('lastTime', [('time', int(now * 1000))]))
+        return elements
+
+
+class Handler(BaseHTTPRequestHandler):
+    simulator = None
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        xml = self.simulator.handle(params)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(xml)))
+        self.end_headers()
+        self.wfile.write(xml)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(simulator, host='localhost', port=8765):
+    """
+    Serve the simulated feed until interrupted.
+    """
+    Handler.simulator = simulator
+    server = ThreadingServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated Nextbus XML feed")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--agencies', type=int, default=1)
+    parser.add_argument('--routes', type=int, default=20, help="per agency")
+    parser.add_argument('--stops', type=int, default=25, help="per route")
+    parser.add_argument('--vehicles', type=int, default=4, help="per route")
+    parser.add_argument('--speed', type=float, default=8, help="m/s")
+    parser.add_argument('--latency', type=float, default=0,
+        help="mean added delay per response, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0,
+        help="share of responses with a temporary <Error>")
+    parser.add_argument('--fatal-error-rate', type=float, default=0,
+        help="share of responses with a permanent <Error>")
+    parser.add_argument('--max-bytes', type=int, default=2 * 1024**2,
+        help="byte quota per --max-bytes-seconds")
+    parser.add_argument('--max-bytes-seconds', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    simulator = Simulator(args.agencies, args.routes, args.stops, args.vehicles,
+                          args.speed, args.latency, args.error_rate,
+                          args.fatal_error_rate, args.max_bytes,
+                          args.max_bytes_seconds, seed=args.seed)
+    print("Simulating {0} agencies, {1} routes, {2} vehicles on http://{3}:{4}/service/publicXMLFeed"\
+          .format(args.agencies, args.agencies * args.routes,
+                  args.agencies * args.routes * args.vehicles, args.host, args.port))
+    serve(simulator, args.host, args.port)
@@ -58,7 +58,11 @@ BusMap.Map = function(opts) {
         }
         L.tileLayer(tileUrl, tileOptions).addTo(that.leaflet);
 
+        // Draw route paths for the tiles in view.
+        that.leaflet.on('moveend', updatePaths);
+
         // Fetch initial data
+        updatePaths();
         updateRoutes();
         updateVehicles();
         // Begin timed data updates
@@ -86,6 +90,55 @@ BusMap.Map = function(opts) {
         return that;
     };
 
+    /* Get route paths for the map tiles in view (at the current zoom) */
+    var pathTiles = {};
+    var pathZoom = null;
+    // Bumped on every zoom change; responses to older requests are dropped.
+    var pathGeneration = 0;
+    function updatePaths() {
+        var zoom = that.leaflet.getZoom();
+        if (!that.pathLayer) {
+            that.pathLayer = L.layerGroup().addTo(that.leaflet);
+        }
+        if (zoom !== pathZoom) {
+            that.pathLayer.clearLayers();
+            pathTiles = {};
+            pathZoom = zoom;
+            pathGeneration++;
+        }
+        var generation = pathGeneration;
+        var bounds = that.leaflet.getPixelBounds();
+        var min = bounds.min.divideBy(256).floor();
+        var max = bounds.max.divideBy(256).floor();
+        for (var x = min.x; x <= max.x; x++) {
+            for (var y = min.y; y <= max.y; y++) {
+                var tile = zoom + "/" + x + "/" + y;
+                if (tile in pathTiles || x < 0 || y < 0) {
+                    continue;
+                }
+                pathTiles[tile] = true;
+                $.getJSON("paths/" + that.opts.agency + "/" + tile + ".json")
+                    .done(function(data) {
+                        if (generation !== pathGeneration) {
+                            return;
+                        }
+                        for (var r in data.routes) {
+                            var color = data.routes[r].color ? "#" + data.routes[r].color : "#888";
+                            data.routes[r].paths.forEach(function(path) {
+                                L.polyline(BusMap.decodePolyline(path), {
+                                    color: color,
+                                    weight: 3,
+                                    opacity: 0.6,
+                                    clickable: false,
+                                }).addTo(that.pathLayer);
+                            });
+                        }
+                    });
+            }
+        }
+        return that;
+    };
+
     /* Get Vehicles (and Predictions) */
     function updateVehicles() {
         var url = "ajax";
@@ -125,6 +178,28 @@ BusMap.Map = function(opts) {
         return that;
     };
 
+    /* Get one stop's predictions (e.g. when its popup is opened) */
+    function updateStopPredictions(stop_id) {
+        $.getJSON("stops/" + stop_id + "/predictions")
+            .done(function(data) {
+                if (!(that.stops && stop_id in that.stops)) {
+                    return;
+                }
+                var predictions = {};
+                for (var r in data.routes) {
+                    predictions[r] = [];
+                    for (var d in data.routes[r]) {
+                        predictions[r] = predictions[r].concat(data.routes[r][d]);
+                    }
+                }
+                that.stops[stop_id].predictions = predictions;
+                var update = {};
+                update[stop_id] = that.stops[stop_id];
+                updateStopsUI(update);
+            });
+        return that;
+    };
+
     /* Refresh (and/or create) UI elements for Vehicles */
     function updateVehiclesUI(vehicles) {
         if (!(that.vehicleMarkersGroup)) {
@@ -253,6 +328,9 @@ BusMap.Map = function(opts) {
                 that.stopMarkers[s] = L.marker(
                     [stops[s].lat, stops[s].lon],
                     markerOpts).bindPopup(text, popupOpts);
+                that.stopMarkers[s].on('popupopen', (function(stop_id) {
+                    return function() { updateStopPredictions(stop_id); };
+                })(s));
                 that.stopMarkersClusterGroup.addLayer(that.stopMarkers[s]);
             }
             // Add predictions to the marker popup, if available
@@ -356,6 +434,28 @@ BusMap.Map = function(opts) {
     return that;
 };
 
+/* Decode a Google encoded polyline into [lat, lon] pairs */
+BusMap.decodePolyline = function(encoded) {
+    var points = [];
+    var lat = 0, lon = 0, i = 0;
+    while (i < encoded.length) {
+        var values = [];
+        for (var n = 0; n < 2; n++) {
+            var shift = 0, result = 0, b;
+            do {
+                b = encoded.charCodeAt(i++) - 63;
+                result |= (b & 0x1f) << shift;
+                shift += 5;
+            } while (b >= 0x20);
+            values.push(result & 1 ? ~(result >> 1) : result >> 1);
+        }
+        lat += values[0];
+        lon += values[1];
+        points.push([lat / 1e5, lon / 1e5]);
+    }
+    return points;
+}
+
 /* Methods to set and get BusMap-related cookies */
 BusMap.getCookies = function() {
     // http://stackoverflow.com/a/4004010
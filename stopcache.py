@@ -0,0 +1,106 @@
+"""
+Per-stop cache of upcoming arrivals, for /stops/<id>/predictions.
+
+After every predictions cycle, ingest writes each stop's arrivals to Redis as
+the JSON document which the endpoint returns, with a short TTL. The endpoint
+serves that as-is, and only queries the database on a miss.
+
+Document format:
+    {"stop_id": 12, "routes": {route tag: {direction tag: [prediction, ...]}}}
+where each route's predictions are soonest first.
+"""
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from lock import connection
+from app import app, db
+
+key_format = "bm-stop-predictions-{0}"
+
+def _is_true(value):
+    # Rows built from XML still hold the attribute strings.
+    return value in (True, 'true')
+
+def document(stop_id, predictions):
+    """
+    Build a stop's JSON document from a list of dicts with route, direction,
+    prediction (datetime), vehicle, is_departure and has_layover.
+    """
+    routes = OrderedDict()
+    for p in sorted(predictions, key=lambda p: p['prediction']):
+        routes.setdefault(p['route'], OrderedDict())\
+              .setdefault(p['direction'], []).append({
+                  'route': p['route'],
+                  'direction': p['direction'],
+                  'prediction': p['prediction'],
+                  'vehicle': p['vehicle'],
+                  'is_departure': _is_true(p['is_departure']),
+                  'has_layover': _is_true(p['has_layover']),
+                  'stop_id': stop_id,
+              })
+    return json.dumps({'stop_id': stop_id, 'routes': routes}, cls=app.json_encoder)
+
+def publish(routes, rows, fetched):
+    """
+    Cache the arrivals of every stop which has Prediction rows (dicts) from
+    this cycle. Stops which were fetched but got none get an empty document,
+    so they don't keep serving arrivals which are gone; the documents of
+    stops whose batch was deferred or failed are left as they are.
+    routes = the cycle's routes, as (agency tag, route tag) -> CatalogRoute;
+    fetched = ids of the stops whose batch got a response (see
+              Nextbus.fetched_stops()).
+    """
+    tags = {}
+    for route in routes.values():
+        directions = {d_id: d_tag for d_tag, d_id in route.directions.items()}
+        tags[route.id] = (route.tag, directions)
+    now = datetime.now()
+    by_stop = {}
+    for row in rows:
+        if row['prediction'] < now or row['route_id'] not in tags:
+            continue
+        route_tag, directions = tags[row['route_id']]
+        by_stop.setdefault(row['stop_id'], []).append(dict(row,
+            route=route_tag, direction=directions.get(row['direction_id'])))
+    pipe = connection().pipeline(transaction=False)
+    for stop_id in set(by_stop) | set(fetched):
+        pipe.setex(key_format.format(stop_id), app.config['STOP_PREDICTIONS_CACHE_TTL'],
+                   document(stop_id, by_stop.get(stop_id, [])))
+    pipe.execute()
+
+def get(stop_id):
+    """
+    Get a stop's cached document, or None.
+    """
+    doc = connection().get(key_format.format(stop_id))
+    return doc.decode() if doc is not None else None
+
+def load(stop_id):
+    """
+    Build a stop's document from the database, and cache it.
+    Returns None if there is no such stop.
+    """
+    from models import Direction, Prediction, Route, Stop
+    if not db.session.query(Stop.id).filter(Stop.id == stop_id).first():
+        return None
+    # The predictions from the stop's most recent API call. (Arrivals which
+    # an earlier call had, but the latest one didn't, are gone.)
+    latest = db.session.query(db.func.max(Prediction.api_call_id))\
+                .filter(Prediction.stop_id == stop_id,
+                        Prediction.created >= datetime.now() -
+                            timedelta(seconds=app.config['PREDICTIONS_MAX_AGE']))\
+                .as_scalar()
+    rows = db.session.query(Route.tag, Direction.tag, Prediction.prediction,
+                            Prediction.vehicle, Prediction.is_departure,
+                            Prediction.has_layover)\
+                .join(Prediction, Prediction.route_id == Route.id)\
+                .outerjoin(Direction, Direction.id == Prediction.direction_id)\
+                .filter(Prediction.api_call_id == latest,
+                        Prediction.stop_id == stop_id,
+                        Prediction.prediction >= datetime.now()).all()
+    doc = document(stop_id, [{'route': r, 'direction': d, 'prediction': p, 'vehicle': v,
+                              'is_departure': dep, 'has_layover': lay}
+                             for r, d, p, v, dep, lay in rows])
+    connection().setex(key_format.format(stop_id),
+                       app.config['STOP_PREDICTIONS_CACHE_TTL'], doc)
+    return doc
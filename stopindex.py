@@ -0,0 +1,123 @@
+"""
+In-memory spatial index of stops, for /stops/nearby.
+
+Stops are bucketed into a grid of small lat/lon cells. A query looks at the
+cells around the point in rings, nearest ring first, and stops as soon as no
+unvisited cell could hold anything closer than what it already found. A query
+only touches the few cells near the point, so it takes about the same time
+however many stops there are.
+
+Each process keeps one index, and rebuilds it when the route catalog's
+version stamps change (see catalog.py), i.e. after a route import.
+"""
+import heapq
+import math
+import threading
+from time import time
+from catalog import Catalog
+from lock import connection
+from app import db
+
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LON = 111320
+
+class StopIndex():
+    def __init__(self, stops, cell=0.005):
+        """
+        stops = list of dicts with id, title, lat, lon, routes (route tags)
+                and agencies (agency tags)
+        cell = grid cell size, in degrees
+        """
+        self.cell = cell
+        self.grid = {}
+        for stop in stops:
+            self.grid.setdefault(self._cell(stop['lat'], stop['lon']), []).append(stop)
+        self.size = len(stops)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell)), int(math.floor(lon / self.cell)))
+
+    @staticmethod
+    def distance(lat1, lon1, lat2, lon2):
+        """
+        Distance in meters (equirectangular; accurate over a few km).
+        """
+        dy = (lat2 - lat1) * METERS_PER_DEGREE_LAT
+        dx = (lon2 - lon1) * METERS_PER_DEGREE_LON * math.cos(math.radians((lat1 + lat2) / 2))
+        return math.hypot(dx, dy)
+
+    def nearest(self, lat, lon, k=10, radius=500, agency=None):
+        """
+        Get up to k stops within radius meters of (lat, lon), nearest first,
+        as a list of (distance, stop). agency = only stops on its routes.
+        """
+        if k < 1:
+            return []
+        ci, cj = self._cell(lat, lon)
+        # Width of one cell in meters, in the narrower direction.
+        cell_m = self.cell * min(METERS_PER_DEGREE_LAT,
+                                 METERS_PER_DEGREE_LON * math.cos(math.radians(lat)))
+        rings = int(radius / cell_m) + 1
+        found = []  # heap of (-distance, id, stop), the k best so far
+        for r in range(rings + 1):
+            for i in range(ci - r, ci + r + 1):
+                for j in range(cj - r, cj + r + 1):
+                    if max(abs(i - ci), abs(j - cj)) != r:
+                        continue
+                    for stop in self.grid.get((i, j), ()):
+                        if agency and agency not in stop['agencies']:
+                            continue
+                        d = self.distance(lat, lon, stop['lat'], stop['lon'])
+                        if d > radius:
+                            continue
+                        if len(found) < k:
+                            heapq.heappush(found, (-d, stop['id'], stop))
+                        elif d < -found[0][0]:
+                            heapq.heapreplace(found, (-d, stop['id'], stop))
+            # Anything beyond this ring is at least r cells away.
+            if len(found) == k and -found[0][0] <= r * cell_m:
+                break
+        return [(-d, stop) for d, i, stop in sorted(found, reverse=True)]
+
+    @classmethod
+    def load(cls):
+        """
+        Build an index of all stops.
+        """
+        from models import Agency, Route, RouteStop, Stop
+        stops = {}
+        for stop_id, title, lat, lon in db.session.query(Stop.id, Stop.title, Stop.lat, Stop.lon):
+            if lat is None or lon is None:
+                continue
+            stops[stop_id] = {'id': stop_id, 'title': title, 'lat': lat, 'lon': lon,
+                              'routes': [], 'agencies': set()}
+        for stop_id, route_tag, agency_tag in db.session.query(
+                    RouteStop.stop_id, Route.tag, Agency.tag)\
+                .join(Route, Route.id == RouteStop.route_id).join(Agency):
+            if stop_id in stops:
+                stops[stop_id]['routes'].append(route_tag)
+                stops[stop_id]['agencies'].add(agency_tag)
+        return cls(list(stops.values()))
+
+# This process's index, and the catalog versions it was built from.
+_index = None
+_versions = None
+_checked = 0
+_lock = threading.Lock()
+
+def index(check_interval=1):
+    """
+    Get this process's StopIndex. Checks the catalog version stamps at most
+    every check_interval seconds, and rebuilds the index if they changed.
+    """
+    global _index, _versions, _checked
+    if _index is not None and time() - _checked < check_interval:
+        return _index
+    with _lock:
+        if _index is None or time() - _checked >= check_interval:
+            versions = connection().hgetall(Catalog.version_key)
+            if _index is None or versions != _versions:
+                _index = StopIndex.load()
+                _versions = versions
+            _checked = time()
+    return _index
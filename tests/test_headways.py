@@ -0,0 +1,64 @@
+"""
+headways.compute(), on prediction rows built in memory.
+    BUSMAP_ENV=test python -m unittest discover tests
+"""
+import os
+os.environ.setdefault('BUSMAP_ENV', 'test')
+import unittest
+from datetime import datetime, timedelta
+from app import app
+import headways
+
+NOW = datetime(2016, 3, 1, 12, 0)
+
+def row(vehicle, stop_id, minutes, direction_id=1):
+    return {
+        'direction_id': direction_id,
+        'stop_id': stop_id,
+        'vehicle': vehicle,
+        'prediction': NOW + timedelta(minutes=minutes),
+    }
+
+class ComputeTest(unittest.TestCase):
+    def by_vehicle(self, rows):
+        return {h['vehicle']: h for h in headways.compute(rows, NOW)}
+
+    def test_headway_to_leader(self):
+        rows = [row('v1', s, s) for s in range(3)] + [row('v2', s, s + 10) for s in range(3)]
+        result = self.by_vehicle(rows)
+        self.assertEqual(set(result), {'v2'})
+        self.assertEqual(result['v2']['leader'], 'v1')
+        self.assertEqual(result['v2']['headway'], 600)
+        self.assertEqual(result['v2']['stops'], 3)
+        self.assertFalse(result['v2']['bunched'])
+
+    def test_bunched(self):
+        rows = [row(v, s, s + i * 10) for i, v in enumerate(('v1', 'v2', 'v3'))
+                for s in range(3)]
+        rows += [row('v4', s, s + 21) for s in range(3)]
+        result = self.by_vehicle(rows)
+        self.assertLess(result['v4']['headway'], app.config['HEADWAY_BUNCHING_SECONDS'])
+        self.assertTrue(result['v4']['bunched'])
+        self.assertFalse(result['v2']['bunched'])
+
+    def test_passed_predictions_are_left_out(self):
+        rows = [row('v1', 0, -1), row('v2', 0, 5)]
+        self.assertEqual(headways.compute(rows, NOW), [])
+
+    def test_rows_without_direction_are_left_out(self):
+        rows = [row('v1', s, s) for s in range(3)] + [row('v2', s, s + 10) for s in range(3)]
+        rows += [row('v3', s, s + 5, direction_id=None) for s in range(3)]
+        rows += [row('v4', s, s + 7, direction_id=None) for s in range(3)]
+        result = self.by_vehicle(rows)
+        self.assertEqual(set(result), {'v2'})
+        self.assertEqual(result['v2']['leader'], 'v1')
+        self.assertEqual(headways.compute(rows[6:], NOW), [])
+
+    def test_next_arrival_only(self):
+        # v1 comes by stop 0 twice; only its next arrival counts.
+        rows = [row('v1', 0, 0), row('v1', 0, 60), row('v2', 0, 10)]
+        result = self.by_vehicle(rows)
+        self.assertEqual(result['v2']['headway'], 600)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+"""
+Request every endpoint which has an SQL_QUERY_BUDGETS entry, with
+TestConfig's budget enforcement on, and fail if one goes over its budget.
+
+Needs Redis and the TestConfig Postgres database (which is wiped), or set
+BUSMAP_TEST_DATABASE to another one:
+    BUSMAP_ENV=test python -m unittest discover tests
+"""
+import math
+import os
+os.environ.setdefault('BUSMAP_ENV', 'test')
+import unittest
+from datetime import datetime, timedelta
+import numpy as np
+from app import app, db
+from lock import connection
+from querybudget import QueryBudgetExceeded
+
+AGENCY = 'budget-test'
+LAT, LON = 40.5, -74.45
+
+def seed():
+    """
+    One agency with one route, three stops, two vehicles, their recent
+    locations and predictions, headways and paths.
+    """
+    import headways
+    import paths
+    from models import (Agency, ApiCall, Direction, Headway, Prediction, Region,
+                        Route, RoutePath, RouteStop, Stop, VehicleLocation)
+    now = datetime.now()
+    db.session.begin()
+    region = Region(title='Test Region')
+    agency = Agency(tag=AGENCY, title='Budget Test', short_title='Test', region=region)
+    route = Route(tag='r1', title='Route 1', short_title='1', color='ff0000',
+                  opposite_color='000000', lat_min=LAT - 0.01, lat_max=LAT + 0.01,
+                  lon_min=LON - 0.01, lon_max=LON + 0.01, agency=agency)
+    direction = Direction(tag='in', title='Inbound', name='Inbound', route=route)
+    stops = [Stop(title='Stop {0}'.format(i), lat=LAT + i * 0.002, lon=LON, lat_lon_count=1)
+             for i in range(3)]
+    api_call = ApiCall(url='test', params={}, size=0, status=200)
+    db.session.add_all([region, agency, route, direction, api_call] + stops)
+    db.session.flush()
+    for i, stop in enumerate(stops):
+        db.session.add(RouteStop(route_id=route.id, stop_id=stop.id, stop_tag='s{0}'.format(i)))
+    for v, vehicle in enumerate(('v1', 'v2')):
+        for t in range(5):
+            db.session.add(VehicleLocation(vehicle=vehicle, route_id=route.id,
+                direction_id=direction.id, lat=LAT + 0.0005 * t, lon=LON + 0.001 * v,
+                time=now - timedelta(seconds=10 * (5 - t)), predictable=True,
+                heading=0, speed=20, api_call_id=api_call.id))
+        for i, stop in enumerate(stops):
+            db.session.add(Prediction(route_id=route.id, direction_id=direction.id,
+                stop_id=stop.id, vehicle=vehicle, created=now, is_departure=False,
+                has_layover=False, api_call_id=api_call.id,
+                prediction=now + timedelta(minutes=2 + i + 5 * v)))
+    db.session.add(Headway(route_id=route.id, direction_id=direction.id, vehicle='v2',
+                           leader='v1', headway=300, stops=3, bunched=False, updated=now))
+    points, offsets = paths.pack([np.array([[LAT - 0.01, LON], [LAT, LON + 0.001],
+                                            [LAT + 0.01, LON]])])
+    for zoom in range(app.config['PATH_MIN_ZOOM'], app.config['PATH_MAX_ZOOM'] + 1):
+        db.session.add(RoutePath(route_id=route.id, zoom=zoom, points=points, offsets=offsets))
+    db.session.commit()
+    connection().hset(headways.computed_key, route.id, now.timestamp())
+    return stops[0].id
+
+def tile(lat, lon, z):
+    """
+    The x, y of the Web Mercator tile containing a point.
+    """
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+class QueryBudgetTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+            'BUSMAP_TEST_DATABASE', app.config['SQLALCHEMY_URI'])
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            cls.stop_id = seed()
+        # / and /embed show the first configured agency.
+        app.config['AGENCIES'] = [AGENCY]
+        # Make the cached endpoints go to the database.
+        r = connection()
+        r.delete("bm-stop-predictions-{0}".format(cls.stop_id))
+        for key in r.scan_iter("bm-path-tile-{0}-*".format(AGENCY)):
+            r.delete(key)
+        cls.client = app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        with app.app_context():
+            db.drop_all()
+
+    def requests(self):
+        """
+        budget name -> URL to request
+        """
+        x, y = tile(LAT, LON, 14)
+        return {
+            'ajax:routes': '/ajax?dataset=routes&agency={0}'.format(AGENCY),
+            'ajax:vehicles': '/ajax?dataset=vehicles&agency={0}'.format(AGENCY),
+            'ajax:positions': '/ajax?dataset=positions&agency={0}'.format(AGENCY),
+            'ajax:headways': '/ajax?dataset=headways&agency={0}'.format(AGENCY),
+            'map': '/',
+            'map_embed': '/embed',
+            'stop_predictions': '/stops/{0}/predictions'.format(self.stop_id),
+            'stops_nearby': '/stops/nearby?lat={0}&lon={1}'.format(LAT, LON),
+            'vehicle_track': '/vehicles/v1/track',
+            'path_tile': '/paths/{0}/14/{1}/{2}.json'.format(AGENCY, x, y),
+        }
+
+    def test_every_budget_is_exercised(self):
+        self.assertEqual(set(self.requests()), set(app.config['SQL_QUERY_BUDGETS']))
+
+    def test_budgets(self):
+        for name, url in sorted(self.requests().items()):
+            with self.subTest(budget=name):
+                try:
+                    response = self.client.get(url)
+                except QueryBudgetExceeded as e:
+                    self.fail(str(e))
+                self.assertEqual(response.status_code, 200, url)
+                self.assertLessEqual(int(response.headers['X-SQL-Queries']),
+                                     app.config['SQL_QUERY_BUDGETS'][name], url)
+
+if __name__ == '__main__':
+    unittest.main()
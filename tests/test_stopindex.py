@@ -0,0 +1,57 @@
+"""
+stopindex.StopIndex.nearest(), on an index built in memory.
+    BUSMAP_ENV=test python -m unittest discover tests
+"""
+import os
+os.environ.setdefault('BUSMAP_ENV', 'test')
+import unittest
+from stopindex import StopIndex
+
+LAT, LON = 40.5, -74.45
+
+def stop(id, dlat, dlon, agencies=('a',)):
+    return {'id': id, 'title': 'Stop {0}'.format(id), 'lat': LAT + dlat, 'lon': LON + dlon,
+            'routes': [], 'agencies': set(agencies)}
+
+class NearestTest(unittest.TestCase):
+    def setUp(self):
+        # Stops 1..10, about 111m further north each, and one for another agency.
+        self.index = StopIndex([stop(i, i * 0.001, 0) for i in range(1, 11)] +
+                               [stop(11, 0, 0.0005, agencies=('b',))])
+
+    def ids(self, *args, **kwargs):
+        return [s['id'] for d, s in self.index.nearest(LAT, LON, *args, **kwargs)]
+
+    def test_nearest_first(self):
+        self.assertEqual(self.ids(3, 1000), [11, 1, 2])
+
+    def test_matches_brute_force(self):
+        for k in (1, 4, 20):
+            for radius in (50, 300, 2000):
+                expected = sorted((StopIndex.distance(LAT, LON, s['lat'], s['lon']), s['id'])
+                                  for cell in self.index.grid.values() for s in cell)
+                expected = [i for d, i in expected if d <= radius][:k]
+                self.assertEqual(self.ids(k, radius), expected, (k, radius))
+
+    def test_distances(self):
+        results = self.index.nearest(LAT, LON, 2, 1000)
+        self.assertAlmostEqual(results[1][0], 110.54, places=1)
+        self.assertLessEqual(results[0][0], results[1][0])
+
+    def test_radius(self):
+        self.assertEqual(self.ids(10, 250), [11, 1, 2])
+        self.assertEqual(self.ids(10, 10), [])
+
+    def test_agency(self):
+        self.assertEqual(self.ids(2, 1000, 'a'), [1, 2])
+        self.assertEqual(self.ids(2, 1000, 'b'), [11])
+
+    def test_k_below_one(self):
+        self.assertEqual(self.ids(0, 1000), [])
+        self.assertEqual(self.ids(-3, 1000), [])
+
+    def test_empty(self):
+        self.assertEqual(StopIndex([]).nearest(LAT, LON, 5, 1000), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Compact vehicle track history, for /vehicles/<id>/track.
+
+A vehicle's recent locations are read in one range scan over the
+(vehicle, time) index, simplified with Douglas-Peucker at a tolerance that
+matches the map's zoom level (points closer than a pixel to the line can't
+be seen anyway), and encoded as a Google encoded polyline. The times of the
+kept points are sent as seconds since the previous point.
+"""
+import numpy as np
+from datetime import datetime, timedelta
+from app import app, db
+
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LON = 111320
+# Meters per pixel at zoom 0 on the equator, for 256px Web Mercator tiles.
+METERS_PER_PIXEL_Z0 = 156543.03
+
+def tolerance(zoom, lat, pixels=1):
+    """
+    Simplification tolerance, in meters, for a zoom level at a latitude.
+    """
+    return pixels * METERS_PER_PIXEL_Z0 * np.cos(np.radians(lat)) / 2**zoom
+
+def simplify(x, y, tolerance):
+    """
+    Douglas-Peucker simplification of a line given as arrays of x and y (in
+    meters). Returns the indices of the points to keep. Each step measures
+    all of a segment's points at once.
+    """
+    n = len(x)
+    if n < 3:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        px, py = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        norm = np.hypot(dx, dy)
+        if norm == 0:
+            d = np.hypot(px, py)
+        else:
+            d = np.abs(dy * px - dx * py) / norm
+        i = int(np.argmax(d))
+        if d[i] > tolerance:
+            m = a + 1 + i
+            keep[m] = True
+            stack.append((a, m))
+            stack.append((m, b))
+    return np.flatnonzero(keep)
+
+def encode_polyline(lat, lon):
+    """
+    Encode coordinates in Google's encoded polyline format (1e-5 precision).
+    """
+    deltas = lambda a: np.diff(np.concatenate(([0], np.round(np.asarray(a) * 1e5))))\
+                         .astype(np.int64)
+    values = np.empty(2 * len(lat), dtype=np.int64)
+    values[0::2] = deltas(lat)
+    values[1::2] = deltas(lon)
+    values = np.where(values < 0, ~(values << 1), values << 1)
+    chunks = []
+    for v in values.tolist():
+        while v >= 0x20:
+            chunks.append(chr((0x20 | (v & 0x1f)) + 63))
+            v >>= 5
+        chunks.append(chr(v + 63))
+    return "".join(chunks)
+
+def track(vehicle, minutes, zoom):
+    """
+    Get a vehicle's track over the last `minutes`, simplified for `zoom`.
+    Returns None if there are no locations in that time.
+    """
+    from models import VehicleLocation
+    since = datetime.now() - timedelta(minutes=minutes)
+    rows = db.session.query(VehicleLocation.time, VehicleLocation.lat, VehicleLocation.lon)\
+                .filter(VehicleLocation.vehicle == vehicle,
+                        VehicleLocation.time >= since)\
+                .order_by(VehicleLocation.time).all()
+    rows = [r for r in rows if r[1] is not None and r[2] is not None]
+    if not rows:
+        return None
+    times, lat, lon = zip(*rows)
+    lat, lon = np.array(lat, dtype=float), np.array(lon, dtype=float)
+    # Project to meters around the track's mean latitude.
+    y = lat * METERS_PER_DEGREE_LAT
+    x = lon * METERS_PER_DEGREE_LON * np.cos(np.radians(lat.mean()))
+    kept = simplify(x, y, tolerance(zoom, lat.mean(), app.config['TRACK_TOLERANCE_PIXELS']))
+    seconds = np.array([(times[i] - times[0]).total_seconds() for i in kept])
+    return {
+        'vehicle': vehicle,
+        'start': times[0],
+        'times': np.diff(np.concatenate(([0], np.round(seconds)))).astype(int).tolist(),
+        'polyline': encode_polyline(lat[kept], lon[kept]),
+        'points': len(rows),
+        'kept': len(kept),
+    }
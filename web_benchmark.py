@@ -0,0 +1,196 @@
+"""
+Load benchmark for the web tier: /, /embed and /ajax.
+
+Seeds a database with a simulated fleet (via simulator.py and the normal
+route import) plus a configurable depth of vehicle location and prediction
+history, then requests each endpoint from a pool of threads through Flask's
+test client. Reports p50/p95/p99 latency, throughput, response size, and
+SQL statements and DB time per request.
+
+With --history-depths, the history is grown step by step and the benchmark
+is repeated at each depth, to show how latency scales with table size.
+
+Needs Redis and a Postgres database which may be wiped, e.g.:
+    python web_benchmark.py postgresql://localhost/pybusmap_bench \
+        --routes 50 --vehicles 4 --history-depths 10,100,1000
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import app, db
+
+endpoints = {
+    'map': "/",
+    'embed': "/embed",
+    'routes': "/ajax?dataset=routes&agency={agency}",
+    'vehicles': "/ajax?dataset=vehicles&agency={agency}",
+}
+
+
+class DBTimer():
+    """
+    Counts SQL statements and time spent in the DB, per thread.
+    """
+    def __init__(self, engine):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def reset(self):
+        self.local.statements = 0
+        self.local.seconds = 0
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        self.local.start = time.time()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        if hasattr(self.local, 'statements'):
+            self.local.statements += 1
+            self.local.seconds += time.time() - self.local.start
+
+
+def seed_catalog(routes, stops, vehicles, port):
+    """
+    Import a simulated agency's routes. Returns the simulator.
+    """
+    from nextbus import Nextbus
+    from quota import QuotaPlanner
+    from simulator import Simulator, Handler, ThreadingServer
+    simulator = Simulator(agencies=1, routes=routes, stops=stops, vehicles=vehicles,
+                          max_bytes=2**40)
+    Handler.simulator = simulator
+    server = ThreadingServer(('localhost', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Nextbus.api_url = "http://localhost:{0}/service/publicXMLFeed".format(port)
+    Nextbus._quota = QuotaPlanner(2**40, Nextbus.api_limits['max_bytes_timeframe_seconds'])
+    try:
+        db.drop_all()
+        db.create_all()
+        Nextbus.get_agencies(truncate=True)
+        Nextbus.get_routes(simulator.agencies[0].tag, truncate=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return simulator
+
+
+def seed_history(simulator, start_depth, end_depth):
+    """
+    Add history steps [start_depth, end_depth): each step is one location
+    per vehicle (3 seconds apart, going back in time) and a set of
+    predictions for every stop.
+    """
+    from models import ApiCall, Direction, Prediction, Route, VehicleLocation
+    agency = simulator.agencies[0]
+    routes = {r.tag: r for r in db.session.query(Route).all()}
+    directions = {(d.route_id, d.tag): d.id for d in db.session.query(Direction).all()}
+    now = datetime.now()
+    for step in range(start_depth, end_depth):
+        when = now - timedelta(seconds=3 * step)
+        result = db.engine.execute(ApiCall.__table__.insert().returning(ApiCall.id),
+                                   {'url': 'benchmark', 'size': 0, 'status': 200, 'time': when})
+        api_call_id = result.scalar()
+        locations = []
+        predictions = []
+        for sim_route in agency.routes:
+            route = routes[sim_route.tag]
+            for vid, reported, lat, lon, heading, dir_tag, speed in \
+                    sim_route.vehicle_reports(time.time() - 3 * step, 10):
+                locations.append({'vehicle': vid, 'route_id': route.id,
+                    'direction_id': directions.get((route.id, dir_tag)),
+                    'lat': lat, 'lon': lon, 'time': when, 'predictable': True,
+                    'heading': heading, 'speed': speed * 3.6,
+                    'api_call_id': api_call_id})
+            for route_stop in route.stops.values():
+                for n, (vid, v_start, v_speed, phase) in enumerate(sim_route.vehicles[:2]):
+                    predictions.append({'route_id': route.id,
+                        'stop_id': route_stop.stop_id,
+                        'prediction': now + timedelta(minutes=5 * (n + 1)),
+                        'created': when, 'is_departure': False, 'has_layover': False,
+                        'direction_id': directions[(route.id, "out")], 'vehicle': vid,
+                        'block': vid, 'api_call_id': api_call_id})
+        if locations:
+            db.engine.execute(VehicleLocation.__table__.insert(), locations)
+        if predictions:
+            db.engine.execute(Prediction.__table__.insert(), predictions)
+
+
+def bench(path, concurrency, count, timer):
+    """
+    Request `path` `count` times from `concurrency` threads. Returns stats.
+    """
+    def one(i):
+        client = app.test_client()
+        timer.reset()
+        start = time.time()
+        response = client.get(path)
+        elapsed = time.time() - start
+        return (elapsed, len(response.data), response.status_code,
+                timer.local.statements, timer.local.seconds)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(count)))
+    wall = time.time() - start
+    latencies = sorted(r[0] for r in results)
+    pct = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+    return {
+        'requests': count,
+        'errors': sum(1 for r in results if r[2] != 200),
+        'p50': pct(0.50),
+        'p95': pct(0.95),
+        'p99': pct(0.99),
+        'throughput': count / wall,
+        'bytes': sum(r[1] for r in results) / count,
+        'sql_statements': sum(r[3] for r in results) / count,
+        'db_seconds': sum(r[4] for r in results) / count,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Web tier load benchmark")
+    parser.add_argument('database', help="Postgres URL. This database will be wiped!")
+    parser.add_argument('--routes', type=int, default=20)
+    parser.add_argument('--stops', type=int, default=25, help="per route")
+    parser.add_argument('--vehicles', type=int, default=4, help="per route")
+    parser.add_argument('--history', type=int, default=20,
+        help="history steps (one location per vehicle, predictions per stop)")
+    parser.add_argument('--history-depths', default=None,
+        help="comma-separated history depths to benchmark in turn (overrides --history)")
+    parser.add_argument('--endpoints', default=",".join(endpoints),
+        help="comma-separated, from: {0}".format(", ".join(endpoints)))
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100, help="per endpoint")
+    parser.add_argument('--port', type=int, default=8767)
+    parser.add_argument('--output', default=None, help="save results as JSON here")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['CAPTURE_DIR'] = None
+    depths = [int(d) for d in args.history_depths.split(",")] \
+        if args.history_depths else [args.history]
+    results = []
+    with app.app_context():
+        timer = DBTimer(db.engine)
+        simulator = seed_catalog(args.routes, args.stops, args.vehicles, args.port)
+        agency = simulator.agencies[0].tag
+        app.config['AGENCIES'] = [agency]
+        seeded = 0
+        for depth in sorted(depths):
+            seed_history(simulator, seeded, depth)
+            seeded = depth
+            for name in args.endpoints.split(","):
+                path = endpoints[name].format(agency=agency)
+                stats = bench(path, args.concurrency, args.requests, timer)
+                results.append(dict(stats, endpoint=name, history=depth))
+                print("history {0:>6} | {1:<8} p50 {2:7.1f} ms  p95 {3:7.1f} ms  p99 {4:7.1f} ms"
+                      "  {5:7.1f} req/s  {6:9.0f} bytes  {7:5.1f} SQL  {8:7.1f} ms DB  {9} errors".format(
+                      depth, name, stats['p50'] * 1000, stats['p95'] * 1000,
+                      stats['p99'] * 1000, stats['throughput'], stats['bytes'],
+                      stats['sql_statements'], stats['db_seconds'] * 1000, stats['errors']))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,99 @@
+"""
+Read-only catalog for the web tier: the configured agencies (with their
+bounds) and each one's /ajax?dataset=routes response, pre-encoded.
+
+With PRELOAD_CATALOG on, app.py loads it at import time. Under a pre-forking
+server (uWSGI without lazy-apps, gunicorn with --preload) that happens once
+in the master, and the workers share the same memory copy-on-write, so page
+renders and routes responses need no catalog queries, and the catalog
+doesn't take more memory per worker. A worker reloads its own copy if the
+route catalog's version stamps change (see catalog.py).
+"""
+import gc
+import json
+import threading
+from time import time
+from sqlalchemy.orm import joinedload, subqueryload
+from catalog import Catalog
+from lock import connection
+from app import app, db
+
+class CatalogAgency():
+    """
+    What map.html needs of an Agency.
+    """
+    __slots__ = ('tag', 'title', 'short_title', 'lat_min', 'lat_max', 'lon_min', 'lon_max')
+
+    def __init__(self, agency):
+        for attr in self.__slots__:
+            setattr(self, attr, getattr(agency, attr))
+
+def routes_document(agency_tag):
+    """
+    Build an agency's routes and stops, as served by /ajax?dataset=routes.
+    """
+    from models import Agency, Route, Stop
+    routes = db.session.query(Route).join(Agency).options(subqueryload(Route.stops))\
+        .filter(Agency.tag==agency_tag).all()
+    stops = db.session.query(Stop).options(joinedload(Stop.routes))\
+        .filter(Stop.routes.any(Route.id.in_([r.id for r in routes]))).all()
+    return {
+        "routes": {r.tag: r.serialize() for r in routes},
+        "stops": {s.id: s.serialize() for s in stops}
+    }
+
+class WebCatalog():
+    def __init__(self, agencies, routes_json, versions):
+        """
+        agencies = agency tag -> CatalogAgency
+        routes_json = agency tag -> encoded routes document
+        versions = catalog version stamps this was built from
+        """
+        self.agencies = agencies
+        self.routes_json = routes_json
+        self.versions = versions
+
+    @classmethod
+    def load(cls):
+        """
+        Load the catalog of the configured agencies (AGENCIES).
+        """
+        from models import Agency
+        # Read the stamps first: a change during loading means a reload later.
+        versions = connection().hgetall(Catalog.version_key)
+        tags = app.config['AGENCIES']
+        agencies = {a.tag: CatalogAgency(a) for a in
+                    db.session.query(Agency).filter(Agency.tag.in_(tags))}
+        routes_json = {tag: json.dumps(routes_document(tag), cls=app.json_encoder).encode()
+                       for tag in agencies}
+        return cls(agencies, routes_json, versions)
+
+_catalog = None
+_checked = 0
+_lock = threading.Lock()
+
+def preload():
+    """
+    Load the catalog now (in the master process, before workers fork).
+    """
+    global _catalog, _checked
+    _catalog = WebCatalog.load()
+    _checked = time()
+    if hasattr(gc, 'freeze'):
+        # Keep the garbage collector from touching (and so copying) its pages.
+        gc.freeze()
+
+def get(check_interval=1):
+    """
+    Get the catalog, or None if it isn't preloaded. Checks the version
+    stamps at most every check_interval seconds, and reloads on a change.
+    """
+    global _catalog, _checked
+    if _catalog is None or time() - _checked < check_interval:
+        return _catalog
+    with _lock:
+        if time() - _checked >= check_interval:
+            if connection().hgetall(Catalog.version_key) != _catalog.versions:
+                _catalog = WebCatalog.load()
+            _checked = time()
+    return _catalog